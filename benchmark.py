@@ -15,6 +15,10 @@ NUM_THREADS = 10
 OPS_PER_THREAD = 800
 PRINT_INTERVAL = 1
 
+# Send each batch through the /_mget, /_mset and /_mdel endpoints, grouped by node
+USE_BATCH_ENDPOINTS = True
+BATCH_ENDPOINTS = {'get': '_mget', 'set': '_mset', 'delete': '_mdel'}
+
 error_count = 0
 kv_stores = []
 ring = HashRing(BASE_URLS, hash_fn='ketama')
@@ -40,8 +44,54 @@ session_pool = queue.Queue()
 for session in sessions:
     session_pool.put(session)
 
+def send_group(session, base_url, op, ops):
+    """Send one node's run of same-type operations as a single request, return the error count"""
+    if op == 'set':
+        body = [{'key': key, 'value': value} for key, value in ops]
+    else:
+        body = [key for key, _ in ops]
+    try:
+        response = session.post(f"{base_url}/{BATCH_ENDPOINTS[op]}", json=body)
+        response.raise_for_status()
+        return sum(1 for result in response.json()['results'] if result['status'] != 200)
+    except Exception:
+        return len(ops)
+
+def grouped_batch_worker(batch):
+    """Process a batch of operations as one request per (node, op type) per wave"""
+    session = session_pool.get()
+    error_count = 0
+    # Ops on the same key go to successive waves so per-key order is preserved;
+    # within a wave every key is independent and can be grouped freely
+    waves = []        # [{(node, op): [(key, value), ...]}, ...]
+    last_wave = {}    # key -> (wave index, op)
+    try:
+        for op, key, value in batch:
+            prev = last_wave.get(key)
+            if prev is None:
+                wave = 0
+            elif prev[1] == op:
+                wave = prev[0]
+            else:
+                wave = prev[0] + 1
+            last_wave[key] = (wave, op)
+            if wave == len(waves):
+                waves.append({})
+            node = ring.get_node(key)
+            kv_stores.append(node)
+            waves[wave].setdefault((node, op), []).append((key, value))
+
+        for groups in waves:
+            for (node, op), ops in groups.items():
+                error_count += send_group(session, node, op, ops)
+        return error_count
+    finally:
+        session_pool.put(session)
+
 def batch_worker(batch):
     """Process a batch of operations"""
+    if USE_BATCH_ENDPOINTS:
+        return grouped_batch_worker(batch)
     session = session_pool.get()
     error_count = 0
     try:
@@ -54,6 +104,8 @@ def batch_worker(batch):
                     session.post(f"{base_url}/{key}", json={'value': value}).raise_for_status()
                 elif op == 'get':
                     session.get(f"{base_url}/{key}").raise_for_status()
+                elif op == 'delete':
+                    session.delete(f"{base_url}/{key}").raise_for_status()
             except Exception:
                 error_count += 1
         return error_count
@@ -106,7 +158,7 @@ def main():
     print(f"Total time: {total_time:.2f} seconds")
     print(f"Throughput: {throughput:.2f} operations per second")
     print(f"Average Latency: {average_latency:.5f} seconds per operation")
-    print(f"Error Rate: {error_rate:.4f}%")
+    print(f"Error Rate: {error_rate * 100:.4f}%")
 
 if __name__ == "__main__":
     main()
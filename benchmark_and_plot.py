@@ -1,6 +1,6 @@
 import threading
 import queue
-from collections import deque
+from collections import deque, Counter
 import requests
 import time
 import xxhash  
@@ -23,7 +23,9 @@ PRINT_INTERVAL = 1
 latencies_queue = deque()
 
 error_count = 0
-kv_stores = []
+# Calls routed to each node; the nodes' /_hotkeys sketches say which keys those calls hit
+node_calls = Counter()
+node_calls_lock = threading.Lock()
 ring = HashRing(BASE_URLS, hash_fn='ketama')
 
 # Synchronize the starting of threads
@@ -83,23 +85,45 @@ def batch_worker(batch):
     """Process a batch of operations"""
     session = session_pool.get()
     local_latencies = []  # Use thread-local storage
-    error_count = 0
+    local_calls = Counter()
+    errors = 0
     try:
         for op, key, value in batch:
             start_time = time.time()
             node = ring.get_node(key)
             base_url = node
-            kv_stores.append(node)
+            local_calls[node] += 1
             try:
                 if op == 'set':
                     session.post(f"{base_url}/{key}", json={'value': value}).raise_for_status()
                 elif op == 'get':
                     session.get(f"{base_url}/{key}").raise_for_status()
+                elif op == 'delete':
+                    session.delete(f"{base_url}/{key}").raise_for_status()
             except Exception:
-                error_count += 1
-                pass
+                errors += 1
             local_latencies.append(time.time() - start_time)
-        return local_latencies
+        with node_calls_lock:
+            node_calls.update(local_calls)
+        return local_latencies, errors
+    finally:
+        session_pool.put(session)
+
+def print_hot_keys(count=5):
+    """Print each node's hottest keys per operation, as its /_hotkeys sketches saw them"""
+    session = session_pool.get()
+    try:
+        for base_url in BASE_URLS:
+            try:
+                response = session.get(f"{base_url}/_hotkeys", params={"count": count})
+                response.raise_for_status()
+            except Exception as e:
+                print(f"No hot keys from {base_url}: {e}")
+                continue
+            for op, stats in response.json()["ops"].items():
+                if stats["top"]:
+                    hot = ", ".join(f"{entry['key']} ({entry['share'] * 100:.2f}%)" for entry in stats["top"])
+                    print(f"Hottest {op} keys on {base_url}: {hot}")
     finally:
         session_pool.put(session)
 
@@ -148,6 +172,7 @@ def main():
 
     # Collect all latencies for plotting
     all_latencies = []
+    total_errors = 0
 
     # Use ThreadPoolExecutor for better thread management
     with concurrent.futures.ThreadPoolExecutor(max_workers=NUM_THREADS) as executor:
@@ -156,7 +181,8 @@ def main():
         
         # Collect results as they complete
         for future in concurrent.futures.as_completed(futures):
-            batch_latencies = future.result()
+            batch_latencies, batch_errors = future.result()
+            total_errors += batch_errors
             for latency in batch_latencies:
                 latencies_queue.append(latency)
                 all_latencies.append(latency)
@@ -175,37 +201,26 @@ def main():
 
     average_latency = sum(total_latencies) / len(total_latencies) if total_latencies else float('nan')
     throughput = total_ops / total_time
-    error_rate = error_count / total_ops
+    error_rate = total_errors / total_ops
 
     print("\nFinal Results:")
     print(f"Total operations: {total_ops}")
     print(f"Total time: {total_time:.2f} seconds")
     print(f"Throughput: {throughput:.2f} operations per second")
     print(f"Average Latency: {average_latency:.5f} seconds per operation")
-    print(f"Error Rate: {error_rate:.4f}%")
+    print(f"Error Rate: {error_rate * 100:.4f}%")
 
-    kv1 = 0
-    kv2 = 0
-    kv3 = 0
-    num_nodes = len(kv_stores)
-    
-    for node in kv_stores:
-        if node == 'http://127.0.0.1:8080':
-            kv1 += 1
-        elif node == 'http://127.0.0.1:8081':
-            kv2 += 1
-        else:
-            kv3 += 1
-    print(f"Percent of 8080 calls: {kv1/len(num_nodes) * 100:.4f}%")
-    print(f"Percent of 8081 calls: {kv2/len(num_nodes) * 100:.4f}%")
-    print(f"Percent of 8082 calls: {kv3/len(num_nodes) * 100:.4f}%")
+    num_calls = sum(node_calls.values())
+    for base_url in BASE_URLS:
+        print(f"Percent of {base_url} calls: {node_calls[base_url]/num_calls * 100:.4f}%")
+    print_hot_keys()
     
     
     # Plotting Latency
-    plural = "" if len(num_nodes) == 1 else "s"
+    plural = "" if len(BASE_URLS) == 1 else "s"
     plt.figure(figsize=(12, 6))
     plt.plot(range(len(all_latencies)), all_latencies, marker='.', linestyle='', alpha=0.5)
-    plt.title(f'Latency per Operation ({len(num_nodes)} node{plural}, with monitoring code)')
+    plt.title(f'Latency per Operation ({len(BASE_URLS)} node{plural}, with monitoring code)')
     plt.xlabel('Operation Number')
     plt.ylabel('Latency (seconds)')
     plt.tight_layout()
@@ -0,0 +1,111 @@
+import asyncio
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+# Configure the comparison
+MODES = ['wsgi', 'asgi']
+CONNECTION_COUNTS = [10, 100, 500]
+DURATION = 5.0
+BASE_PORT = 8180
+
+async def http_request(reader, writer, method, path, body=None):
+    """Send one request on a keep-alive connection and return its status code"""
+    head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+    payload = b""
+    if body is not None:
+        payload = json.dumps(body).encode()
+        head += f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+    writer.write(head.encode() + b"\r\n" + payload)
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+async def connection_worker(port, conn_id, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            key = f"key_{conn_id}_{i % 100}"
+            for method, body in (('POST', {'value': f"value_{i}"}), ('GET', None)):
+                start_time = time.perf_counter()
+                status = await http_request(reader, writer, method, f"/{key}", body)
+                latencies.append(time.perf_counter() - start_time)
+                if status != 200:
+                    errors.append(status)
+            i += 1
+    finally:
+        writer.close()
+
+async def run_load(port, connections, duration):
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    start_time = time.perf_counter()
+    await asyncio.gather(*(connection_worker(port, c, deadline, latencies, errors)
+                           for c in range(connections)))
+    elapsed = time.perf_counter() - start_time
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2] if latencies else float('nan'),
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else float('nan'),
+        "error_rate": len(errors) / len(latencies) if latencies else 0.0,
+    }
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def start_server(mode, port, extra_args=()):
+    # Durability is off so both modes measure only the front end and the store
+    env = dict(os.environ, KV_WAL='off', KV_SNAPSHOTS='off')
+    return subprocess.Popen([sys.executable, 'main.py', '--mode', mode, '--port', str(port), *extra_args],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the wsgi and asgi server modes at increasing connection counts')
+    parser.add_argument('--connections', type=int, nargs='+', default=CONNECTION_COUNTS, help='Connection counts to test')
+    parser.add_argument('--duration', type=float, default=DURATION, help='Seconds per run')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    for offset, mode in enumerate(MODES):
+        port = BASE_PORT + offset
+        server = start_server(mode, port)
+        try:
+            if not wait_for_port(port):
+                print(f"{mode} server did not start")
+                continue
+            for connections in args.connections:
+                result = asyncio.run(run_load(port, connections, args.duration))
+                print(f"{mode} @ {connections} connections: {result['throughput']:.2f} ops/sec, "
+                      f"p50 {result['p50'] * 1000:.2f} ms, p99 {result['p99'] * 1000:.2f} ms, "
+                      f"error rate {result['error_rate'] * 100:.4f}%")
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
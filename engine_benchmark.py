@@ -0,0 +1,327 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+sys.path.append("./kv_store/src")
+from trie_kv_store import KVStore
+from radix_kv_store import RadixKVStore
+import values
+import kv_store
+
+# Engine constructors, given the parsed arguments; "dict" is kv_store.KVStore's in-memory
+# fallback, "redis" the same class backed by Redis nodes, skipped if none answer
+ENGINES = {
+    "trie": lambda args: KVStore(),
+    "radix": lambda args: RadixKVStore(),
+    "dict": lambda args: kv_store.KVStore(use_redis=False),
+    "redis": lambda args: kv_store.KVStore(num_nodes=args.redis_nodes, use_redis=True, base_port=args.redis_port),
+}
+
+# Configure the comparison
+KEY_COUNTS = [100000]
+THREAD_COUNTS = [1]
+KEY_DISTRIBUTIONS = ["sequential"]
+NUM_LOOKUPS = 200000
+NUM_SCANS = 2000
+SCAN_COUNT = 100
+KEY_LENGTH = 32
+BASELINE_DIR = "./benchmarks"
+# Relative change that counts as a regression when comparing against a baseline
+REGRESSION_THRESHOLD = 0.10
+PERCENTILES = {"p50": 0.5, "p99": 0.99, "p999": 0.999}
+# Compression report: codec:level settings tried on each value kind, and values per kind
+COMPRESSION_SETTINGS = ["zlib:1", "zlib:6", "bz2:1", "lzma:0"]
+VALUE_KINDS = ["json", "text", "binary", "random"]
+NUM_VALUES = 2000
+VALUE_SIZE = 1024
+WORDS = ("the quick brown fox jumps over lazy dog store key value cache node ring replica "
+         "shard write read scan index page log error user session token").split()
+
+def make_keys(distribution, count, length, rng):
+    """
+    Build count distinct keys
+
+    Args:
+        distribution (str): "sequential" ("key_0", "key_1", ...), "fixed"
+            (random keys of exactly length chars), "uniform" (random keys of
+            4 to length chars) or "prefixed" (long shared prefixes, like
+            "user:12:session:3:field:7", which share most trie paths)
+        count (int): Number of keys
+        length (int): Key length for "fixed", longest key for "uniform"
+        rng (random.Random): Source of randomness
+    """
+    if distribution == "sequential":
+        return [f"key_{i}" for i in range(count)]
+    if distribution == "prefixed":
+        return [f"user:{i // 100}:session:{i // 10 % 10}:field:{i % 10}" for i in range(count)]
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789"
+    keys = set()
+    while len(keys) < count:
+        size = length if distribution == "fixed" else rng.randint(4, length)
+        keys.add("".join(rng.choices(alphabet, k=size)))
+    return list(keys)
+
+def make_store(engine, args):
+    # The Redis-backed class prints on connection problems; keep the report readable
+    with redirect_stdout(io.StringIO()):
+        store = ENGINES[engine](args)
+    if engine == "redis" and not store.use_redis:
+        return None
+    return store
+
+def clear(store, engine, keys):
+    # Redis nodes outlive the run, so remove what the previous measurement left behind
+    if engine == "redis":
+        for key in keys:
+            store.delete(key)
+
+def measure_memory(engine, keys, args):
+    # Memory: everything allocated while loading the keys, minus the keys and values themselves
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = make_store(engine, args)
+    for key in keys:
+        store.set(key, 1)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(keys)
+
+def run_threads(threads, work):
+    """Run work(thread_index) on each thread from a common start; returns (wall seconds, latencies in ns)"""
+    results = [None] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def runner(index):
+        barrier.wait()
+        results[index] = work(index)
+
+    workers = [threading.Thread(target=runner, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start_time
+    return elapsed, [latency for latencies in results for latency in latencies]
+
+def timed_calls(fn, argument_lists):
+    # Per-call latency; the clock reads add ~100ns to each sample
+    clock = time.perf_counter_ns
+    latencies = []
+    append = latencies.append
+    for args in argument_lists:
+        start = clock()
+        fn(*args)
+        append(clock() - start)
+    return latencies
+
+def summarize(ops, elapsed, latencies):
+    latencies.sort()
+    n = len(latencies)
+    result = {"ops": ops, "ops_per_sec": ops / elapsed if elapsed else 0.0}
+    for name, q in PERCENTILES.items():
+        result[f"{name}_ns"] = latencies[min(int(q * n), n - 1)] if n else None
+    return result
+
+def measure_ops(engine, keys, threads, args, rng):
+    """Time set, get, scan and delete of keys spread over threads against a fresh store"""
+    store = make_store(engine, args)
+    clear(store, engine, keys)
+    slices = [keys[i::threads] for i in range(threads)]
+    per_thread_lookups = max(args.lookups // threads, 1)
+    lookups = [[(rng.choice(keys),) for _ in range(per_thread_lookups)] for _ in range(threads)]
+    results = {}
+
+    elapsed, latencies = run_threads(threads, lambda i: timed_calls(store.set, [(key, 1) for key in slices[i]]))
+    results["set"] = summarize(len(keys), elapsed, latencies)
+
+    elapsed, latencies = run_threads(threads, lambda i: timed_calls(store.get, lookups[i]))
+    results["get"] = summarize(per_thread_lookups * threads, elapsed, latencies)
+
+    # Only the tree engines have ordered, resumable scans
+    if hasattr(store, "scan"):
+        per_thread_scans = max(args.scans // threads, 1)
+        cursors = [[("", rng.choice(keys), SCAN_COUNT) for _ in range(per_thread_scans)] for _ in range(threads)]
+        elapsed, latencies = run_threads(threads, lambda i: timed_calls(store.scan, cursors[i]))
+        results["scan"] = summarize(per_thread_scans * threads, elapsed, latencies)
+
+    elapsed, latencies = run_threads(threads, lambda i: timed_calls(store.delete, [(key,) for key in slices[i]]))
+    results["delete"] = summarize(len(keys), elapsed, latencies)
+    return results
+
+def make_value(kind, size, rng):
+    """
+    One value of roughly size bytes
+
+    Args:
+        kind (str): "json" (a record with repeated field names), "text"
+            (words from a small vocabulary), "binary" (packed small
+            integers) or "random" (incompressible bytes)
+    """
+    if kind == "json":
+        record = {"id": rng.randrange(10 ** 9), "name": " ".join(rng.choices(WORDS, k=3)), "tags": [], "events": []}
+        while len(json.dumps(record)) < size:
+            record["events"].append({"type": rng.choice(WORDS), "ts": 1700000000 + rng.randrange(10 ** 6),
+                                     "ok": rng.random() < 0.9})
+        return record
+    if kind == "text":
+        text = []
+        length = 0
+        while length < size:
+            word = rng.choice(WORDS)
+            text.append(word)
+            length += len(word) + 1
+        return " ".join(text)
+    if kind == "binary":
+        return bytes(rng.randrange(16) if i % 4 else rng.randrange(256) for i in range(size))
+    return rng.randbytes(size)
+
+def encoded_size(value):
+    return len(value) if isinstance(value, bytes) else len(json.dumps(value).encode())
+
+def measure_compression(kind, setting, samples, min_bytes):
+    """Ratio, stored bytes and per-value compress/decompress time of one codec:level on samples"""
+    codec, level = setting.split(":")
+    clock = time.perf_counter_ns
+    start = clock()
+    packed = [values.pack(value, min_bytes, codec, int(level)) for value in samples]
+    compress_ns = clock() - start
+    start = clock()
+    for value in packed:
+        values.unpack(value)
+    decompress_ns = clock() - start
+    original = sum(encoded_size(value) for value in samples)
+    stored = sum(len(value.data) if type(value) is values.Compressed else encoded_size(value) for value in packed)
+    return {"kind": kind, "setting": setting, "values": len(samples), "ratio": original / stored,
+            "bytes_per_value": stored / len(samples), "original_bytes_per_value": original / len(samples),
+            "compressed_share": sum(type(value) is values.Compressed for value in packed) / len(samples),
+            "compress_us": compress_ns / len(samples) / 1000, "decompress_us": decompress_ns / len(samples) / 1000}
+
+def compression_report(args, rng):
+    """
+    Trade-off of each codec:level setting on each value kind: memory saved per
+    value against CPU spent compressing on the write path and decompressing
+    on every read. Values that do not shrink are stored as they are, which
+    compressed_share shows.
+    """
+    results = []
+    print(f"Compression of {args.values} values of ~{args.value_size} bytes, threshold {args.compress_min_bytes} bytes")
+    for kind in args.value_kinds:
+        samples = [make_value(kind, args.value_size, rng) for _ in range(args.values)]
+        for setting in args.codecs:
+            result = measure_compression(kind, setting, samples, args.compress_min_bytes)
+            results.append(result)
+            print(f"{kind:>6} {setting:>7}: ratio {result['ratio']:5.2f}, {result['bytes_per_value']:7.0f} bytes/value "
+                  f"(from {result['original_bytes_per_value']:.0f}, {result['compressed_share'] * 100:3.0f}% compressed), "
+                  f"compress {result['compress_us']:7.1f}us, decompress {result['decompress_us']:6.1f}us")
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def result_key(result):
+    return (result["engine"], result["keys"], result["key_dist"], result["threads"])
+
+def compare(results, baseline, threshold):
+    """Print each metric's change against baseline; returns the number of regressions"""
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = 0
+    print(f"\nAgainst baseline {baseline['revision']} ({baseline['created']}):")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        label = "{} {} keys {} x{}".format(*result_key(result))
+        # (name, old, new, True if higher is better)
+        metrics = [("bytes/key", old["bytes_per_key"], result["bytes_per_key"], False)]
+        for op, stats in result["ops"].items():
+            if op in old["ops"]:
+                metrics.append((f"{op} ops/s", old["ops"][op]["ops_per_sec"], stats["ops_per_sec"], True))
+                # p50 rather than p99: tail latency in-process is mostly GC and scheduler noise
+                metrics.append((f"{op} p50", old["ops"][op]["p50_ns"], stats["p50_ns"], False))
+        for name, before, after, higher_is_better in metrics:
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > threshold else ""
+            regressions += bool(flag)
+            print(f"{label:>32} {name:>13}: {before:12.0f} -> {after:12.0f} ({change * 100:+6.1f}%){flag}")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the store engines in-process: throughput, latency and memory')
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=["trie", "radix"], help='Engines to measure (default: trie radix)')
+    parser.add_argument('--keys', type=int, nargs='+', default=KEY_COUNTS, help=f'Key counts to load (default: {KEY_COUNTS[0]})')
+    parser.add_argument('--key-dist', nargs='+', choices=["sequential", "fixed", "uniform", "prefixed"], default=KEY_DISTRIBUTIONS, help='Key shapes (default: sequential)')
+    parser.add_argument('--key-length', type=int, default=KEY_LENGTH, help=f'Length of fixed keys, longest uniform key (default: {KEY_LENGTH})')
+    parser.add_argument('--threads', type=int, nargs='+', default=THREAD_COUNTS, help='Thread counts (default: 1)')
+    parser.add_argument('--lookups', type=int, default=NUM_LOOKUPS, help=f'Random lookups per run (default: {NUM_LOOKUPS})')
+    parser.add_argument('--scans', type=int, default=NUM_SCANS, help=f'Scans of {SCAN_COUNT} keys per run (default: {NUM_SCANS})')
+    parser.add_argument('--redis-nodes', type=int, default=1, help='Redis nodes for the redis engine (default: 1)')
+    parser.add_argument('--redis-port', type=int, default=6379, help='Port of the first Redis node (default: 6379)')
+    parser.add_argument('--save', nargs='?', const='', help=f'Save results as a baseline, by default to {BASELINE_DIR}/engine-<git revision>.json')
+    parser.add_argument('--baseline', help='Compare against a saved baseline; exits 1 on any regression')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help=f'Relative change counted as a regression (default: {REGRESSION_THRESHOLD})')
+    parser.add_argument('--compression', action='store_true', help='Report value compression ratios and CPU cost instead of measuring the engines')
+    parser.add_argument('--codecs', nargs='+', default=COMPRESSION_SETTINGS, help=f'codec:level settings to compare (default: {" ".join(COMPRESSION_SETTINGS)})')
+    parser.add_argument('--value-kinds', nargs='+', choices=VALUE_KINDS, default=VALUE_KINDS, help='Value shapes to compress (default: all)')
+    parser.add_argument('--values', type=int, default=NUM_VALUES, help=f'Values per kind (default: {NUM_VALUES})')
+    parser.add_argument('--value-size', type=int, default=VALUE_SIZE, help=f'Approximate value size in bytes (default: {VALUE_SIZE})')
+    parser.add_argument('--compress-min-bytes', type=int, default=values.COMPRESS_MIN_BYTES or 64, help='Compression threshold (default: KV_COMPRESS_MIN_BYTES, else 64)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    results = []
+    compression = []
+    for distribution in ([] if args.compression else args.key_dist):
+        for count in args.keys:
+            keys = make_keys(distribution, count, args.key_length, rng)
+            print(f"{count} {distribution} keys, {args.lookups} lookups, {args.scans} scans")
+            for engine in args.engines:
+                if make_store(engine, args) is None:
+                    print(f"{engine:>6}: skipped, no Redis node answered on port {args.redis_port}")
+                    continue
+                bytes_per_key = measure_memory(engine, keys, args) if engine != "redis" else None
+                for threads in args.threads:
+                    ops = measure_ops(engine, keys, threads, args, random.Random(args.seed))
+                    results.append({"engine": engine, "keys": count, "key_dist": distribution,
+                                    "threads": threads, "bytes_per_key": bytes_per_key, "ops": ops})
+                    memory = f"{bytes_per_key:.0f} bytes/key" if bytes_per_key is not None else "memory n/a"
+                    print(f"{engine:>6} x{threads}: {memory}, " + ", ".join(
+                        f"{op} {stats['ops_per_sec']:.0f} ops/s p50 {stats['p50_ns']}ns p99 {stats['p99_ns']}ns"
+                        for op, stats in ops.items()))
+    if args.compression:
+        compression = compression_report(args, rng)
+
+    report = {"revision": git_revision(), "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": sys.version.split()[0], "results": results, "compression": compression}
+    if args.save is not None:
+        path = args.save or os.path.join(BASELINE_DIR, f"engine-{report['revision']}.json")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {path}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,850 @@
+# kv_client.py
+# Client library for the HTTP API: routes keys over the ketama ring, pipelines requests over pooled keep-alive connections
+import asyncio
+import base64
+import json
+import select
+import selectors
+import socket
+from collections import deque
+from urllib.parse import urlsplit, quote
+from uhashring import HashRing
+
+# Most keys sent in one /_mget, /_mset or /_mdel request; the nodes' KV_MAX_BATCH default
+MAX_BATCH = 1000
+# Requests sent on one connection ahead of their responses
+MAX_PIPELINE = 256
+# Bytes read from a socket at once
+RECV_SIZE = 65536
+
+
+class KVClientError(Exception):
+    """Raised when a node answers with an error, or cannot be reached (status None)"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RequestNotSent(ConnectionResetError):
+    """The connection closed before the request was written, so it can be resent whatever it does"""
+
+
+def encode_request(method, path, host, payload=None):
+    """One HTTP/1.1 request, with payload sent as a JSON body"""
+    # Asking for JSON makes the nodes wrap bytes values as {"$base64": ...} instead of sending them raw
+    if payload is None:
+        return f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n\r\n".encode()
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    return (f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nAccept: application/json\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body
+
+
+def parse_head(head):
+    """
+    Parse a response's status line and headers
+
+    Returns:
+        tuple: (status, body length, True if the connection stays open)
+
+    Raises:
+        ValueError: If the response is malformed or has no Content-Length
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    length = None
+    keep_alive = True
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection" and value.strip().lower() == "close":
+            keep_alive = False
+    if length is None:
+        # Both apps always send a length; reading to EOF would rule out pipelining
+        raise ValueError(f"response without Content-Length: {lines[0]}")
+    return status, length, keep_alive
+
+
+def key_path(key):
+    return "/" + quote(key, safe="")
+
+
+# Conditions and in-place updates in a POST body; a request carrying one must not reach a node twice
+UNREPEATABLE = ("incr", "append", "nx", "if_version", "if_value")
+
+
+def replayable(method, payload):
+    """Whether a request may be resent after its connection broke: gets, deletes and plain sets end the same either way"""
+    return method != "POST" or payload is None or not any(name in payload for name in UNREPEATABLE)
+
+
+def error_for(status, body):
+    try:
+        message = json.loads(body).get("error", "")
+    except (ValueError, AttributeError):
+        message = body[:200].decode("utf-8", "replace")
+    return KVClientError(f"HTTP {status}: {message}", status)
+
+
+# bytes values travel as {"$base64": ...} inside JSON bodies, as the nodes send them
+def encode_value(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$base64": base64.b64encode(value).decode()}
+    return value
+
+
+def decode_value(value):
+    if type(value) is dict and len(value) == 1 and "$base64" in value:
+        return base64.b64decode(value["$base64"])
+    return value
+
+
+# Turn a (status, body) response into a result, per operation
+def get_result(status, body):
+    if status == 200:
+        return decode_value(json.loads(body)["value"])
+    if status == 404:
+        return None
+    raise error_for(status, body)
+
+
+def versioned_result(status, body):
+    if status == 200:
+        data = json.loads(body)
+        return decode_value(data["value"]), data["version"]
+    if status == 404:
+        return None, 0
+    raise error_for(status, body)
+
+
+def set_result(status, body):
+    # 412: a conditional set whose condition did not hold
+    if status in (200, 412):
+        return status == 200
+    raise error_for(status, body)
+
+
+def incr_result(status, body):
+    if status == 200:
+        return json.loads(body)["value"]
+    raise error_for(status, body)
+
+
+def append_result(status, body):
+    if status == 200:
+        return json.loads(body)["length"]
+    raise error_for(status, body)
+
+
+def delete_result(status, body):
+    if status in (200, 404):
+        return status == 200
+    raise error_for(status, body)
+
+
+def batch_results(status, body):
+    """Per-key results of a batch request, or None if the node has no batch endpoints"""
+    if status == 200:
+        return json.loads(body)["results"]
+    # Only a missing route means the node cannot batch; a 400 is a bad batch (a value, or over KV_MAX_BATCH)
+    if status in (404, 405):
+        return None
+    raise error_for(status, body)
+
+
+def set_payload(value, ex=None, px=None, nx=False, if_version=None):
+    payload = {"value": encode_value(value)}
+    if ex is not None:
+        payload["ex"] = ex
+    if px is not None:
+        payload["px"] = px
+    if nx:
+        payload["nx"] = True
+    if if_version is not None:
+        payload["if_version"] = if_version
+    return payload
+
+
+def hot_keys_path(op, count, by):
+    return f"/_hotkeys?op={quote(op)}&count={count}&by={quote(by)}"
+
+
+def merge_hot_keys(nodes, responses, op, count, by):
+    """Every node's hottest keys for op, heaviest first, each tagged with its node"""
+    hot = []
+    for node, (status, body) in zip(nodes, responses):
+        # Nodes that cannot report (older versions, or the asgi app over Redis) are skipped
+        if status != 200:
+            continue
+        for entry in json.loads(body)["ops"][op]["top"]:
+            hot.append({**entry, "node": node.url})
+    hot.sort(key=lambda entry: entry[by], reverse=True)
+    return hot[:count]
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class BaseClient:
+    def __init__(self, nodes):
+        """
+        Routing shared by both clients
+
+        Node names on the ring are the nodes' base URLs, as in benchmark.py
+        and the routing proxy, so every client agrees on which node owns a key.
+
+        Args:
+            nodes (list): Base URLs of the nodes, e.g. ["http://127.0.0.1:8080"]
+        """
+        self.ring = HashRing(list(nodes), hash_fn="ketama")
+        self.nodes = {url: self._make_node(url) for url in nodes}
+
+    def _make_node(self, url):
+        raise NotImplementedError
+
+    def node_for(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def _group(self, keys):
+        """Positions of keys, grouped by the node that owns each"""
+        by_node = {}
+        for index, key in enumerate(keys):
+            by_node.setdefault(self.node_for(key), []).append(index)
+        return by_node
+
+    def pipeline(self):
+        """Collect get/set/incr/delete calls and send them together with execute()"""
+        return Pipeline(self)
+
+
+class Pipeline:
+    """Calls queued for one round trip per node; execute() returns their results in call order"""
+
+    def __init__(self, client):
+        self.client = client
+        self.ops = []
+
+    def get(self, key):
+        self.ops.append(("GET", key, None, get_result))
+        return self
+
+    def set(self, key, value, ex=None, px=None, nx=False, if_version=None):
+        self.ops.append(("POST", key, set_payload(value, ex, px, nx, if_version), set_result))
+        return self
+
+    def incr(self, key, by=1):
+        self.ops.append(("POST", key, {"incr": by}, incr_result))
+        return self
+
+    def delete(self, key):
+        self.ops.append(("DELETE", key, None, delete_result))
+        return self
+
+    def execute(self):
+        """Send the queued calls; a coroutine on AsyncKVClient"""
+        ops, self.ops = self.ops, []
+        return self.client._execute(ops)
+
+
+class Node:
+    """A node's idle keep-alive sockets, reused most recently used first"""
+
+    def __init__(self, url, pool_size, timeout):
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.authority = f"{self.host}:{self.port}"
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = deque()
+        self.batching = True  # Cleared once the node turns out to lack /_mget and friends
+
+    def checkout(self):
+        """A connected non-blocking socket, and whether it was reused from the pool"""
+        while self.idle:
+            sock = self.idle.pop()
+            # Anything readable on an idle socket is the node closing it, e.g. after its keep-alive timeout
+            if not select.select([sock], [], [], 0)[0]:
+                return sock, True
+            sock.close()
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise KVClientError(f"{self.url}: {e!r}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        return sock, False
+
+    def checkin(self, sock):
+        if len(self.idle) < self.pool_size:
+            self.idle.append(sock)
+        else:
+            sock.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+
+class Flow:
+    """Requests to one node being pipelined over one socket by KVClient._exchange"""
+
+    def __init__(self, node, indexes, requests, max_pipeline):
+        self.node = node
+        self.indexes = indexes
+        self.requests = requests
+        self.max_pipeline = max_pipeline
+        self.sock, self.reused = node.checkout()
+        self.sent = 0      # Requests written, at least partly
+        self.answered = 0  # Responses read
+        self.out = memoryview(b"")
+        self.buffer = bytearray()
+        self.closing = False  # The node announced it closes the connection after its last response
+
+    def wants_write(self):
+        return bool(self.out) or (self.sent < len(self.indexes) and self.sent - self.answered < self.max_pipeline)
+
+    def send(self):
+        if not self.out:
+            # Fill the window in one write, so a node sees the whole burst in one read
+            end = min(len(self.indexes), self.answered + self.max_pipeline)
+            self.out = memoryview(b"".join(self.requests[i][1] for i in self.indexes[self.sent:end]))
+            self.sent = end
+        written = self.sock.send(self.out)
+        self.out = self.out[written:]
+
+    def receive(self, responses):
+        """Read what arrived; returns False once the node closed the connection"""
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            return False
+        self.buffer += data
+        position = 0
+        while self.answered < self.sent:
+            end = self.buffer.find(b"\r\n\r\n", position)
+            if end < 0:
+                break
+            status, length, keep_alive = parse_head(bytes(self.buffer[position:end]))
+            if len(self.buffer) < end + 4 + length:
+                break
+            responses[self.indexes[self.answered]] = (status, bytes(self.buffer[end + 4:end + 4 + length]))
+            self.answered += 1
+            position = end + 4 + length
+            if not keep_alive:
+                self.closing = True
+                break
+        del self.buffer[:position]
+        return True
+
+    def done(self):
+        return self.answered == len(self.indexes)
+
+    def restart(self):
+        """
+        Resend what is still unanswered over a new socket
+
+        Raises:
+            KVClientError: If a request that is not replayable was sent and not answered,
+                since the node may already have applied it
+        """
+        if not all(self.requests[i][2] for i in self.indexes[self.answered:self.sent]):
+            raise KVClientError(f"{self.node.url}: connection closed with an incr, append or conditional set "
+                                f"in flight; it may have been applied")
+        self.sock.close()
+        self.indexes = self.indexes[self.answered:]
+        self.sock, self.reused = self.node.checkout()
+        self.sent = self.answered = 0
+        self.out = memoryview(b"")
+        self.buffer = bytearray()
+        self.closing = False
+
+
+class KVClient(BaseClient):
+    def __init__(self, nodes, pool_size=8, max_pipeline=MAX_PIPELINE, timeout=2.0):
+        """
+        Blocking client for one or more nodes
+
+        Each call that touches several keys groups them by owning node and
+        pipelines each group over one pooled connection, with every node's
+        connection driven at once by a selector, so a call costs about one
+        round trip to the slowest node. Safe to share between threads: each
+        call checks its sockets out of the pools.
+
+        A connection that breaks mid-pipeline is replaced and the unanswered
+        requests are resent, once per connection that made progress, so a set
+        or delete can reach a node twice. An incr, append or conditional set
+        that was sent but not answered is not resent; the call raises
+        KVClientError, as the node may or may not have applied it.
+
+        Args:
+            nodes (list): Base URLs of the nodes
+            pool_size (int): Idle keep-alive connections kept per node
+            max_pipeline (int): Requests written to a connection ahead of their responses
+            timeout (float): Seconds a call may go without progress
+        """
+        self.pool_size = pool_size
+        self.max_pipeline = max_pipeline
+        self.timeout = timeout
+        super().__init__(nodes)
+
+    def _make_node(self, url):
+        return Node(url, self.pool_size, self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for node in self.nodes.values():
+            node.close()
+
+    def get(self, key):
+        return self._execute([("GET", key, None, get_result)])[0]
+
+    def get_versioned(self, key):
+        """(value, version) of key, or (None, 0) if it does not exist"""
+        return self._execute([("GET", key, None, versioned_result)])[0]
+
+    def set(self, key, value, ex=None, px=None, nx=False, if_version=None):
+        """
+        Set key to a JSON-serializable value or bytes, optionally expiring in ex seconds or px milliseconds
+
+        With nx (only if the key does not exist) or if_version (only if the
+        key is still at that version, 0 for absent), returns False when the
+        condition did not hold.
+        """
+        payload = set_payload(value, ex, px, nx, if_version)
+        return self._execute([("POST", key, payload, set_result)])[0]
+
+    def incr(self, key, by=1):
+        """Atomically add by to a number, an absent key counting as 0; returns the new number"""
+        return self._execute([("POST", key, {"incr": by}, incr_result)])[0]
+
+    def append(self, key, item):
+        """Atomically append to a string, bytes or list value; returns the new length"""
+        return self._execute([("POST", key, {"append": encode_value(item)}, append_result)])[0]
+
+    def delete(self, key):
+        """Delete key; returns False if it did not exist"""
+        return self._execute([("DELETE", key, None, delete_result)])[0]
+
+    def hot_keys(self, op="get", count=10, by="requests"):
+        """
+        The hottest keys across all nodes, from each node's /_hotkeys sketches
+
+        Returns:
+            list: [{"key", "node", "requests", "bytes", "share", "error"}, ...], heaviest first;
+                share is the key's part of its own node's traffic for op
+        """
+        nodes = list(self.nodes.values())
+        responses = self._exchange([(node, encode_request("GET", hot_keys_path(op, count, by), node.authority), True)
+                                    for node in nodes])
+        return merge_hot_keys(nodes, responses, op, count, by)
+
+    def mget(self, keys):
+        """Values of keys, in order, with None for missing keys"""
+        keys = list(keys)
+        return self._multi("/_mget", keys, keys, ("GET", None, get_result),
+                           lambda item: decode_value(item.get("value")) if item["status"] == 200 else None)
+
+    def mset(self, items, ex=None, px=None):
+        """Set every key of the items dict to its value"""
+        keys = list(items)
+        ops = [{"key": key, **set_payload(items[key], ex, px)} for key in keys]
+        self._multi("/_mset", keys, ops, ("POST", "value", set_result), lambda item: True)
+
+    def mdel(self, keys):
+        """Delete keys; returns the number that existed"""
+        keys = list(keys)
+        return sum(self._multi("/_mdel", keys, keys, ("DELETE", None, delete_result),
+                               lambda item: item["status"] == 200))
+
+    def _multi(self, path, keys, ops, single, to_result):
+        """
+        Run a multi-key call as one batch request per node and MAX_BATCH keys
+
+        Nodes without batch endpoints get one pipelined request per key.
+        single is (method, field of the op sent as the body, result function).
+        """
+        results = [None] * len(keys)
+        batches = []
+        fallback = []
+        for node, indexes in self._group(keys).items():
+            if node.batching:
+                batches.extend((node, chunk) for chunk in chunks(indexes, MAX_BATCH))
+            else:
+                fallback.extend(indexes)
+
+        # Batches hold plain gets, sets or deletes, so they are replayable
+        responses = self._exchange([(node, encode_request("POST", path, node.authority, [ops[i] for i in chunk]), True)
+                                    for node, chunk in batches])
+        for (node, chunk), (status, body) in zip(batches, responses):
+            items = batch_results(status, body)
+            if items is None:
+                node.batching = False
+                fallback.extend(chunk)
+                continue
+            for index, item in zip(chunk, items):
+                results[index] = to_result(item)
+
+        if fallback:
+            method, field, result = single
+            singles = self._execute([(method, keys[i], set_payload(ops[i][field], ops[i].get("ex"), ops[i].get("px"))
+                                      if field else None, result) for i in fallback])
+            for index, value in zip(fallback, singles):
+                results[index] = value
+        return results
+
+    def _execute(self, ops):
+        """Run (method, key, payload, result function) ops; returns their results in order"""
+        requests = []
+        for method, key, payload, _ in ops:
+            node = self.node_for(key)
+            requests.append((node, encode_request(method, key_path(key), node.authority, payload),
+                             replayable(method, payload)))
+        responses = self._exchange(requests)
+        return [result(status, body) for (_, _, _, result), (status, body) in zip(ops, responses)]
+
+    def _exchange(self, requests):
+        """
+        Send (node, encoded request, replayable) triples, pipelined per node
+
+        Returns:
+            list: (status, body) per request, in order
+
+        Raises:
+            KVClientError: If a node cannot be reached or stalls for timeout seconds,
+                or a connection broke while a request that is not replayable was in flight
+        """
+        responses = [None] * len(requests)
+        by_node = {}
+        for index, (node, _, _) in enumerate(requests):
+            by_node.setdefault(node, []).append(index)
+
+        selector = selectors.DefaultSelector()
+        flows = []
+        try:
+            for node, indexes in by_node.items():
+                flow = Flow(node, indexes, requests, self.max_pipeline)
+                flows.append(flow)
+                selector.register(flow.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, flow)
+            active = len(flows)
+            while active:
+                events = selector.select(self.timeout)
+                if not events:
+                    raise KVClientError(f"no response within {self.timeout}s")
+                for key, mask in events:
+                    flow = key.data
+                    try:
+                        if mask & selectors.EVENT_WRITE and flow.wants_write():
+                            flow.send()
+                        alive = not mask & selectors.EVENT_READ or flow.receive(responses)
+                    except OSError:
+                        alive = False
+                    if flow.done():
+                        selector.unregister(flow.sock)
+                        if flow.closing or not alive:
+                            flow.sock.close()
+                        else:
+                            flow.node.checkin(flow.sock)
+                        flow.sock = None
+                        active -= 1
+                        continue
+                    if not alive or flow.closing:
+                        # A fresh connection that dies without answering anything is the node failing, not a stale socket
+                        if not flow.answered and not flow.reused and not flow.closing:
+                            raise KVClientError(f"{flow.node.url}: connection closed")
+                        selector.unregister(flow.sock)
+                        flow.restart()
+                        selector.register(flow.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, flow)
+                        continue
+                    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if flow.wants_write() else 0)
+                    if key.events != events:
+                        selector.modify(flow.sock, events, flow)
+        except ValueError as e:
+            raise KVClientError(f"malformed response: {e}")
+        finally:
+            # Sockets still checked out are mid-exchange, so their state is unknown
+            for flow in flows:
+                if flow.sock is not None:
+                    flow.sock.close()
+            selector.close()
+        return responses
+
+
+class AsyncConnection:
+    """One keep-alive connection; responses arrive in request order and resolve pending futures"""
+
+    def __init__(self, node, reader, writer):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()
+        self.out = []
+        self.closed = False
+        self.task = asyncio.get_running_loop().create_task(self._read_responses())
+
+    def send(self, data):
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_exception(RequestNotSent("connection closed"))
+            return future
+        self.pending.append(future)
+        # Cork: everything sent during one loop iteration goes out in a single write
+        if not self.out:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self.out.append(data)
+        return future
+
+    def _flush(self):
+        if not self.closed:
+            self.writer.write(b"".join(self.out))
+        self.out.clear()
+
+    async def _read_responses(self):
+        error = ConnectionResetError("connection closed")
+        try:
+            while True:
+                head = await self.reader.readuntil(b"\r\n\r\n")
+                status, length, keep_alive = parse_head(head[:-4])
+                body = await self.reader.readexactly(length)
+                future = self.pending.popleft()
+                # A caller that timed out already had its future failed; its response is simply dropped
+                if not future.done():
+                    future.set_result((status, body))
+                if not keep_alive:
+                    break
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError) as e:
+            error = e
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self.node.discard(self)
+        # The newest requests may still be waiting for _flush, so the node never saw them
+        unsent = len(self.pending) - len(self.out)
+        self.out.clear()
+        for position, future in enumerate(self.pending):
+            if not future.done():
+                future.set_exception((RequestNotSent if position >= unsent else ConnectionResetError)(repr(error)))
+        self.pending.clear()
+
+
+class AsyncNode:
+    """A node's keep-alive connections; each request goes to the one with the fewest outstanding"""
+
+    def __init__(self, url, connections, max_pipeline):
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.authority = f"{self.host}:{self.port}"
+        self.size = connections
+        self.connections = []
+        self.opening = None  # Task opening the next connection
+        self.slots = None  # Created inside the running loop
+        self.max_in_flight = connections * max_pipeline
+        self.batching = True
+
+    async def connection(self):
+        best = min(self.connections, key=lambda c: len(c.pending), default=None)
+        if best is not None and (not best.pending or len(self.connections) >= self.size):
+            return best
+        # Connections open one at a time; callers arriving meanwhile share the one being opened
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self._open())
+        return await asyncio.shield(self.opening)
+
+    async def _open(self):
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            raise KVClientError(f"{self.url}: {e!r}")
+        finally:
+            self.opening = None
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = AsyncConnection(self, reader, writer)
+        self.connections.append(connection)
+        return connection
+
+    def discard(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+
+    def close(self):
+        for connection in list(self.connections):
+            connection.close()
+
+
+class AsyncKVClient(BaseClient):
+    def __init__(self, nodes, connections=4, max_pipeline=MAX_PIPELINE, timeout=2.0):
+        """
+        asyncio client for one or more nodes
+
+        Concurrent calls share a few connections per node: each request is
+        written to the connection with the fewest outstanding requests, and
+        the requests issued during one event loop iteration go out in a single
+        write, so thousands of in-flight calls cost a handful of syscalls per
+        iteration. Up to connections * max_pipeline requests are outstanding
+        per node; further calls wait for a slot.
+
+        A request whose connection breaks after it was sent is retried once on
+        another connection, so a set or delete can reach a node twice. An
+        incr, append or conditional set is only retried if it was never
+        written; otherwise the call raises KVClientError, as the node may or
+        may not have applied it.
+
+        Args:
+            nodes (list): Base URLs of the nodes
+            connections (int): Keep-alive connections per node
+            max_pipeline (int): Outstanding requests per connection
+            timeout (float): Seconds a call may take, including waiting for a slot
+        """
+        self.connections = connections
+        self.max_pipeline = max_pipeline
+        self.timeout = timeout
+        super().__init__(nodes)
+
+    def _make_node(self, url):
+        return AsyncNode(url, self.connections, self.max_pipeline)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        for node in self.nodes.values():
+            node.close()
+
+    async def get(self, key):
+        node = self.node_for(key)
+        return get_result(*await self._request(node, encode_request("GET", key_path(key), node.authority)))
+
+    async def get_versioned(self, key):
+        """(value, version) of key, or (None, 0) if it does not exist"""
+        return await self._run_op("GET", key, None, versioned_result)
+
+    async def set(self, key, value, ex=None, px=None, nx=False, if_version=None):
+        """Set key, as KVClient.set"""
+        node = self.node_for(key)
+        payload = set_payload(value, ex, px, nx, if_version)
+        data = encode_request("POST", key_path(key), node.authority, payload)
+        return set_result(*await self._request(node, data, replayable("POST", payload)))
+
+    async def incr(self, key, by=1):
+        """Atomically add by to a number, an absent key counting as 0; returns the new number"""
+        return await self._run_op("POST", key, {"incr": by}, incr_result)
+
+    async def append(self, key, item):
+        """Atomically append to a string, bytes or list value; returns the new length"""
+        return await self._run_op("POST", key, {"append": encode_value(item)}, append_result)
+
+    async def delete(self, key):
+        """Delete key; returns False if it did not exist"""
+        node = self.node_for(key)
+        return delete_result(*await self._request(node, encode_request("DELETE", key_path(key), node.authority)))
+
+    async def hot_keys(self, op="get", count=10, by="requests"):
+        """The hottest keys across all nodes, as KVClient.hot_keys"""
+        nodes = list(self.nodes.values())
+        responses = await asyncio.gather(*(
+            self._request(node, encode_request("GET", hot_keys_path(op, count, by), node.authority)) for node in nodes))
+        return merge_hot_keys(nodes, responses, op, count, by)
+
+    async def mget(self, keys):
+        """Values of keys, in order, with None for missing keys"""
+        keys = list(keys)
+        return await self._multi("/_mget", keys, keys, self.get,
+                                 lambda item: decode_value(item.get("value")) if item["status"] == 200 else None)
+
+    async def mset(self, items, ex=None, px=None):
+        """Set every key of the items dict to its value"""
+        keys = list(items)
+        ops = [{"key": key, **set_payload(items[key], ex, px)} for key in keys]
+        await self._multi("/_mset", keys, ops, lambda key: self.set(key, items[key], ex, px), lambda item: True)
+
+    async def mdel(self, keys):
+        """Delete keys; returns the number that existed"""
+        keys = list(keys)
+        return sum(await self._multi("/_mdel", keys, keys, self.delete, lambda item: item["status"] == 200))
+
+    async def _multi(self, path, keys, ops, single, to_result):
+        # As KVClient._multi, with every node's batches in flight at once
+        results = [None] * len(keys)
+
+        async def run_chunk(node, chunk):
+            if node.batching:
+                data = encode_request("POST", path, node.authority, [ops[i] for i in chunk])
+                items = batch_results(*await self._request(node, data))
+                if items is not None:
+                    for index, item in zip(chunk, items):
+                        results[index] = to_result(item)
+                    return
+                node.batching = False
+            values = await asyncio.gather(*(single(keys[i]) for i in chunk))
+            for index, value in zip(chunk, values):
+                results[index] = value
+
+        await asyncio.gather(*(run_chunk(node, chunk) for node, indexes in self._group(keys).items()
+                               for chunk in chunks(indexes, MAX_BATCH)))
+        return results
+
+    async def _execute(self, ops):
+        return await asyncio.gather(*(self._run_op(*op) for op in ops))
+
+    async def _run_op(self, method, key, payload, result):
+        node = self.node_for(key)
+        data = encode_request(method, key_path(key), node.authority, payload)
+        return result(*await self._request(node, data, replayable(method, payload)))
+
+    async def _request(self, node, data, retry=True):
+        # One timer per request instead of wait_for, which would wrap every call in a task
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        if node.slots is None:
+            node.slots = asyncio.Semaphore(node.max_in_flight)
+        if node.slots.locked():
+            try:
+                await asyncio.wait_for(node.slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise KVClientError(f"{node.url}: no free connection within {self.timeout}s")
+        else:
+            await node.slots.acquire()
+        try:
+            for attempt in range(2):
+                connection = await node.connection()
+                future = connection.send(data)
+                timer = loop.call_at(deadline, self._expire, future, node)
+                try:
+                    return await future
+                except RequestNotSent as e:
+                    if attempt:
+                        raise KVClientError(f"{node.url}: {e}")
+                except ConnectionResetError as e:
+                    if not retry:
+                        raise KVClientError(f"{node.url}: {e} with an incr, append or conditional set in flight; "
+                                            f"it may have been applied")
+                    # Most likely an idle connection the node closed as the request went out
+                    if attempt:
+                        raise KVClientError(f"{node.url}: {e}")
+                finally:
+                    timer.cancel()
+        finally:
+            node.slots.release()
+
+    def _expire(self, future, node):
+        # The response may still arrive; the connection then drops it, as the future is done
+        if not future.done():
+            future.set_exception(KVClientError(f"{node.url}: no response within {self.timeout}s"))
@@ -1,12 +1,632 @@
 # kv_store.py
+import asyncio
+import fnmatch
 import threading
+import time
+from collections import deque, OrderedDict
 import redis
+import redis.asyncio
 import os
 from uhashring import HashRing
 
+# Keys read per SCAN page when moving keys after a ring change
+MIGRATION_BATCH = 500
+# Connections per Redis node, shared by every thread; callers wait up to POOL_TIMEOUT seconds for one
+POOL_SIZE = int(os.getenv("KV_REDIS_POOL_SIZE", "32"))
+POOL_TIMEOUT = float(os.getenv("KV_REDIS_POOL_TIMEOUT", "2.0"))
+# Automatic pipelining of concurrent single-key commands: on/off, most commands per pipeline,
+# and pipelines in flight per node before further commands queue up for the next one
+AUTO_PIPELINE = os.getenv("KV_REDIS_AUTOPIPELINE", "on") != "off"
+PIPELINE_MAX = int(os.getenv("KV_REDIS_PIPELINE_MAX", "256"))
+PIPELINES_IN_FLIGHT = int(os.getenv("KV_REDIS_PIPELINES", "4"))
+# Keys per MGET/MSET/DEL command in the multi-key operations, and per SCAN page in keys()
+MULTI_BATCH = 500
+SCAN_COUNT = 1000
+# Near cache in front of Redis: most entries (0 disables it), seconds an entry may be served, eviction policy
+NEAR_CACHE_SIZE = int(os.getenv("KV_NEAR_CACHE_SIZE", "0"))
+NEAR_CACHE_TTL = float(os.getenv("KV_NEAR_CACHE_TTL", "5.0"))
+NEAR_CACHE_POLICY = os.getenv("KV_NEAR_CACHE_POLICY", "lru")
+# Oldest entries compared by the lfu policy when evicting
+NEAR_CACHE_SAMPLES = 5
+# Seconds between pings on an idle invalidation link, and the longest wait before reconnecting one
+INVALIDATION_PING = 1.0
+RECONNECT_MAX = 2.0
+# Single-flight reads: most keys with a read in flight (0 disables coalescing),
+# and seconds a read may be joined and waited for
+SINGLE_FLIGHT_MAX = int(os.getenv("KV_SINGLE_FLIGHT_MAX", "1024"))
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("KV_SINGLE_FLIGHT_TIMEOUT", str(POOL_TIMEOUT)))
+
+
+def node_configs(num_nodes, base_port):
+    """Build the host/port of each Redis node, following Docker service names when DOCKER_ENV is set"""
+    nodes = []
+    redis_host = os.getenv("REDIS_HOST", "localhost")
+    
+    # In Docker, we need to handle multiple Redis services
+    if os.getenv("DOCKER_ENV"):
+        # Expect Redis services to be named redis-1, redis-2, etc.
+        for i in range(num_nodes):
+            nodes.append({
+                "host": f"redis-{i+1}",  # Docker service name
+                "port": base_port  # Each service runs on the same port
+            })
+    else:
+        # Local development - use different ports on localhost
+        for i in range(num_nodes):
+            nodes.append({
+                "host": redis_host,
+                "port": base_port + i
+            })
+    return nodes
+
+
+def make_client(host, port):
+    """A client over a bounded pool of keep-alive connections to one Redis node"""
+    pool = redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        decode_responses=True,
+        max_connections=POOL_SIZE,
+        timeout=POOL_TIMEOUT,
+        socket_connect_timeout=2.0,
+        socket_keepalive=True,
+        health_check_interval=30,  # PING a connection idle this long before reusing it
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def make_async_client(host, port):
+    """asyncio counterpart of make_client"""
+    pool = redis.asyncio.BlockingConnectionPool(
+        host=host,
+        port=port,
+        decode_responses=True,
+        max_connections=POOL_SIZE,
+        timeout=POOL_TIMEOUT,
+        socket_connect_timeout=2.0,
+        socket_keepalive=True,
+        health_check_interval=30,
+    )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class PendingCommand:
+    __slots__ = ("method", "args", "kwargs", "result", "error", "done", "event")
+
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = False
+        self.event = threading.Event()
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class AutoPipeline:
+    def __init__(self, client, max_batch=PIPELINE_MAX, max_in_flight=PIPELINES_IN_FLIGHT):
+        """
+        Coalesce single-key commands from concurrent threads into pipelines
+
+        Up to max_in_flight threads send their command straight away. A
+        command arriving while they are all busy queues up instead. Each
+        sender, when its round trip returns, hands its slot to the oldest
+        queued command, whose thread sends everything queued behind it in
+        one pipeline. Without contention a command is sent on its own, so
+        this costs no latency; under load one round trip carries up to
+        max_batch commands.
+
+        Args:
+            client (redis.Redis): Client of the node
+            max_batch (int): Most commands per pipeline
+            max_in_flight (int): Pipelines in flight at once
+        """
+        self.client = client
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.in_flight = 0
+
+    def execute(self, method, *args, **kwargs):
+        """Run client.<method>(*args, **kwargs), possibly in a pipeline with other threads' commands"""
+        with self.lock:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                lead = True
+            else:
+                command = PendingCommand(method, args, kwargs)
+                self.queue.append(command)
+                lead = False
+
+        if lead:
+            try:
+                return getattr(self.client, method)(*args, **kwargs)
+            finally:
+                self._hand_off()
+
+        command.event.wait()
+        if command.done:
+            return command.outcome()
+        # Promoted: the command left the queue with a slot, and leads the next pipeline
+        with self.lock:
+            batch = [command] + [self.queue.popleft() for _ in range(min(len(self.queue), self.max_batch - 1))]
+        try:
+            self._send(batch)
+        finally:
+            self._hand_off()
+        return command.outcome()
+
+    def _send(self, batch):
+        pipe = self.client.pipeline(transaction=False)
+        for command in batch:
+            getattr(pipe, command.method)(*command.args, **command.kwargs)
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except redis.exceptions.RedisError as e:
+            results = [e] * len(batch)
+        for command, result in zip(batch, results):
+            if isinstance(result, Exception):
+                command.error = result
+            else:
+                command.result = result
+            command.done = True
+            command.event.set()
+
+    def _hand_off(self):
+        with self.lock:
+            if self.queue:
+                # The slot passes to the oldest waiter, which is not done, since only a slot holder sends
+                self.queue.popleft().event.set()
+            else:
+                self.in_flight -= 1
+
+
+class AsyncAutoPipeline:
+    def __init__(self, client, max_batch=PIPELINE_MAX):
+        """
+        Coalesce the commands issued during one event loop iteration into pipelines
+
+        Args:
+            client (redis.asyncio.Redis): Client of the node
+            max_batch (int): Most commands per pipeline
+        """
+        self.client = client
+        self.max_batch = max_batch
+        self.queue = []
+        self.tasks = set()
+
+    def execute(self, method, *args, **kwargs):
+        """Awaitable result of client.<method>(*args, **kwargs), sent with this iteration's other commands"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self.queue:
+            loop.call_soon(self._flush)
+        self.queue.append((method, args, kwargs, future))
+        return future
+
+    def _flush(self):
+        batch, self.queue = self.queue, []
+        for chunk in chunked(batch, self.max_batch):
+            # Held until done, since the loop only keeps weak references to tasks
+            task = asyncio.ensure_future(self._send(chunk))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch):
+        if len(batch) == 1:
+            method, args, kwargs, future = batch[0]
+            try:
+                results = [await getattr(self.client, method)(*args, **kwargs)]
+            except redis.exceptions.RedisError as e:
+                results = [e]
+        else:
+            pipe = self.client.pipeline(transaction=False)
+            for method, args, kwargs, _ in batch:
+                getattr(pipe, method)(*args, **kwargs)
+            try:
+                results = await pipe.execute(raise_on_error=False)
+            except redis.exceptions.RedisError as e:
+                results = [e] * len(batch)
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+# Returned by NearCache.get for keys it does not hold, since None is a valid cached result
+MISS = object()
+
+
+class NearCache:
+    def __init__(self, max_entries=10000, ttl=NEAR_CACHE_TTL, policy="lru"):
+        """
+        Bounded in-process cache of values read from Redis
+
+        Entries are dropped when an Invalidator reports their key changed,
+        when this process writes the key, and ttl seconds after they were
+        read, which bounds staleness if invalidations are lost. A read
+        registers itself with begin_fill before going to Redis; an
+        invalidation that arrives before it fills cancels the fill, so a
+        value that was already stale when it arrived is never cached.
+
+        Args:
+            max_entries (int): Most keys held
+            ttl (float): Seconds an entry may be served
+            policy (str): "lru" evicts the least recently read entry; "lfu"
+                evicts the least read of the NEAR_CACHE_SAMPLES oldest entries
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown near cache policy: {policy}")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.policy = policy
+        self.entries = OrderedDict()  # key -> [value, expires, reads], oldest first
+        self.fills = {}               # key -> token of the read that may fill it
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """The cached value of key, or MISS"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self.hits += 1
+                    entry[2] += 1
+                    if self.policy == "lru":
+                        self.entries.move_to_end(key)
+                    return entry[0]
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return MISS
+
+    def begin_fill(self, key):
+        """Start reading key from Redis; returns the token to fill with"""
+        token = object()
+        self.fills[key] = token
+        return token
+
+    def fill(self, key, value, token):
+        with self.lock:
+            if self.fills.get(key) is not token:
+                return  # Invalidated, or overtaken by a newer read, while the value was in flight
+            del self.fills[key]
+            self.entries[key] = [value, time.monotonic() + self.ttl, 0]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Called with self.lock held
+        if self.policy == "lru":
+            self.entries.popitem(last=False)
+        else:
+            oldest = []
+            for key, entry in self.entries.items():
+                oldest.append((entry[2], key))
+                if len(oldest) == NEAR_CACHE_SAMPLES:
+                    break
+            del self.entries[min(oldest, key=lambda pair: pair[0])[1]]
+        self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.fills.pop(key, None)
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop everything, e.g. after invalidations may have been missed"""
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.fills.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "max_entries": self.max_entries, "policy": self.policy,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations, "invalidations": self.invalidations}
+
+    def collect_metrics(self):
+        """Near cache counters, in the format metrics.add_collector expects"""
+        return [
+            ("kv_near_cache_entries", "gauge", "Keys held by the near cache", [({}, len(self.entries))]),
+            ("kv_near_cache_lookups_total", "counter", "Near cache lookups by result",
+             [({"result": "hit"}, self.hits), ({"result": "miss"}, self.misses)]),
+            ("kv_near_cache_removals_total", "counter", "Entries dropped from the near cache by reason",
+             [({"reason": "evicted"}, self.evictions), ({"reason": "expired"}, self.expirations),
+              ({"reason": "invalidated"}, self.invalidations)]),
+        ]
+
+
+class Invalidator:
+    def __init__(self, cache, host, port):
+        """
+        Feed a NearCache the keys that change on one Redis node
+
+        Uses Redis client-side caching in broadcast mode: one connection
+        subscribes to __redis__:invalidate, and a second one turns tracking
+        on with its invalidations redirected to the first, so every key
+        written on the node is reported. Servers without CLIENT TRACKING
+        are followed through keyspace notifications instead, if the node's
+        notify-keyspace-events enables them. With neither, the cache only
+        expires entries by TTL. Whenever the link drops the whole cache is
+        cleared, since changes may have been missed.
+
+        Args:
+            cache (NearCache): Cache to invalidate
+            host (str): Redis host
+            port (int): Redis port
+        """
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.mode = None   # "tracking", "keyspace" or "ttl" once connected
+        self.link_up = False
+        self.stopped = False
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name=f"invalidator-{self.port}", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped = True
+
+    def serving(self):
+        """True while the cache may serve this node's keys: its changes are followed, or only TTLs apply"""
+        return self.link_up or self.mode == "ttl"
+
+    def _run(self):
+        delay = 0.1
+        while not self.stopped and self.mode != "ttl":
+            try:
+                self._listen()
+            except (redis.exceptions.RedisError, OSError) as e:
+                if self.link_up:
+                    delay = 0.1
+                    print(f"Invalidation link to {self.host}:{self.port} lost: {e}")
+            self.link_up = False
+            self.cache.clear()
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def _connection(self):
+        connection = redis.Connection(host=self.host, port=self.port, decode_responses=True,
+                                      socket_connect_timeout=2.0, socket_timeout=INVALIDATION_PING * 5)
+        connection.connect()
+        return connection
+
+    def _keyspace_flags(self, control):
+        # The node's notify-keyspace-events, or "" where CONFIG is disabled
+        control.send_command("CONFIG", "GET", "notify-keyspace-events")
+        try:
+            reply = control.read_response()
+        except redis.exceptions.ResponseError:
+            return ""
+        return reply[1] if isinstance(reply, list) else reply.get("notify-keyspace-events", "")
+
+    def _listen(self):
+        listener = self._connection()
+        control = self._connection()
+        try:
+            listener.send_command("CLIENT", "ID")
+            client_id = listener.read_response()
+            try:
+                control.send_command("CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST")
+                control.read_response()
+                listener.send_command("SUBSCRIBE", "__redis__:invalidate")
+                self.mode = "tracking"
+            except redis.exceptions.ResponseError:
+                # Some servers hang up after an unknown command, so ask on a fresh connection
+                control.disconnect()
+                control = self._connection()
+                flags = self._keyspace_flags(control)
+                if "K" not in flags or not ("A" in flags or {"g", "$"} <= set(flags)):
+                    print(f"{self.host}:{self.port} has neither CLIENT TRACKING nor keyspace notifications; "
+                          f"near cache entries expire after {self.cache.ttl}s")
+                    self.mode = "ttl"
+                    return
+                listener.send_command("PSUBSCRIBE", "__keyspace@*__:*")
+                self.mode = "keyspace"
+            listener.read_response()
+            # Anything cached before the subscription took effect may have missed its invalidation
+            self.cache.clear()
+            self.link_up = True
+
+            while not self.stopped:
+                if not listener.can_read(timeout=INVALIDATION_PING):
+                    # Tracking is registered on the control connection; make sure it is still there
+                    control.send_command("PING")
+                    control.read_response()
+                    continue
+                message = listener.read_response()
+                if message[0] == "message":
+                    if message[2] is None:
+                        self.cache.clear()  # The node was flushed
+                    else:
+                        for key in message[2]:
+                            self.cache.invalidate(key)
+                elif message[0] == "pmessage":
+                    self.cache.invalidate(message[2].split(":", 1)[1])
+        finally:
+            listener.disconnect()
+            control.disconnect()
+
+
+class Flight:
+    __slots__ = ("deadline", "result", "error", "event", "task")
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.event = None  # Created by the first thread that joins, so a read nobody joins never builds one
+        self.task = None   # The fetch, for AsyncSingleFlight
+
+
+class SingleFlight:
+    def __init__(self, max_flights=SINGLE_FLIGHT_MAX, timeout=SINGLE_FLIGHT_TIMEOUT):
+        """
+        Collapse concurrent reads of the same key into one backend call
+
+        The first thread to read a key runs the fetch; threads reading the
+        same key while it is in flight wait for its result, or its error,
+        instead of sending their own. A stampede on one key costs one round
+        trip rather than one per reader.
+
+        Bounded and deadline-aware: at most max_flights keys are in flight,
+        and reads of further keys go straight to the backend. A flight can
+        be joined for timeout seconds after it started, and its waiters give
+        up with a TimeoutError at that point. A read that arrives once the
+        flight is past its deadline starts a new one.
+
+        Args:
+            max_flights (int): Most keys with a read in flight
+            timeout (float): Seconds a flight may be joined and waited for
+        """
+        self.max_flights = max_flights
+        self.timeout = timeout
+        self.flights = {}  # key -> Flight
+        self.lock = threading.Lock()
+        self.calls = 0       # Reads that went to the backend as a flight
+        self.coalesced = 0   # Reads answered by another thread's flight
+        self.bypassed = 0    # Reads sent on their own because max_flights keys were in flight
+        self.timeouts = 0    # Waiters that gave up at the deadline
+
+    def do(self, key, fetch):
+        """fetch() once for all concurrent callers with this key, returning its result to each"""
+        with self.lock:
+            now = time.monotonic()
+            flight = self.flights.get(key)
+            if flight is not None and flight.deadline > now:
+                self.coalesced += 1
+                if flight.event is None:
+                    flight.event = threading.Event()
+                lead = False
+            elif flight is None and len(self.flights) >= self.max_flights:
+                self.bypassed += 1
+                flight = None
+                lead = True
+            else:
+                self.calls += 1
+                flight = self.flights[key] = Flight(now + self.timeout)
+                lead = True
+
+        if lead:
+            if flight is None:
+                return fetch()
+            try:
+                flight.result = fetch()
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    # Unless a write detached it, or a newer flight replaced it after the deadline
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+                    event = flight.event
+                if event is not None:
+                    event.set()
+
+        if not flight.event.wait(max(0.0, flight.deadline - time.monotonic())):
+            with self.lock:
+                self.timeouts += 1
+            raise redis.exceptions.TimeoutError(f"Timed out waiting for a concurrent read of {key!r}")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def forget(self, key):
+        """Detach key's flight, so reads that start after a write never share a fetch that started before it"""
+        with self.lock:
+            self.flights.pop(key, None)
+
+    def stats(self):
+        reads = self.calls + self.coalesced + self.bypassed
+        return {"in_flight": len(self.flights), "max_flights": self.max_flights, "calls": self.calls,
+                "coalesced": self.coalesced, "bypassed": self.bypassed, "timeouts": self.timeouts,
+                "coalesced_rate": self.coalesced / reads if reads else 0.0}
+
+    def collect_metrics(self):
+        """Single-flight counters, in the format metrics.add_collector expects"""
+        return [
+            ("kv_single_flight_in_flight", "gauge", "Keys with a coalesced read in flight", [({}, len(self.flights))]),
+            ("kv_single_flight_reads_total", "counter", "Reads by how single-flight served them",
+             [({"result": "call"}, self.calls), ({"result": "coalesced"}, self.coalesced),
+              ({"result": "bypassed"}, self.bypassed)]),
+            ("kv_single_flight_timeouts_total", "counter", "Coalesced reads that gave up at the deadline",
+             [({}, self.timeouts)]),
+        ]
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    SingleFlight for coroutines on one event loop
+
+    The fetch runs as a task of its own, so a caller that is cancelled,
+    e.g. because its client went away, never cancels the read for the
+    others. Only waiters that joined a flight are held to its deadline;
+    the caller that started it waits as long as the fetch takes.
+    """
+
+    async def do(self, key, fetch):
+        """await fetch() once for all concurrent callers with this key"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        flight = self.flights.get(key)
+        if flight is not None and flight.deadline > now:
+            self.coalesced += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(flight.task), flight.deadline - now)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise redis.exceptions.TimeoutError(f"Timed out waiting for a concurrent read of {key!r}")
+        if flight is None and len(self.flights) >= self.max_flights:
+            self.bypassed += 1
+            return await fetch()
+        self.calls += 1
+        flight = self.flights[key] = Flight(now + self.timeout)
+        flight.task = asyncio.ensure_future(fetch())
+        flight.task.add_done_callback(lambda task: self._land(key, flight))
+        return await asyncio.shield(flight.task)
+
+    def _land(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        if not flight.task.cancelled():
+            # Retrieved here, so an error nobody awaited is not reported as never retrieved
+            flight.task.exception()
+
+    def forget(self, key):
+        self.flights.pop(key, None)
+
 
 class KVStore:
-    def __init__(self, num_nodes=3, use_redis=False, user_serverside_hashring=False, base_port=6379):
+    def __init__(self, num_nodes=3, use_redis=False, user_serverside_hashring=False, base_port=6379,
+                 auto_pipeline=AUTO_PIPELINE, near_cache_size=NEAR_CACHE_SIZE, near_cache_ttl=NEAR_CACHE_TTL,
+                 near_cache_policy=NEAR_CACHE_POLICY, single_flight_max=SINGLE_FLIGHT_MAX):
         """
         Initialize KV Store with dynamic number of nodes
         
@@ -14,30 +634,29 @@ class KVStore:
             num_nodes (int): Number of Redis nodes to create
             use_redis (bool): Whether to use Redis or fallback to in-memory
             base_port (int): Starting port number for Redis nodes
+            auto_pipeline (bool): Coalesce concurrent get/set/delete calls into pipelines per node
+            near_cache_size (int): Keys kept in an in-process cache of Redis reads; 0 disables it
+            near_cache_ttl (float): Seconds a cached read may be served
+            near_cache_policy (str): Near cache eviction policy, "lru" or "lfu"
+            single_flight_max (int): Most keys whose concurrent get() calls share one Redis read; 0 disables it
         """
         self.store = {}  # In-memory dictionary as backup
         self.use_redis = use_redis
+        self.auto_pipeline = auto_pipeline
         self.redis_clients = {}
+        self.pipelines = {}  # Node name -> AutoPipeline, when auto_pipeline is on
+        self.near_cache = None
+        self.invalidators = {}  # Node name -> Invalidator, when the near cache is on
+        if use_redis and near_cache_size > 0:
+            self.near_cache = NearCache(near_cache_size, near_cache_ttl, near_cache_policy)
+        self.single_flight = SingleFlight(single_flight_max) if use_redis and single_flight_max > 0 else None
+        # While keys move after a ring change: the ring and clients from before it
+        self.old_ring = None
+        self.old_clients = None
+        self.migration_lock = threading.Lock()
         
         # Generate nodes configuration
-        self.nodes = []
-        redis_host = os.getenv("REDIS_HOST", "localhost")
-        
-        # In Docker, we need to handle multiple Redis services
-        if os.getenv("DOCKER_ENV"):
-            # Expect Redis services to be named redis-1, redis-2, etc.
-            for i in range(num_nodes):
-                self.nodes.append({
-                    "host": f"redis-{i+1}",  # Docker service name
-                    "port": base_port  # Each service runs on the same port
-                })
-        else:
-            # Local development - use different ports on localhost
-            for i in range(num_nodes):
-                self.nodes.append({
-                    "host": redis_host,
-                    "port": base_port + i
-                })
+        self.nodes = node_configs(num_nodes, base_port)
 
         # Initialize HashRing with node names
         node_names = [f"node{i+1}" for i in range(num_nodes)]
@@ -47,15 +666,10 @@ class KVStore:
             for idx, node in enumerate(self.nodes):
                 try:
                     # Attempt to initialize Redis client
-                    client = redis.Redis(
-                        host=node['host'], 
-                        port=node['port'], 
-                        decode_responses=True,
-                        socket_connect_timeout=2.0  # Add timeout for connection attempts
-                    )
+                    client = make_client(node['host'], node['port'])
                     # Test connection by pinging Redis
                     client.ping()
-                    self.redis_clients[f"node{idx+1}"] = client
+                    self._add_client(f"node{idx+1}", client)
                     print(f"Connected to Redis {node['host']}:{node['port']} as node{idx+1}")
                 except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
                     print(f"Redis connection failed for {node['host']}:{node['port']}: {str(e)}")
@@ -64,52 +678,548 @@ class KVStore:
                         self.use_redis = False
                         break
 
+    def _add_client(self, name, client):
+        self.redis_clients[name] = client
+        if self.auto_pipeline:
+            self.pipelines[name] = AutoPipeline(client)
+        if self.near_cache is not None:
+            kwargs = client.connection_pool.connection_kwargs
+            self.invalidators[name] = Invalidator(self.near_cache, kwargs["host"], kwargs["port"])
+            self.invalidators[name].start()
+
+    def _cache_for(self, node):
+        # The near cache, unless the node's invalidation link is down and changes could go unnoticed
+        invalidator = self.invalidators.get(node)
+        if invalidator is None or not invalidator.serving():
+            return None
+        return self.near_cache
+
+    def _invalidate(self, keys):
+        # Drop this process's cached copies and reads in flight once its own write has landed
+        if self.near_cache is not None:
+            for key in keys:
+                self.near_cache.invalidate(key)
+        if self.single_flight is not None:
+            for key in keys:
+                self.single_flight.forget(key)
+
+    def near_cache_stats(self):
+        """Near cache size, hit rate, evictions, expirations and invalidations; None if it is off"""
+        if self.near_cache is None:
+            return None
+        return {**self.near_cache.stats(),
+                "invalidation": {name: invalidator.mode if invalidator.serving() else "down"
+                                 for name, invalidator in self.invalidators.items()}}
+
+    def single_flight_stats(self):
+        """Reads sent, coalesced, bypassed and timed out by single-flight; None if it is off"""
+        return None if self.single_flight is None else self.single_flight.stats()
+
+    def _call(self, node, method, *args, **kwargs):
+        # Run one command on node, through its automatic pipeline when there is one
+        pipeline = self.pipelines.get(node)
+        if pipeline is None:
+            return getattr(self.redis_clients[node], method)(*args, **kwargs)
+        return pipeline.execute(method, *args, **kwargs)
+
     def get_client(self, key):
         node = self.ring.get_node(key)
         return self.redis_clients.get(node)
 
+    def get_old_client(self, key):
+        # The client of the node key is moving away from, or None if it is not moving
+        old_ring = self.old_ring
+        if old_ring is None:
+            return None
+        node = old_ring.get_node(key)
+        if node == self.ring.get_node(key):
+            return None
+        return self.old_clients.get(node)
+
     def get(self, key):
         # Retrieve value from Redis if available, otherwise from the in-memory store
-        client = self.get_client(key)
+        node = self.ring.get_node(key)
+        client = self.redis_clients.get(node)
 
         if self.use_redis and client:
-            return client.get(key)
+            cache = self._cache_for(node)
+            if cache is not None:
+                value = cache.get(key)
+                if value is not MISS:
+                    return value
+            # Concurrent misses on the same key share one read
+            if self.single_flight is None:
+                return self._fetch(node, client, key, cache)
+            return self.single_flight.do(key, lambda: self._fetch(node, client, key, cache))
         return self.store.get(key)
 
+    def _fetch(self, node, client, key, cache):
+        # Read key from Redis, filling the near cache if it is on
+        if cache is not None:
+            token = cache.begin_fill(key)
+        value = self._call(node, "get", key)
+        if value is None and self.get_old_client(key) is not None:
+            # Not moved yet: read both copies in one step of the migration
+            with self.migration_lock:
+                value = client.get(key)
+                old_client = self.get_old_client(key)
+                if value is None and old_client is not None:
+                    value = old_client.get(key)
+        if cache is not None:
+            cache.fill(key, value, token)
+        return value
+
     def set(self, key, value, **kwargs):
         # Set value in Redis if available, otherwise in the in-memory store
-        client = self.get_client(key)
+        node = self.ring.get_node(key)
+        client = self.redis_clients.get(node)
 
         if self.use_redis and client:
-            res = client.set(key, value, **kwargs)
-
-            if res == None:
-                print(f"Failed to set key: {key} in Redis")
+            old_client = self.get_old_client(key)
+            if old_client is None:
+                self._call(node, "set", key, value, **kwargs)
             else:
-                print(f"Key: {key} set successfully in Redis")
+                # Drop the old copy so the migration cannot bring it back
+                with self.migration_lock:
+                    client.set(key, value, **kwargs)
+                    old_client.delete(key)
+            self._invalidate([key])
         else:
-            print("Failed to get client or use_redis == False")
             self.store[key] = value
         return 0
 
     def delete(self, key):
         # Delete key(s) from Redis if available, otherwise from the in-memory store
-        res = []  # Could be modified key -> *keys to delete multiple keys at once & return list of responses
-        client = self.get_client(key)
+        res = []  # mdel() deletes many keys at once
+        node = self.ring.get_node(key)
+        client = self.redis_clients.get(node)
 
         if self.use_redis and client:
-            res.append(client.delete(key))
+            old_client = self.get_old_client(key)
+            if old_client is None:
+                res.append(self._call(node, "delete", key))
+            else:
+                with self.migration_lock:
+                    res.append(client.delete(key) + old_client.delete(key))
+            self._invalidate([key])
         else:
             res.append(self.store.pop(key, -1))
         return res
 
+    def _group(self, keys):
+        # Positions of keys, grouped by the ring node that owns each
+        by_node = {}
+        for index, key in enumerate(keys):
+            by_node.setdefault(self.ring.get_node(key), []).append(index)
+        return by_node
+
+    def mget(self, keys):
+        """
+        Values of many keys in one round trip per node
+
+        Each node gets one pipeline of MGETs of up to MULTI_BATCH keys.
+
+        Returns:
+            list: Values in the order of keys, None for missing keys
+        """
+        keys = list(keys)
+        if not self.use_redis:
+            return [self.store.get(key) for key in keys]
+        if self.old_ring is not None:
+            # Keys are moving: each one may need its old owner's copy
+            return [self.get(key) for key in keys]
+        values = [None] * len(keys)
+        for node, indexes in self._group(keys).items():
+            cache = self._cache_for(node)
+            if cache is not None:
+                tokens = {}
+                missing = []
+                for index in indexes:
+                    value = cache.get(keys[index])
+                    if value is MISS:
+                        tokens[index] = cache.begin_fill(keys[index])
+                        missing.append(index)
+                    else:
+                        values[index] = value
+                indexes = missing
+            batches = chunked(indexes, MULTI_BATCH)
+            pipe = self.redis_clients[node].pipeline(transaction=False)
+            for batch in batches:
+                pipe.mget([keys[i] for i in batch])
+            for batch, found in zip(batches, pipe.execute()):
+                for index, value in zip(batch, found):
+                    values[index] = value
+                    if cache is not None:
+                        cache.fill(keys[index], value, tokens[index])
+        return values
+
+    def mset(self, items, **kwargs):
+        """
+        Set many keys in one round trip per node
+
+        Each node gets one pipeline of MSETs of up to MULTI_BATCH keys, or of
+        single SETs when kwargs (e.g. px) carry options MSET lacks.
+
+        Args:
+            items (dict): Key -> value
+        """
+        if not self.use_redis:
+            self.store.update(items)
+            return 0
+        if self.old_ring is not None:
+            for key, value in items.items():
+                self.set(key, value, **kwargs)
+            return 0
+        keys = list(items)
+        for node, indexes in self._group(keys).items():
+            pipe = self.redis_clients[node].pipeline(transaction=False)
+            for batch in chunked(indexes, MULTI_BATCH):
+                if kwargs:
+                    for i in batch:
+                        pipe.set(keys[i], items[keys[i]], **kwargs)
+                else:
+                    pipe.mset({keys[i]: items[keys[i]] for i in batch})
+            pipe.execute()
+        self._invalidate(keys)
+        return 0
+
+    def mdel(self, keys):
+        """
+        Delete many keys in one round trip per node
+
+        Returns:
+            int: Number of keys that existed
+        """
+        keys = list(keys)
+        if not self.use_redis:
+            return sum(self.store.pop(key, None) is not None for key in keys)
+        if self.old_ring is not None:
+            return sum(self.delete(key)[0] > 0 for key in keys)
+        deleted = 0
+        for node, indexes in self._group(keys).items():
+            pipe = self.redis_clients[node].pipeline(transaction=False)
+            for batch in chunked(indexes, MULTI_BATCH):
+                pipe.delete(*[keys[i] for i in batch])
+            deleted += sum(pipe.execute())
+        self._invalidate(keys)
+        return deleted
+
+    def iter_keys(self, pattern="*"):
+        """
+        Iterate over the keys matching a glob pattern, node by node
+
+        Uses SCAN rather than KEYS, so no node is blocked for the whole
+        listing. A key written or moved during the iteration may be
+        missed or seen twice.
+        """
+        if self.use_redis:
+            for client in list(self.redis_clients.values()):
+                yield from client.scan_iter(match=pattern, count=SCAN_COUNT)
+        else:
+            yield from (key for key in list(self.store) if fnmatch.fnmatchcase(key, pattern))
+
     def keys(self, pattern="*"):
         # List keys from Redis if available, otherwise from the in-memory store
+        return list(dict.fromkeys(self.iter_keys(pattern)))
+
+    def add_node(self, host, port):
+        """
+        Add a Redis node to the ring, then move the keys it now owns onto it
+
+        Blocks until the keys are moved; other threads keep using the store meanwhile.
+
+        Returns:
+            int: Number of keys moved
+        """
+        name = f"node{max((int(node[4:]) for node in self.redis_clients), default=0) + 1}"
+        client = make_client(host, port)
+        client.ping()
+        old_clients = dict(self.redis_clients)
+        self.nodes.append({"host": host, "port": port})
+        self._add_client(name, client)
+        # Every existing node hands some of its hash ranges to the new one
+        return self._rebalance(old_clients, list(old_clients))
+
+    def remove_node(self, name):
+        """
+        Move a Redis node's keys to the nodes that now own them, then drop it from the ring
+
+        Returns:
+            int: Number of keys moved
+        """
+        old_clients = dict(self.redis_clients)
+        client = self.redis_clients.pop(name)
+        self.pipelines.pop(name, None)
+        invalidator = self.invalidators.pop(name, None)
+        if invalidator is not None:
+            invalidator.stop()
+        kwargs = client.connection_pool.connection_kwargs
+        self.nodes = [node for node in self.nodes
+                      if (node["host"], node["port"]) != (kwargs.get("host"), kwargs.get("port"))]
+        moved = self._rebalance(old_clients, [name])
+        client.close()
+        return moved
+
+    def _rebalance(self, old_clients, sources):
+        """
+        Swap in a ring over the current clients and move the keys whose owner changed
+
+        Each source node is walked with SCAN. The keys of a page that now
+        belong elsewhere are read with GET/PTTL in one pipeline and written
+        to their new owner with SET NX (keeping their TTLs) in another,
+        then deleted from the source. Until it finishes, get() falls back
+        to a key's old owner when the new one misses, and set()/delete()
+        also delete the old copy. NX keeps a copy from overwriting a value
+        a client already wrote to the new owner.
+
+        Args:
+            old_clients (dict): Node name -> client before the change
+            sources (list): Names of the nodes that lose keys
+
+        Returns:
+            int: Number of keys moved
+        """
+        self.old_clients = old_clients
+        self.old_ring = self.ring
+        self.ring = HashRing(nodes=list(self.redis_clients))
+        moved = 0
+        try:
+            for name in sources:
+                source = old_clients[name]
+                page = []
+                for key in source.scan_iter(count=MIGRATION_BATCH):
+                    page.append(key)
+                    if len(page) >= MIGRATION_BATCH:
+                        moved += self._move_page(name, source, page)
+                        page = []
+                moved += self._move_page(name, source, page)
+        finally:
+            self.old_ring = None
+            self.old_clients = None
+        print(f"Moved {moved} keys to their new nodes")
+        return moved
+
+    def _move_page(self, name, source, keys):
+        moves = {}  # New owner -> keys
+        for key in keys:
+            owner = self.ring.get_node(key)
+            if owner != name:
+                moves.setdefault(owner, []).append(key)
+
+        moved = 0
+        for owner, keys in moves.items():
+            # Under the lock, so a concurrent delete cannot land between the copy and the source's delete
+            with self.migration_lock:
+                pipe = source.pipeline(transaction=False)
+                for key in keys:
+                    pipe.get(key)
+                    pipe.pttl(key)
+                results = pipe.execute()
+                pipe = self.redis_clients[owner].pipeline(transaction=False)
+                copied = []
+                for key, value, ttl in zip(keys, results[::2], results[1::2]):
+                    if value is None:
+                        continue  # Deleted since the scan
+                    pipe.set(key, value, nx=True, px=ttl if ttl > 0 else None)
+                    copied.append(key)
+                pipe.execute()
+                if copied:
+                    source.delete(*copied)
+            moved += len(copied)
+        return moved
+
+
+class AsyncKVStore:
+    def __init__(self, num_nodes=3, base_port=6379, auto_pipeline=AUTO_PIPELINE, near_cache_size=NEAR_CACHE_SIZE,
+                 near_cache_ttl=NEAR_CACHE_TTL, near_cache_policy=NEAR_CACHE_POLICY, single_flight_max=SINGLE_FLIGHT_MAX):
+        """
+        Asyncio counterpart of KVStore for the ASGI front end, using redis.asyncio clients
+        
+        Args:
+            num_nodes (int): Number of Redis nodes to create
+            base_port (int): Starting port number for Redis nodes
+            auto_pipeline (bool): Send the commands issued in one event loop iteration as one pipeline per node
+            near_cache_size (int): Keys kept in an in-process cache of get() results; 0 disables it
+            near_cache_ttl (float): Seconds a cached read may be served
+            near_cache_policy (str): Near cache eviction policy, "lru" or "lfu"
+            single_flight_max (int): Most keys whose concurrent get() calls share one Redis read; 0 disables it
+        """
+        self.store = {}  # In-memory dictionary as backup
+        self.use_redis = True
+        self.auto_pipeline = auto_pipeline
+        self.redis_clients = {}
+        self.pipelines = {}
+        self.near_cache = NearCache(near_cache_size, near_cache_ttl, near_cache_policy) if near_cache_size > 0 else None
+        self.single_flight = AsyncSingleFlight(single_flight_max) if single_flight_max > 0 else None
+        self.invalidators = {}
+        self.nodes = node_configs(num_nodes, base_port)
+        node_names = [f"node{i+1}" for i in range(num_nodes)]
+        self.ring = HashRing(nodes=node_names)
+
+    async def connect(self):
+        # Clients can only be pinged from inside the event loop, so connecting is a separate step
+        for idx, node in enumerate(self.nodes):
+            try:
+                client = make_async_client(node['host'], node['port'])
+                await client.ping()
+                self.redis_clients[f"node{idx+1}"] = client
+                if self.auto_pipeline:
+                    self.pipelines[f"node{idx+1}"] = AsyncAutoPipeline(client)
+                if self.near_cache is not None:
+                    # Invalidations are read on a thread of their own, as for KVStore
+                    self.invalidators[f"node{idx+1}"] = Invalidator(self.near_cache, node['host'], node['port'])
+                    self.invalidators[f"node{idx+1}"].start()
+                print(f"Connected to Redis {node['host']}:{node['port']} as node{idx+1}")
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+                print(f"Redis connection failed for {node['host']}:{node['port']}: {str(e)}")
+                if idx == 0:
+                    print("Primary Redis connection failed. Using in-memory store as backup.")
+                    self.use_redis = False
+                    break
+
+    async def close(self):
+        for invalidator in self.invalidators.values():
+            invalidator.stop()
+        for client in self.redis_clients.values():
+            await client.aclose()
+
+    def _cache_for(self, node):
+        invalidator = self.invalidators.get(node)
+        if invalidator is None or not invalidator.serving():
+            return None
+        return self.near_cache
+
+    def _invalidate(self, keys):
+        if self.near_cache is not None:
+            for key in keys:
+                self.near_cache.invalidate(key)
+        if self.single_flight is not None:
+            for key in keys:
+                self.single_flight.forget(key)
+
+    def near_cache_stats(self):
+        """See KVStore.near_cache_stats"""
+        if self.near_cache is None:
+            return None
+        return {**self.near_cache.stats(),
+                "invalidation": {name: invalidator.mode if invalidator.serving() else "down"
+                                 for name, invalidator in self.invalidators.items()}}
+
+    def single_flight_stats(self):
+        """See KVStore.single_flight_stats"""
+        return None if self.single_flight is None else self.single_flight.stats()
+
+    def get_client(self, key):
+        node = self.ring.get_node(key)
+        return self.redis_clients.get(node)
+
+    def _call(self, node, method, *args, **kwargs):
+        # Awaitable result of one command on node, through its automatic pipeline when there is one
+        pipeline = self.pipelines.get(node)
+        if pipeline is None:
+            return getattr(self.redis_clients[node], method)(*args, **kwargs)
+        return pipeline.execute(method, *args, **kwargs)
+
+    async def get(self, key):
+        node = self.ring.get_node(key)
+        if self.use_redis and node in self.redis_clients:
+            cache = self._cache_for(node)
+            if cache is not None:
+                value = cache.get(key)
+                if value is not MISS:
+                    return value
+            if self.single_flight is None:
+                return await self._fetch(node, key, cache)
+            return await self.single_flight.do(key, lambda: self._fetch(node, key, cache))
+        return self.store.get(key)
+
+    async def _fetch(self, node, key, cache):
+        if cache is None:
+            return await self._call(node, "get", key)
+        token = cache.begin_fill(key)
+        value = await self._call(node, "get", key)
+        cache.fill(key, value, token)
+        return value
+
+    async def set(self, key, value, **kwargs):
+        node = self.ring.get_node(key)
+        if self.use_redis and node in self.redis_clients:
+            await self._call(node, "set", key, value, **kwargs)
+            self._invalidate([key])
+        else:
+            self.store[key] = value
+        return 0
+
+    async def delete(self, key):
+        node = self.ring.get_node(key)
+        if self.use_redis and node in self.redis_clients:
+            res = [await self._call(node, "delete", key)]
+            self._invalidate([key])
+            return res
+        return [self.store.pop(key, -1)]
+
+    def _group(self, keys):
+        by_node = {}
+        for index, key in enumerate(keys):
+            by_node.setdefault(self.ring.get_node(key), []).append(index)
+        return by_node
+
+    async def _per_node(self, keys, queue):
+        # Run queue(pipe, batch) for each node's keys, every node's pipeline at once
+        async def run(node, indexes):
+            batches = chunked(indexes, MULTI_BATCH)
+            pipe = self.redis_clients[node].pipeline(transaction=False)
+            for batch in batches:
+                queue(pipe, batch)
+            return batches, await pipe.execute()
+        return await asyncio.gather(*(run(node, indexes) for node, indexes in self._group(keys).items()))
+
+    async def mget(self, keys):
+        """Values of many keys in order, None for missing ones; see KVStore.mget, though this one skips the near cache"""
+        keys = list(keys)
+        if not self.use_redis:
+            return [self.store.get(key) for key in keys]
+        values = [None] * len(keys)
+        for batches, results in await self._per_node(keys, lambda pipe, batch: pipe.mget([keys[i] for i in batch])):
+            for batch, found in zip(batches, results):
+                for index, value in zip(batch, found):
+                    values[index] = value
+        return values
+
+    async def mset(self, items, **kwargs):
+        """Set many keys in one round trip per node; see KVStore.mset"""
+        if not self.use_redis:
+            self.store.update(items)
+            return 0
+        keys = list(items)
+
+        def queue(pipe, batch):
+            if kwargs:
+                for i in batch:
+                    pipe.set(keys[i], items[keys[i]], **kwargs)
+            else:
+                pipe.mset({keys[i]: items[keys[i]] for i in batch})
+        await self._per_node(keys, queue)
+        self._invalidate(keys)
+        return 0
+
+    async def mdel(self, keys):
+        """Delete many keys in one round trip per node; returns the number that existed"""
+        keys = list(keys)
+        if not self.use_redis:
+            return sum(self.store.pop(key, None) is not None for key in keys)
+        results = await self._per_node(keys, lambda pipe, batch: pipe.delete(*[keys[i] for i in batch]))
+        self._invalidate(keys)
+        return sum(sum(counts) for _, counts in results)
+
+    async def keys(self, pattern="*"):
+        # SCAN rather than KEYS, as in KVStore.iter_keys
         if self.use_redis:
-            all_keys = []
-            for client in self.redis_clients.values():
-                all_keys.extend(client.keys(pattern))
-            return all_keys
-        return list(self.store.keys())
+            all_keys = {}
+            for client in list(self.redis_clients.values()):
+                async for key in client.scan_iter(match=pattern, count=SCAN_COUNT):
+                    all_keys[key] = None
+            return list(all_keys)
+        return [key for key in list(self.store) if fnmatch.fnmatchcase(key, pattern)]
 
 kv_store = KVStore(num_nodes=1)
@@ -1,44 +1,256 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from get_value import handle_get_thread
 from set_value import handle_set_thread
 from delete_key import handle_delete_thread
+from scan_keys import handle_scan_thread
+from batch_ops import handle_mget_thread, handle_mset_thread, handle_mdel_thread, parse_batch
+from atomic_ops import handle_conditional_set_thread, handle_incr_thread, handle_append_thread, ConditionFailed
+from atomic_ops import query_options, parse_conditions
+from expiry import expire_at
 from logger import log_operation
+from worker_pool import DeadlineExceeded, PoolSaturated
+from replication import replication, ReadOnlyReplica
+from metrics import metrics, CONTENT_TYPE
+from values import to_json, from_json, byte_range
+from hot_keys import hot_keys, OPS
 
 app = Flask(__name__)
 
+# Samples response serialization (see metrics.phase_clock)
+serialize_clock = metrics.phase_clock()
+
+# Run a batch handler and turn its per-key results into a response
+def run_batch(operation, handler, args, to_result):
+    try:
+        results = handler(args)
+    except DeadlineExceeded:
+        log_operation(operation, None, 'timeout')
+        return jsonify({"error": f"Timeout running {operation}"}), 504
+    except PoolSaturated:
+        log_operation(operation, None, 'overloaded')
+        return jsonify({"error": "Server overloaded"}), 503
+    except ReadOnlyReplica:
+        log_operation(operation, None, 'read-only')
+        return jsonify({"error": "Read-only replica"}), 403
+    log_operation(operation, None, f'{len(results)} keys')
+    started = next(serialize_clock)()
+    response = jsonify({"results": [to_result(key, res) for key, res in results]})
+    if started:
+        metrics.phase_end("serialize", started)
+    return response, 200
+
+# Get the values for many keys
+@app.route('/_mget', methods=['POST'])
+@metrics.timed('mget')
+def mget_app():
+    try:
+        ops = parse_batch(request.get_data(), request.mimetype, require_value=False)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return run_batch('mget', handle_mget_thread, [op['key'] for op in ops],
+                     lambda key, value: {"key": key, "status": 404} if value is None
+                     else {"key": key, "status": 200, "value": to_json(value)})
+
+# Set many key-value pairs
+@app.route('/_mset', methods=['POST'])
+@metrics.timed('mset')
+def mset_app():
+    try:
+        ops = parse_batch(request.get_data(), request.mimetype, require_value=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return run_batch('mset', handle_mset_thread, [(op['key'], op['value'], op['deadline']) for op in ops],
+                     lambda key, version: {"key": key, "status": 200, "version": version})
+
+# Delete many keys
+@app.route('/_mdel', methods=['POST'])
+@metrics.timed('mdel')
+def mdel_app():
+    try:
+        ops = parse_batch(request.get_data(), request.mimetype, require_value=False)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return run_batch('mdel', handle_mdel_thread, [op['key'] for op in ops],
+                     lambda key, res: {"key": key, "status": 404 if res == -1 else 200})
+
+# Liveness probe used by the router's health checks
+@app.route('/_health', methods=['GET'])
+def health_app():
+    return jsonify({"status": "ok"}), 200
+
+# Replication role, offset and links
+@app.route('/_replication', methods=['GET'])
+def replication_app():
+    return jsonify(replication.status()), 200
+
+# Latency histograms and server counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_app():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+# Hottest keys per operation (get, set, delete, update), by requests or bytes, from fixed-size sketches
+@app.route('/_hotkeys', methods=['GET'])
+def hot_keys_app():
+    try:
+        count = int(request.args.get('count', hot_keys.capacity))
+        report = hot_keys.report(request.args.getlist('op') or OPS, count, request.args.get('by', 'requests'),
+                                 request.args.getlist('key'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(report), 200
+
+# Scan keys by prefix and optional glob, one page at a time
+@app.route('/_scan', methods=['GET'])
+@metrics.timed('scan')
+def scan_app():
+    prefix = request.args.get('prefix', '')
+    cursor = request.args.get('cursor', '')
+    pattern = request.args.get('match')
+    # expiry=1 adds each key's deadline (unix time, or null) to its item
+    with_expiry = request.args.get('expiry') == '1'
+    try:
+        count = int(request.args.get('count', 10))
+    except ValueError:
+        return jsonify({"error": "'count' must be an integer"}), 400
+    next_cursor, items = handle_scan_thread(prefix, cursor, count, pattern, with_expiry)
+    log_operation('scan', prefix, f'{len(items)} keys')
+    items = [(key, to_json(value), *rest) for key, value, *rest in items]
+    return jsonify({"cursor": next_cursor, "items": items}), 200
+
+# Increment a number or append to a value in place: {"incr": n} or {"append": item}
+def update_value_app(key, data):
+    if 'incr' in data:
+        operation, delta = 'incr', data['incr']
+        if isinstance(delta, bool) or not isinstance(delta, (int, float)):
+            return jsonify({"error": "'incr' must be a number"}), 400
+        handler, args, field = handle_incr_thread, (key, delta), 'value'
+    else:
+        try:
+            item = from_json(data['append'])
+        except ValueError:
+            return jsonify({"error": "Invalid base64 in 'append'"}), 400
+        operation, handler, args, field = 'append', handle_append_thread, (key, item), 'length'
+    try:
+        result, version = handler(*args)
+    except ValueError as e:
+        log_operation(operation, key, 'wrong type')
+        return jsonify({"error": str(e)}), 400
+    except DeadlineExceeded:
+        log_operation(operation, key, 'timeout')
+        return jsonify({"error": f"Timeout running {operation}"}), 504
+    except PoolSaturated:
+        log_operation(operation, key, 'overloaded')
+        return jsonify({"error": "Server overloaded"}), 503
+    except ReadOnlyReplica:
+        log_operation(operation, key, 'read-only')
+        return jsonify({"error": "Read-only replica"}), 403
+    log_operation(operation, key, 'success')
+    return jsonify({field: result, "version": version}), 200
+
 # Set a key-value pair
 @app.route('/<key>', methods=['POST'])
+@metrics.timed('set')
 def set_value_app(key):
-    # Get data
-    data = request.get_json()
-    if 'value' not in data:
-        return jsonify({"error": "Missing 'value' in request body"}), 400
+    # An application/octet-stream body is stored as the raw bytes, with no JSON round trip
+    if request.mimetype == 'application/octet-stream':
+        value = request.get_data()
+        try:
+            data = query_options(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        data = request.get_json()
+        if 'incr' in data or 'append' in data:
+            return update_value_app(key, data)
+        if 'value' not in data:
+            return jsonify({"error": "Missing 'value' in request body"}), 400
+        try:
+            value = from_json(data['value'])
+        except ValueError:
+            return jsonify({"error": "Invalid base64 in 'value'"}), 400
+    # Optional TTL, as in Redis SET: "ex"/"px" seconds/milliseconds from now, "exat"/"pxat" unix time,
+    # and conditions: "nx" (only if absent), "if_version" (0 for absent) and "if_value"
+    try:
+        deadline = expire_at(data.get('ex'), data.get('px'), data.get('exat'), data.get('pxat'))
+        conditions = parse_conditions(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     # Call handler, return appropriately
-    res = handle_set_thread(key, data['value'])
-    log_operation('set', key, 'success' if res else 'timeout')
-    if res is None:
+    try:
+        if conditions:
+            version = handle_conditional_set_thread(key, value, deadline, **conditions)
+        else:
+            version = handle_set_thread(key, value, deadline)
+    except ConditionFailed as e:
+        log_operation('set', key, 'condition failed')
+        return jsonify({"error": "Condition failed", "version": e.version}), 412
+    except DeadlineExceeded:
+        log_operation('set', key, 'timeout')
         return jsonify({"error": "Timeout setting value"}), 504
-    return jsonify({"message": f"Value for key '{key}' set successfully."}), 200
+    except PoolSaturated:
+        log_operation('set', key, 'overloaded')
+        return jsonify({"error": "Server overloaded"}), 503
+    except ReadOnlyReplica:
+        log_operation('set', key, 'read-only')
+        return jsonify({"error": "Read-only replica"}), 403
+    log_operation('set', key, 'success')
+    return jsonify({"message": f"Value for key '{key}' set successfully.", "version": version}), 200
+
+# Serve a bytes value, or the slice a Range header asks for, with its version as the ETag
+def bytes_response(value, version):
+    try:
+        requested = byte_range(request.headers.get('Range'), len(value))
+    except ValueError:
+        return Response(status=416, headers={"Content-Range": f"bytes */{len(value)}"}), 416
+    if requested is None:
+        return Response(value, mimetype='application/octet-stream',
+                        headers={"Accept-Ranges": "bytes", "ETag": f'"{version}"'}), 200
+    start, stop = requested
+    # WSGI servers only send bytes, so unlike the asgi app this copies the slice (never the whole value)
+    response = Response(value[start:stop], status=206, mimetype='application/octet-stream')
+    response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(value)}"
+    response.headers["ETag"] = f'"{version}"'
+    return response, 206
 
 # Get the value for a key
 @app.route('/<key>', methods=['GET'])
+@metrics.timed('get')
 def get_value_app(key):
     # Get result, return appropriately
-    res = handle_get_thread(key)
-    log_operation('get', key, 'success' if res else 'not found')
+    try:
+        res, version = handle_get_thread(key, with_version=True)
+    except DeadlineExceeded:
+        log_operation('get', key, 'timeout')
+        return jsonify({"error": "Timeout getting value"}), 504
+    log_operation('get', key, 'success' if res is not None else 'not found')
     if res is None:
         return jsonify({"error": f"Key '{key}' not found"}), 404
-    return jsonify({"value": res}), 200
+    # Bytes are served raw unless the Accept header names JSON, which gets {"value": {"$base64": ...}}
+    if isinstance(res, bytes) and 'application/json' not in request.headers.get('Accept', ''):
+        return bytes_response(res, version)
+    started = next(serialize_clock)()
+    response = jsonify({"value": to_json(res), "version": version})
+    if started:
+        metrics.phase_end("serialize", started)
+    return response, 200
 
 # Delete a key
 @app.route('/<key>', methods=['DELETE'])
+@metrics.timed('delete')
 def delete_value_app(key):
     # Get result, return appropriately  
-    res = handle_delete_thread(key)
-    if res is None:
-        log_operation('timeout', None, None)
+    try:
+        res = handle_delete_thread(key)
+    except DeadlineExceeded:
+        log_operation('delete', key, 'timeout')
         return jsonify({"error": "Timeout deleting key"}), 504
-    elif res == -1:
+    except PoolSaturated:
+        log_operation('delete', key, 'overloaded')
+        return jsonify({"error": "Server overloaded"}), 503
+    except ReadOnlyReplica:
+        log_operation('delete', key, 'read-only')
+        return jsonify({"error": "Read-only replica"}), 403
+    if res == -1:
         log_operation('delete', key, 'did not exist')
         return jsonify({"message": f"Key '{key}' did not exist"}), 404
     else:
@@ -0,0 +1,406 @@
+import asyncio
+import json
+import math
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from get_value import get_value
+from scan_keys import handle_scan_thread
+from batch_ops import handle_mget_thread, mset_values, mdel_keys, parse_batch, BATCH_TIMEOUT
+from set_value import set_value
+from atomic_ops import conditional_set, incr, append, query_options, parse_conditions, ConditionFailed, MISSING
+from delete_key import delete_key
+from expiry import expire_at
+from logger import log_operation
+from wal import wal
+from worker_pool import pool, DEFAULT_TIMEOUT, DeadlineExceeded, PoolSaturated
+from replication import replication, ReadOnlyReplica
+from metrics import metrics, CONTENT_TYPE
+from values import to_json, from_json, byte_range
+from hot_keys import hot_keys, OPS
+
+
+class TrieBackend:
+    """Serves the in-memory trie on the event loop; writes only leave it when they may block on fsync"""
+
+    def __init__(self):
+        # Without per-write fsync a write is a buffered append plus a trie update, so it never blocks
+        self.inline_writes = not (wal.enabled and wal.fsync_policy == "always")
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get(self, key):
+        """(value or None, version)"""
+        # Lookups never block, so they run on the event loop itself
+        return get_value(key, with_version=True)
+
+    async def mget(self, keys):
+        return handle_mget_thread(keys)
+
+    async def scan(self, prefix, cursor, count, pattern, with_expiry):
+        return handle_scan_thread(prefix, cursor, count, pattern, with_expiry)
+
+    async def set(self, key, value, deadline=None):
+        return await self._run(set_value, key, value, deadline)
+
+    async def conditional_set(self, key, value, deadline=None, if_version=None, if_value=MISSING, nx=False):
+        return await self._run(conditional_set, key, value, deadline, if_version, if_value, nx)
+
+    async def incr(self, key, delta):
+        return await self._run(incr, key, delta)
+
+    async def append(self, key, item):
+        return await self._run(append, key, item)
+
+    async def delete(self, key):
+        return await self._run(delete_key, key)
+
+    async def mset(self, items):
+        return await self._run(mset_values, items, timeout=BATCH_TIMEOUT)
+
+    async def mdel(self, keys):
+        return await self._run(mdel_keys, keys, timeout=BATCH_TIMEOUT)
+
+    async def _run(self, fn, *args, timeout=DEFAULT_TIMEOUT):
+        if self.inline_writes:
+            return fn(*args)
+        future = pool.submit(fn, *args, timeout=timeout)
+        waiter = asyncio.wrap_future(future)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            # As in pool.run: a write that was applied in time is waited for through its commit
+            if pool.was_applied(future):
+                return await waiter
+            future.cancel()
+            raise DeadlineExceeded()
+
+
+class RedisBackend:
+    """Serves kv_store.AsyncKVStore; values are stored as JSON so they round-trip like the trie's, bytes as {"$base64": ...}"""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def start(self):
+        # Clients can only be pinged from inside the event loop
+        await self.store.connect()
+
+    async def stop(self):
+        await self.store.close()
+
+    async def get(self, key):
+        """(value or None, None); Redis keeps no versions"""
+        value = await self.store.get(key)
+        return (None if value is None else from_json(json.loads(value))), None
+
+    async def mget(self, keys):
+        values = await asyncio.gather(*(self.get(key) for key in keys))
+        return [(key, value) for key, (value, _) in zip(keys, values)]
+
+    async def scan(self, prefix, cursor, count, pattern, with_expiry):
+        # Keys are spread over the Redis nodes by hash, so there is no ordered walk to page through
+        raise NotImplementedError("Scans are not supported by the redis backend")
+
+    async def set(self, key, value, deadline=None):
+        value = json.dumps(to_json(value))
+        if deadline is None:
+            await self.store.set(key, value)
+        else:
+            await self.store.set(key, value, pxat=math.ceil(deadline * 1000))
+        return None  # Redis keeps no versions
+
+    # Redis keeps no versions, and these would need a read-modify-write across the store's nodes
+    async def conditional_set(self, key, value, deadline=None, if_version=None, if_value=MISSING, nx=False):
+        raise NotImplementedError("Conditional sets are not supported by the redis backend")
+
+    async def incr(self, key, delta):
+        raise NotImplementedError("'incr' is not supported by the redis backend")
+
+    async def append(self, key, item):
+        raise NotImplementedError("'append' is not supported by the redis backend")
+
+    async def delete(self, key):
+        res = await self.store.delete(key)
+        return 1 if res[0] not in (0, -1) else -1
+
+    # Batches fan out as concurrent single-key commands, which the store pipelines per node
+    async def mset(self, items):
+        versions = await asyncio.gather(*(self.set(key, value, deadline) for key, value, deadline in items))
+        return [(key, version) for (key, _, _), version in zip(items, versions)]
+
+    async def mdel(self, keys):
+        results = await asyncio.gather(*(self.delete(key) for key in keys))
+        return list(zip(keys, results))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await app.state.backend.start()
+    yield
+    await app.state.backend.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.state.backend = TrieBackend()
+
+# Samples response serialization (see metrics.phase_clock)
+serialize_clock = metrics.phase_clock()
+
+# Swap in the Redis-backed store; called by main.py before serving
+def use_redis_backend(num_nodes, base_port):
+    from kv_store import AsyncKVStore
+    store = AsyncKVStore(num_nodes=num_nodes, base_port=base_port)
+    app.state.backend = RedisBackend(store)
+    if store.near_cache is not None:
+        metrics.add_collector(store.near_cache.collect_metrics)
+    if store.single_flight is not None:
+        metrics.add_collector(store.single_flight.collect_metrics)
+
+# Liveness probe used by the router's health checks
+@app.get('/_health')
+async def health_app():
+    return JSONResponse({"status": "ok"})
+
+# Replication role, offset and links
+@app.get('/_replication')
+async def replication_app():
+    return JSONResponse(replication.status())
+
+# Latency histograms and server counters in the Prometheus text format
+@app.get('/metrics')
+async def metrics_app():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Hottest keys per operation, as in the wsgi app; the Redis backend records nothing here
+@app.get('/_hotkeys')
+async def hot_keys_app(request: Request):
+    params = request.query_params
+    try:
+        count = int(params.get('count', hot_keys.capacity))
+        report = hot_keys.report(params.getlist('op') or OPS, count, params.get('by', 'requests'), params.getlist('key'))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return JSONResponse(report)
+
+# Run a batch on the backend and turn its per-key results into a response, as run_batch in the wsgi app
+async def run_batch(operation, run, args, to_result):
+    try:
+        results = await run(args)
+    except DeadlineExceeded:
+        log_operation(operation, None, 'timeout')
+        return JSONResponse({"error": f"Timeout running {operation}"}, status_code=504)
+    except PoolSaturated:
+        log_operation(operation, None, 'overloaded')
+        return JSONResponse({"error": "Server overloaded"}, status_code=503)
+    except ReadOnlyReplica:
+        log_operation(operation, None, 'read-only')
+        return JSONResponse({"error": "Read-only replica"}, status_code=403)
+    log_operation(operation, None, f'{len(results)} keys')
+    started = next(serialize_clock)()
+    response = JSONResponse({"results": [to_result(key, res) for key, res in results]})
+    if started:
+        metrics.phase_end("serialize", started)
+    return response
+
+# Parse a batch request's body, as the wsgi app does
+async def read_batch(request, require_value):
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip()
+    return parse_batch(await request.body(), mimetype, require_value)
+
+# Get the values for many keys
+@app.post('/_mget')
+@metrics.timed('mget')
+async def mget_app(request: Request):
+    try:
+        ops = await read_batch(request, require_value=False)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return await run_batch('mget', app.state.backend.mget, [op['key'] for op in ops],
+                           lambda key, value: {"key": key, "status": 404} if value is None
+                           else {"key": key, "status": 200, "value": to_json(value)})
+
+# Set many key-value pairs
+@app.post('/_mset')
+@metrics.timed('mset')
+async def mset_app(request: Request):
+    try:
+        ops = await read_batch(request, require_value=True)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return await run_batch('mset', app.state.backend.mset, [(op['key'], op['value'], op['deadline']) for op in ops],
+                           lambda key, version: {"key": key, "status": 200, "version": version})
+
+# Delete many keys
+@app.post('/_mdel')
+@metrics.timed('mdel')
+async def mdel_app(request: Request):
+    try:
+        ops = await read_batch(request, require_value=False)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return await run_batch('mdel', app.state.backend.mdel, [op['key'] for op in ops],
+                           lambda key, res: {"key": key, "status": 404 if res == -1 else 200})
+
+# Scan keys by prefix and optional glob, one page at a time
+@app.get('/_scan')
+@metrics.timed('scan')
+async def scan_app(request: Request):
+    params = request.query_params
+    prefix = params.get('prefix', '')
+    # expiry=1 adds each key's deadline (unix time, or null) to its item
+    with_expiry = params.get('expiry') == '1'
+    try:
+        count = int(params.get('count', 10))
+    except ValueError:
+        return JSONResponse({"error": "'count' must be an integer"}, status_code=400)
+    try:
+        next_cursor, items = await app.state.backend.scan(prefix, params.get('cursor', ''), count,
+                                                          params.get('match'), with_expiry)
+    except NotImplementedError as e:
+        return JSONResponse({"error": str(e)}, status_code=501)
+    log_operation('scan', prefix, f'{len(items)} keys')
+    items = [(key, to_json(value), *rest) for key, value, *rest in items]
+    return JSONResponse({"cursor": next_cursor, "items": items})
+
+# Increment a number or append to a value in place: {"incr": n} or {"append": item}, as in the wsgi app
+async def update_value_app(key, data):
+    if 'incr' in data:
+        operation, delta = 'incr', data['incr']
+        if isinstance(delta, bool) or not isinstance(delta, (int, float)):
+            return JSONResponse({"error": "'incr' must be a number"}, status_code=400)
+        update, arg, field = app.state.backend.incr, delta, 'value'
+    else:
+        try:
+            arg = from_json(data['append'])
+        except ValueError:
+            return JSONResponse({"error": "Invalid base64 in 'append'"}, status_code=400)
+        operation, update, field = 'append', app.state.backend.append, 'length'
+    try:
+        result, version = await update(key, arg)
+    except NotImplementedError as e:
+        return JSONResponse({"error": str(e)}, status_code=501)
+    except ValueError as e:
+        log_operation(operation, key, 'wrong type')
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except DeadlineExceeded:
+        log_operation(operation, key, 'timeout')
+        return JSONResponse({"error": f"Timeout running {operation}"}, status_code=504)
+    except PoolSaturated:
+        log_operation(operation, key, 'overloaded')
+        return JSONResponse({"error": "Server overloaded"}, status_code=503)
+    except ReadOnlyReplica:
+        log_operation(operation, key, 'read-only')
+        return JSONResponse({"error": "Read-only replica"}, status_code=403)
+    log_operation(operation, key, 'success')
+    return JSONResponse({field: result, "version": version})
+
+# Set a key-value pair
+@app.post('/{key}')
+@metrics.timed('set')
+async def set_value_app(key: str, request: Request):
+    # An application/octet-stream body is stored as the raw bytes, TTL and condition options in the query string
+    if request.headers.get('content-type', '').startswith('application/octet-stream'):
+        value = await request.body()
+        try:
+            data = query_options(request.query_params)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+    else:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and ('incr' in data or 'append' in data):
+            return await update_value_app(key, data)
+        if not isinstance(data, dict) or 'value' not in data:
+            return JSONResponse({"error": "Missing 'value' in request body"}, status_code=400)
+        try:
+            value = from_json(data['value'])
+        except ValueError:
+            return JSONResponse({"error": "Invalid base64 in 'value'"}, status_code=400)
+    try:
+        deadline = expire_at(data.get('ex'), data.get('px'), data.get('exat'), data.get('pxat'))
+        conditions = parse_conditions(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    try:
+        if conditions:
+            version = await app.state.backend.conditional_set(key, value, deadline, **conditions)
+        else:
+            version = await app.state.backend.set(key, value, deadline)
+    except NotImplementedError as e:
+        return JSONResponse({"error": str(e)}, status_code=501)
+    except ConditionFailed as e:
+        log_operation('set', key, 'condition failed')
+        return JSONResponse({"error": "Condition failed", "version": e.version}, status_code=412)
+    except DeadlineExceeded:
+        log_operation('set', key, 'timeout')
+        return JSONResponse({"error": "Timeout setting value"}, status_code=504)
+    except PoolSaturated:
+        log_operation('set', key, 'overloaded')
+        return JSONResponse({"error": "Server overloaded"}, status_code=503)
+    except ReadOnlyReplica:
+        log_operation('set', key, 'read-only')
+        return JSONResponse({"error": "Read-only replica"}, status_code=403)
+    log_operation('set', key, 'success')
+    if version is None:
+        return JSONResponse({"message": f"Value for key '{key}' set successfully."})
+    return JSONResponse({"message": f"Value for key '{key}' set successfully.", "version": version})
+
+# Serve a bytes value, or the slice a Range header asks for, without copying it; the version, if any, is the ETag
+def bytes_response(value, version, range_header):
+    try:
+        requested = byte_range(range_header, len(value))
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{len(value)}"})
+    etag = {} if version is None else {"ETag": f'"{version}"'}
+    if requested is None:
+        return Response(value, media_type='application/octet-stream', headers={"Accept-Ranges": "bytes", **etag})
+    start, stop = requested
+    return Response(memoryview(value)[start:stop], status_code=206, media_type='application/octet-stream',
+                    headers={"Content-Range": f"bytes {start}-{stop - 1}/{len(value)}", **etag})
+
+# Get the value for a key
+@app.get('/{key}')
+@metrics.timed('get')
+async def get_value_app(key: str, request: Request):
+    res, version = await app.state.backend.get(key)
+    log_operation('get', key, 'success' if res is not None else 'not found')
+    if res is None:
+        return JSONResponse({"error": f"Key '{key}' not found"}, status_code=404)
+    # As in the wsgi app, bytes are served raw unless the Accept header names JSON
+    if isinstance(res, bytes) and 'application/json' not in request.headers.get('accept', ''):
+        return bytes_response(res, version, request.headers.get('range'))
+    started = next(serialize_clock)()
+    body = {"value": to_json(res)}
+    if version is not None:  # The redis backend keeps no versions
+        body["version"] = version
+    response = JSONResponse(body)
+    if started:
+        metrics.phase_end("serialize", started)
+    return response
+
+# Delete a key
+@app.delete('/{key}')
+@metrics.timed('delete')
+async def delete_value_app(key: str):
+    try:
+        res = await app.state.backend.delete(key)
+    except DeadlineExceeded:
+        log_operation('delete', key, 'timeout')
+        return JSONResponse({"error": "Timeout deleting key"}, status_code=504)
+    except PoolSaturated:
+        log_operation('delete', key, 'overloaded')
+        return JSONResponse({"error": "Server overloaded"}, status_code=503)
+    except ReadOnlyReplica:
+        log_operation('delete', key, 'read-only')
+        return JSONResponse({"error": "Read-only replica"}, status_code=403)
+    if res == -1:
+        log_operation('delete', key, 'did not exist')
+        return JSONResponse({"message": f"Key '{key}' did not exist"}, status_code=404)
+    log_operation('delete', key, 'success')
+    return JSONResponse({"message": f"Key '{key}' deleted successfully."})
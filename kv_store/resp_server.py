@@ -0,0 +1,411 @@
+# resp_server.py
+# A TCP front end speaking a subset of the Redis protocol (RESP2, and RESP3 after HELLO 3) over the trie store
+import asyncio
+import json
+import math
+import threading
+import time
+from trie_kv_store import kv_store
+from get_value import get_value
+from set_value import set_value
+from delete_key import delete_key
+from batch_ops import mget_values, mset_values, mdel_keys
+from atomic_ops import conditional_set, incr, append, ConditionFailed
+from scan_keys import MAX_SCAN_COUNT
+from expiry import expire_at
+from worker_pool import pool, PoolSaturated
+from wal import wal
+from replication import replication, ReadOnlyReplica
+
+class ProtocolError(Exception):
+    """Raised when a client sends bytes that are not valid RESP"""
+
+
+class CommandError(Exception):
+    """Raised by a command to send an -ERR reply"""
+
+
+def parse_command(buf, pos):
+    """
+    Parse one command from buf starting at pos
+
+    Returns:
+        tuple: (args, next_pos), or (None, pos) if the command is not complete yet
+    """
+    if buf[pos] != ord('*'):
+        # Inline command, as typed into telnet / redis-cli --no-raw
+        end = buf.find(b"\r\n", pos)
+        if end < 0:
+            return None, pos
+        return bytes(buf[pos:end]).split(), end + 2
+
+    end = buf.find(b"\r\n", pos)
+    if end < 0:
+        return None, pos
+    try:
+        count = int(buf[pos + 1:end])
+    except ValueError:
+        raise ProtocolError("invalid multibulk length")
+    cur = end + 2
+    args = []
+    for _ in range(count):
+        if cur >= len(buf):
+            return None, pos
+        if buf[cur] != ord('$'):
+            raise ProtocolError("expected '$'")
+        end = buf.find(b"\r\n", cur)
+        if end < 0:
+            return None, pos
+        try:
+            length = int(buf[cur + 1:end])
+        except ValueError:
+            raise ProtocolError("invalid bulk length")
+        start = end + 2
+        if start + length + 2 > len(buf):
+            return None, pos
+        args.append(bytes(buf[start:start + length]))
+        cur = start + length + 2
+    return args, cur
+
+
+# Null bulk string; RESP3 connections get the dedicated null type instead
+NULL = b"$-1\r\n"
+NULL_RESP3 = b"_\r\n"
+
+
+def encode(value, null=NULL):
+    """Encode a reply; str/bytes become bulk strings, so status replies are built with simple()"""
+    if value is None:
+        return null
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item, null) for item in value)
+    if isinstance(value, str):
+        # Undoes decode(), so keys and values that were not UTF-8 go back out byte for byte
+        value = value.encode("utf-8", "surrogateescape")
+    elif not isinstance(value, bytes):
+        # Values written over HTTP can be any JSON type
+        value = json.dumps(value).encode()
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def bulk(value):
+    """A stored value as GET replies with it: a bulk string, never an integer, so numbers and bools written over HTTP come back as their JSON text"""
+    if value is None or isinstance(value, (str, bytes)):
+        return value
+    return json.dumps(value)
+
+
+def simple(text):
+    return b"+" + text.encode() + b"\r\n"
+
+
+def error(text):
+    return b"-ERR " + text.encode() + b"\r\n"
+
+
+def decode(arg):
+    # Keys stay str; bytes that are not UTF-8 are kept as lone surrogates, so no key is lost
+    return arg.decode("utf-8", "surrogateescape")
+
+
+def value_of(arg):
+    """A value argument as it is stored: the text if it was UTF-8, else the raw bytes"""
+    if arg.isascii():
+        return arg
+    try:
+        arg.encode()
+    except UnicodeEncodeError:
+        return arg.encode("utf-8", "surrogateescape")
+    return arg
+
+
+def integer(arg):
+    try:
+        return int(arg)
+    except ValueError:
+        raise CommandError("value is not an integer or out of range")
+
+
+def cursor_for(key):
+    """
+    A SCAN cursor holding the key to resume after, so any connection can continue the scan
+
+    RESP cursors are integers, so the key's bytes are read as one big-endian
+    number behind a 0x01 byte that keeps leading zero bytes; 0 starts a scan.
+    """
+    return int.from_bytes(b"\x01" + key.encode("utf-8", "surrogateescape"), "big")
+
+
+def key_for(cursor):
+    """The key a cursor from cursor_for resumes after; raises CommandError for a cursor it did not make"""
+    try:
+        cursor = int(cursor)
+        data = cursor.to_bytes((cursor.bit_length() + 7) // 8, "big")
+    except (ValueError, OverflowError):
+        raise CommandError("invalid cursor")
+    if data[:1] != b"\x01":
+        raise CommandError("invalid cursor")
+    return data[1:].decode("utf-8", "surrogateescape")
+
+
+def remaining_ms(key):
+    """Milliseconds until key expires; -1 if it has no TTL, -2 if it does not exist, as in Redis"""
+    if kv_store.get(key) == "-1":
+        return -2
+    _, deadline = kv_store.get_entry(key)
+    if deadline is None:
+        return -1
+    return max(0, math.ceil((deadline - time.time()) * 1000))
+
+
+class Connection:
+    def __init__(self):
+        """Per-connection state: the protocol version HELLO picked"""
+        self.protocol = 2
+        self.null = NULL
+
+    def execute(self, args):
+        """Run one command and return its encoded reply"""
+        if not args:
+            return error("empty command")
+        name = args[0].upper().decode(errors="replace")
+        handler = COMMANDS.get(name)
+        if handler is None:
+            return error(f"unknown command '{name}'")
+        try:
+            return handler(self, [decode(arg) for arg in args[1:]])
+        except CommandError as e:
+            return error(str(e))
+        except ReadOnlyReplica:
+            return b"-READONLY You can't write against a read only replica.\r\n"
+        except ValueError as e:
+            return error(str(e))
+
+    def cmd_ping(self, args):
+        return simple("PONG") if not args else encode(args[0])
+
+    def cmd_get(self, args):
+        if len(args) != 1:
+            raise CommandError("wrong number of arguments for 'get' command")
+        return encode(bulk(get_value(args[0])), self.null)
+
+    def cmd_set(self, args):
+        if len(args) not in (2, 4):
+            raise CommandError("syntax error")
+        deadline = None
+        if len(args) == 4:
+            option = args[2].lower()
+            if option not in ("ex", "px", "exat", "pxat"):
+                raise CommandError("syntax error")
+            try:
+                deadline = expire_at(**{option: int(args[3])})
+            except ValueError:
+                raise CommandError("invalid expire time in 'set' command")
+        set_value(args[0], value_of(args[1]), deadline)
+        return simple("OK")
+
+    def cmd_setnx(self, args):
+        if len(args) != 2:
+            raise CommandError("wrong number of arguments for 'setnx' command")
+        try:
+            conditional_set(args[0], value_of(args[1]), nx=True)
+        except ConditionFailed:
+            return encode(0)
+        return encode(1)
+
+    def _incr(self, key, delta):
+        try:
+            return encode(incr(key, delta)[0])
+        except ValueError:
+            raise CommandError("value is not an integer or out of range")
+
+    def cmd_incr(self, args):
+        if len(args) != 1:
+            raise CommandError("wrong number of arguments for 'incr' command")
+        return self._incr(args[0], 1)
+
+    def cmd_decr(self, args):
+        if len(args) != 1:
+            raise CommandError("wrong number of arguments for 'decr' command")
+        return self._incr(args[0], -1)
+
+    def cmd_incrby(self, args):
+        if len(args) != 2:
+            raise CommandError("wrong number of arguments for 'incrby' command")
+        return self._incr(args[0], integer(args[1]))
+
+    def cmd_decrby(self, args):
+        if len(args) != 2:
+            raise CommandError("wrong number of arguments for 'decrby' command")
+        return self._incr(args[0], -integer(args[1]))
+
+    def cmd_append(self, args):
+        if len(args) != 2:
+            raise CommandError("wrong number of arguments for 'append' command")
+        try:
+            return encode(append(args[0], value_of(args[1]), mix_bytes=True)[0])
+        except ValueError:
+            return b"-WRONGTYPE Operation against a key holding the wrong kind of value\r\n"
+
+    def cmd_pttl(self, args):
+        if len(args) != 1:
+            raise CommandError("wrong number of arguments for 'pttl' command")
+        return encode(remaining_ms(args[0]))
+
+    def cmd_ttl(self, args):
+        if len(args) != 1:
+            raise CommandError("wrong number of arguments for 'ttl' command")
+        ms = remaining_ms(args[0])
+        return encode(ms if ms < 0 else (ms + 500) // 1000)
+
+    def cmd_del(self, args):
+        if not args:
+            raise CommandError("wrong number of arguments for 'del' command")
+        if len(args) == 1:
+            return encode(1 if delete_key(args[0]) == 1 else 0)
+        return encode(sum(1 for _, res in mdel_keys(args) if res == 1))
+
+    def cmd_mget(self, args):
+        if not args:
+            raise CommandError("wrong number of arguments for 'mget' command")
+        return encode([bulk(value) for _, value in mget_values(args)], self.null)
+
+    def cmd_mset(self, args):
+        if not args or len(args) % 2:
+            raise CommandError("wrong number of arguments for 'mset' command")
+        mset_values([(key, value_of(value), None) for key, value in zip(args[::2], args[1::2])])
+        return simple("OK")
+
+    def cmd_scan(self, args):
+        if not args:
+            raise CommandError("wrong number of arguments for 'scan' command")
+        pattern = None
+        count = 10
+        options = args[1:]
+        if len(options) % 2:
+            raise CommandError("syntax error")
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == "MATCH":
+                pattern = value
+            elif option.upper() == "COUNT":
+                count = integer(value)
+            else:
+                raise CommandError("syntax error")
+
+        resume_after = "" if args[0] == "0" else key_for(args[0])
+        count = max(1, min(count, MAX_SCAN_COUNT))
+        next_key, items = kv_store.scan("", resume_after, count, pattern)
+        next_cursor = cursor_for(next_key) if next_key else 0
+        return encode([str(next_cursor), [key for key, _ in items]])
+
+    def cmd_hello(self, args):
+        # Newer clients open with HELLO 3; replies stay RESP2-shaped apart from this one and nulls
+        if args:
+            try:
+                protover = int(args[0])
+            except ValueError:
+                raise CommandError("Protocol version is not an integer or out of range")
+            if protover not in (2, 3):
+                return b"-NOPROTO unsupported protocol version\r\n"
+            self.protocol = protover
+            self.null = NULL_RESP3 if protover == 3 else NULL
+        info = ["server", "otkv", "version", "1.0.0", "proto", self.protocol,
+                "id", id(self), "mode", "standalone", "role", "replica" if replication.read_only else "master", "modules", []]
+        if self.protocol == 3:
+            return b"%%%d\r\n" % (len(info) // 2) + b"".join(encode(item) for item in info)
+        return encode(info)
+
+    def cmd_ok(self, args):
+        # CLIENT SETINFO, SELECT 0 and friends that clients send on connect
+        return simple("OK")
+
+    def cmd_command(self, args):
+        return encode([])
+
+
+COMMANDS = {
+    "PING": Connection.cmd_ping,
+    "GET": Connection.cmd_get,
+    "SET": Connection.cmd_set,
+    "SETNX": Connection.cmd_setnx,
+    "INCR": Connection.cmd_incr,
+    "INCRBY": Connection.cmd_incrby,
+    "DECR": Connection.cmd_decr,
+    "DECRBY": Connection.cmd_decrby,
+    "APPEND": Connection.cmd_append,
+    "TTL": Connection.cmd_ttl,
+    "PTTL": Connection.cmd_pttl,
+    "DEL": Connection.cmd_del,
+    "MGET": Connection.cmd_mget,
+    "MSET": Connection.cmd_mset,
+    "SCAN": Connection.cmd_scan,
+    "HELLO": Connection.cmd_hello,
+    "CLIENT": Connection.cmd_ok,
+    "SELECT": Connection.cmd_ok,
+    "COMMAND": Connection.cmd_command,
+}
+
+
+def execute_pipeline(connection, commands):
+    # Every command already parsed from the socket runs back to back, then one write answers them all
+    return b"".join(connection.execute(args) for args in commands)
+
+
+async def handle_client(reader, writer):
+    connection = Connection()
+    buf = bytearray()
+    # Without per-write fsync nothing here blocks, so pipelines run on the event loop itself
+    inline = not (wal.enabled and wal.fsync_policy == "always")
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            buf += data
+
+            commands = []
+            pos = 0
+            try:
+                while pos < len(buf):
+                    args, pos_after = parse_command(buf, pos)
+                    if args is None:
+                        break
+                    commands.append(args)
+                    pos = pos_after
+            except ProtocolError as e:
+                writer.write(error(f"Protocol error: {e}"))
+                break
+            del buf[:pos]
+
+            if commands:
+                if inline:
+                    reply = execute_pipeline(connection, commands)
+                else:
+                    try:
+                        reply = await asyncio.wrap_future(pool.submit(execute_pipeline, connection, commands))
+                    except PoolSaturated:
+                        # One reply per command keeps the client's pipeline in step; none of them ran
+                        reply = error("server overloaded") * len(commands)
+                writer.write(reply)
+                await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def start_resp_server(host='0.0.0.0', port=7379):
+    """Serve RESP on a background thread with its own event loop"""
+    thread = threading.Thread(target=lambda: asyncio.run(serve(host, port)), name="resp-server", daemon=True)
+    thread.start()
+    return thread
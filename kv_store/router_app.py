@@ -0,0 +1,762 @@
+# router_app.py
+# Routing proxy: forwards the /<key> API to the node that owns each key on a consistent-hash ring
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_right
+from collections import deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, quote, parse_qs
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+from uhashring import HashRing
+
+# Virtual nodes per unit of weight on the ketama ring
+VNODES = int(os.getenv("KV_ROUTER_VNODES", "40"))
+# Idle keep-alive connections kept per node, and the cap on connections in use per node
+POOL_SIZE = int(os.getenv("KV_ROUTER_POOL_SIZE", "32"))
+MAX_CONNECTIONS = int(os.getenv("KV_ROUTER_MAX_CONNECTIONS", "128"))
+# Seconds an upstream request may take, including waiting for a connection
+UPSTREAM_TIMEOUT = float(os.getenv("KV_ROUTER_TIMEOUT", "2.0"))
+# Health checks: period, per-check timeout, and consecutive failures before a node leaves the ring
+HEALTH_INTERVAL = float(os.getenv("KV_ROUTER_HEALTH_INTERVAL", "1.0"))
+HEALTH_TIMEOUT = float(os.getenv("KV_ROUTER_HEALTH_TIMEOUT", "0.5"))
+FAIL_THRESHOLD = int(os.getenv("KV_ROUTER_FAIL_THRESHOLD", "2"))
+# Keys scanned per page when moving keys after a membership change
+MIGRATION_BATCH = int(os.getenv("KV_ROUTER_MIGRATION_BATCH", "500"))
+# Hot keys: seconds between polls of each node's /_hotkeys (0 disables), keys asked for per node,
+# and the share of a node's GETs that makes a key hot
+HOT_INTERVAL = float(os.getenv("KV_ROUTER_HOT_INTERVAL", "5.0"))
+HOT_COUNT = int(os.getenv("KV_ROUTER_HOT_COUNT", "16"))
+HOT_SHARE = float(os.getenv("KV_ROUTER_HOT_SHARE", "0.02"))
+# Milliseconds the router serves a hot key's GET response from its own copy; 0 disables the cache
+HOT_CACHE_MS = float(os.getenv("KV_ROUTER_HOT_CACHE_MS", "0"))
+
+# Size of the ketama hash space
+HASH_SPACE = 2 ** 32
+
+# Range and the If-* preconditions: they make a GET's answer depend on more than the key,
+# so such GETs skip the hot-key cache
+CONDITIONAL_HEADERS = ("range", "if-match", "if-none-match", "if-range", "if-modified-since", "if-unmodified-since")
+# Request headers passed on to nodes, and response headers passed back to clients;
+# the rest of a node's answer is its status, content type and body
+FORWARDED_REQUEST_HEADERS = ("accept",) + CONDITIONAL_HEADERS
+FORWARDED_RESPONSE_HEADERS = ("etag", "accept-ranges", "content-range")
+
+# POST /<key> options whose outcome depends on the key's current value
+READS_CURRENT = ("incr", "append", "nx", "if_version", "if_value")
+
+
+class UpstreamError(Exception):
+    """Raised when a node cannot be reached or breaks the connection mid-request"""
+
+
+class ConnectionDropped(ConnectionError):
+    """Raised when a node closes a connection before sending any part of the response"""
+
+
+class Upstream:
+    def __init__(self, url, weight=1):
+        """
+        A node behind the router, with a pool of persistent HTTP/1.1 connections
+
+        Args:
+            url (str): Base URL of the node, e.g. http://127.0.0.1:8080
+            weight (int): Relative share of the ring
+        """
+        parts = urlsplit(url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.weight = weight
+        self.healthy = True
+        self.failures = 0
+        self.replicas = []  # Read-only replicas of this node, as Upstreams
+        self.next_read = 0
+        self.idle = deque()  # (reader, writer) pairs ready for reuse
+        self.slots = asyncio.Semaphore(MAX_CONNECTIONS)
+
+    async def request(self, method, path, body=b"", content_type=None, headers=None):
+        """
+        Send one request over a pooled connection
+
+        Args:
+            headers (dict): Extra request headers, such as FORWARDED_REQUEST_HEADERS
+
+        Returns:
+            tuple: (status, content_type, body bytes, {name: value} of FORWARDED_RESPONSE_HEADERS present)
+
+        Raises:
+            UpstreamError: If the node could not be reached or answered
+        """
+        async with self.slots:
+            # A pooled connection may have been closed by the node; that costs one retry on a fresh one
+            for attempt in range(2):
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await self._connect()
+                try:
+                    status, response_type, response, response_headers, keep_alive = await self._exchange(
+                        reader, writer, method, path, body, content_type, headers)
+                except ConnectionDropped as e:
+                    writer.close()
+                    # An idle connection the node had already closed: the request never ran, so it can be re-sent
+                    if reused and attempt == 0:
+                        continue
+                    raise UpstreamError(f"{self.url}: {e!r}")
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+                    # Part of a response arrived, so the node may have applied the request; writes
+                    # such as increments and appends are not idempotent, so it is never re-sent
+                    writer.close()
+                    raise UpstreamError(f"{self.url}: {e!r}")
+                except asyncio.CancelledError:
+                    # Timed out mid-exchange: the connection's state is unknown, so it cannot go back in the pool
+                    writer.close()
+                    raise
+                if keep_alive and len(self.idle) < POOL_SIZE:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, response_type, response, response_headers
+
+    async def _connect(self):
+        try:
+            return await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            raise UpstreamError(f"{self.url}: {e!r}")
+
+    async def _exchange(self, reader, writer, method, path, body, content_type, headers):
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Length: {len(body)}\r\n"
+        if content_type:
+            head += f"Content-Type: {content_type}\r\n"
+        if headers:
+            head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        # The first byte is read on its own, so a connection dropped before any of the response
+        # arrived can be told apart from one that broke partway through it
+        try:
+            writer.write(head.encode() + b"\r\n" + body)
+            await writer.drain()
+            first = await reader.read(1)
+        except (ConnectionResetError, BrokenPipeError) as e:
+            raise ConnectionDropped(f"connection closed: {e!r}")
+        if not first:
+            raise ConnectionDropped("connection closed")
+        status_line = first + await reader.readline()
+        status = int(status_line.split()[1])
+        length = None
+        response_type = None
+        response_headers = {}
+        keep_alive = True
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if not line.endswith(b"\n"):
+                raise ConnectionResetError("connection closed mid-response")
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            if name == "content-length":
+                length = int(value)
+            elif name == "content-type":
+                response_type = value
+            elif name == "connection" and value.lower() == "close":
+                keep_alive = False
+            elif name in FORWARDED_RESPONSE_HEADERS:
+                response_headers[name] = value
+        if length is None:
+            # No length: the body runs until the node closes the connection
+            return status, response_type, await reader.read(), response_headers, False
+        return status, response_type, await reader.readexactly(length), response_headers, keep_alive
+
+    def reader(self):
+        """Pick the next healthy copy for a read, round-robin over this node and its replicas"""
+        copies = [self] + [replica for replica in self.replicas if replica.healthy]
+        self.next_read += 1
+        return copies[self.next_read % len(copies)]
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+        for replica in self.replicas:
+            replica.close()
+
+
+class HotKeys:
+    def __init__(self, ttl):
+        """
+        The keys the nodes report as hot, and short-lived copies of their GET responses
+
+        A key is hot when it takes at least HOT_SHARE of its node's sampled
+        GETs. With a ttl, the router answers GETs for hot keys from a copy
+        at most ttl seconds old, so a key that would melt its node is read
+        from the node a few times per second instead. Copies are kept per
+        Accept header, since it picks between a bytes value and its JSON
+        form; Range and conditional GETs always go to the node. Writes and
+        deletes through this router drop the copies; writes that reach the
+        node some other way show up once the copies expire.
+
+        Args:
+            ttl (float): Seconds a copy is served for; 0 only tracks hot keys
+        """
+        self.ttl = ttl
+        self.keys = {}     # Hot key -> {"key", "node", "requests", "share"}
+        self.copies = {}   # Hot key -> {Accept header: (expires, status, content type, body, headers)}
+        self.writes = {}   # Hot key -> writes seen, so a read that overlapped a write is never kept
+        self.polled = None
+
+    def update(self, hot):
+        self.keys = hot
+        self.polled = time.time()
+        self.copies = {key: copy for key, copy in self.copies.items() if key in hot}
+        self.writes = {key: count for key, count in self.writes.items() if key in hot}
+
+    def caching(self, key):
+        return self.ttl > 0 and key in self.keys
+
+    def lookup(self, key, accept):
+        copy = self.copies.get(key, {}).get(accept)
+        if copy is None or copy[0] < time.monotonic():
+            return None
+        _, status, response_type, body, headers = copy
+        return Response(body, status_code=status, media_type=response_type, headers=headers)
+
+    def token(self, key):
+        return self.writes.get(key, 0)
+
+    def keep(self, key, accept, token, response):
+        # Only successful reads, and only if no write went through while this one was in flight
+        if response.status_code == 200 and self.writes.get(key, 0) == token:
+            headers = {name: response.headers[name] for name in FORWARDED_RESPONSE_HEADERS if name in response.headers}
+            self.copies.setdefault(key, {})[accept] = (time.monotonic() + self.ttl, response.status_code,
+                                                       response.media_type, response.body, headers)
+
+    def invalidate(self, key):
+        if key in self.keys:
+            self.writes[key] = self.writes.get(key, 0) + 1
+            self.copies.pop(key, None)
+
+    def status(self):
+        return {"polled": self.polled, "share": HOT_SHARE, "cache_ms": self.ttl * 1000,
+                "keys": sorted(self.keys.values(), key=lambda hot: hot["requests"], reverse=True)}
+
+
+class MigrationInProgress(Exception):
+    """Raised when membership changes while keys are still moving from the previous change"""
+
+
+class Fence:
+    def __init__(self):
+        """
+        Shared/exclusive lock over one source node's moving keys
+
+        Requests for moving keys hold it shared; the mover holds it alone
+        while it copies one page. Requests that queued up behind a page go
+        in before the mover takes the next one, and requests that arrive
+        after the mover asked wait for it, so neither side starves.
+        """
+        self.shared = 0
+        self.waiting = 0
+        self.exclusive = False
+        self.changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def share(self):
+        async with self.changed:
+            self.waiting += 1
+            await self.changed.wait_for(lambda: not self.exclusive)
+            self.waiting -= 1
+            self.shared += 1
+            self.changed.notify_all()
+        try:
+            yield
+        finally:
+            async with self.changed:
+                self.shared -= 1
+                self.changed.notify_all()
+
+    @asynccontextmanager
+    async def exclude(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.waiting == 0)
+            self.exclusive = True
+            await self.changed.wait_for(lambda: self.shared == 0)
+        try:
+            yield
+        finally:
+            async with self.changed:
+                self.exclusive = False
+                self.changed.notify_all()
+
+
+def moved_ranges(old_ring, new_ring):
+    """
+    Hash ranges whose owner differs between two rings
+
+    Every point of either ring starts a range, so each ring has a single
+    owner across each range. A key belongs to the first point above its
+    hash, wrapping around to the first point.
+
+    Returns:
+        list: [(start, end, old owner, new owner), ...]; a range covers start <= hash < end,
+            and the last one wraps past the end of the hash space
+    """
+    rings = []
+    for ring in (old_ring, new_ring):
+        points = sorted(ring.get_points())
+        rings.append(([point for point, _ in points], [node for _, node in points]))
+    bounds = sorted({point for hashes, _ in rings for point in hashes})
+
+    ranges = []
+    for i, start in enumerate(bounds):
+        owners = [nodes[bisect_right(hashes, start) % len(hashes)] for hashes, nodes in rings]
+        if owners[0] != owners[1]:
+            ranges.append((start, bounds[(i + 1) % len(bounds)], owners[0], owners[1]))
+    return ranges
+
+
+class Migration:
+    def __init__(self, old_ring, sources, share):
+        """
+        A rebalance in progress: keys whose owner changed move from their old node to their new one
+
+        Each source (an old owner that lost hash ranges) is walked with
+        /_scan pages. The keys of a page that now belong elsewhere are
+        grouped by their new owner, copied with one /_mset per owner
+        (keeping their TTLs), and removed from the source with one /_mdel.
+        Until the move finishes, requests for moving keys hold the source's
+        fence shared. A GET that misses on the new owner falls back to the
+        old one. POST and DELETE also delete the key from the old owner, so
+        the mover can never copy a stale value over a newer write. Increments,
+        appends and conditional sets first move their key themselves, so
+        they apply to its current value.
+
+        Args:
+            old_ring (HashRing): Ring before the change
+            sources (dict): Base URL -> Upstream of each old owner that loses keys
+            share (float): Fraction of the hash space that changed owner
+        """
+        self.old_ring = old_ring
+        self.sources = sources
+        self.share = share
+        self.fences = {url: Fence() for url in sources}
+        self.moved = 0
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+        self.task = None
+
+    def source_for(self, key, owner):
+        """Return the Upstream key is moving away from, or None if owner already held it"""
+        old = self.old_ring.get_node(key)
+        if old == owner.url:
+            return None
+        return self.sources.get(old)
+
+    async def run(self, router):
+        try:
+            for url, source in self.sources.items():
+                cursor = ""
+                while True:
+                    async with self.fences[url].exclude():
+                        cursor = await self._move_page(router, source, cursor)
+                    if not cursor:
+                        break
+        except (UpstreamError, asyncio.TimeoutError, ValueError, KeyError) as e:
+            # Keys not moved yet stay on their old node; reads for them miss until membership changes again
+            self.error = repr(e)
+            print(f"Rebalance stopped after moving {self.moved} keys: {e!r}")
+        else:
+            print(f"Rebalance moved {self.moved} keys in {time.time() - self.started:.2f}s")
+        finally:
+            self.finished = time.time()
+            router.finish_migration(self)
+
+    async def _move_page(self, router, source, cursor):
+        page = json.loads(await self._call(source, "GET",
+                                           f"/_scan?count={MIGRATION_BATCH}&expiry=1&cursor={quote(cursor, safe='')}"))
+        batches = {}  # New owner -> ops
+        for key, value, deadline in page["items"]:
+            owner = router.node_for(key)
+            if owner is None or owner.url == source.url:
+                continue
+            op = {"key": key, "value": value}
+            if deadline is not None:
+                op["exat"] = deadline
+            batches.setdefault(owner, []).append(op)
+
+        moved = []
+        for owner, ops in batches.items():
+            await self._call(owner, "POST", "/_mset", ops)
+            moved.extend(op["key"] for op in ops)
+        # Only after every copy landed, so a failed page leaves the keys where they were
+        if moved:
+            await self._call(source, "POST", "/_mdel", moved)
+        self.moved += len(moved)
+        return page["cursor"]
+
+    async def _call(self, upstream, method, path, body=None):
+        payload = b"" if body is None else json.dumps(body).encode()
+        status, _, response, _ = await asyncio.wait_for(
+            upstream.request(method, path, payload, "application/json" if body is not None else None),
+            UPSTREAM_TIMEOUT)
+        if status != 200:
+            raise UpstreamError(f"{upstream.url}{path.split('?')[0]} returned {status}")
+        return response
+
+    def status(self):
+        return {"sources": list(self.sources), "share": round(self.share, 4), "moved": self.moved, "started": self.started,
+                "finished": self.finished, "error": self.error}
+
+
+class Router:
+    def __init__(self, nodes, replicas=None):
+        """
+        Route keys to nodes on a ketama ring that only contains healthy nodes
+
+        Node names on the ring are the nodes' base URLs, so keys land where
+        a client-side HashRing over the same URLs (as in benchmark.py) would
+        put them. GETs rotate over a node and its healthy replicas, so they
+        may briefly read a value older than the node's.
+
+        Args:
+            nodes (dict): Base URL -> weight
+            replicas (dict): Base URL -> [replica base URL, ...]
+        """
+        self.upstreams = {url: Upstream(url, weight) for url, weight in nodes.items()}
+        for url, replica_urls in (replicas or {}).items():
+            if url in self.upstreams:
+                self.upstreams[url].replicas = [Upstream(replica_url) for replica_url in replica_urls]
+        self.ring = None
+        self.health_task = None
+        self.hot_task = None
+        self.hot = HotKeys(HOT_CACHE_MS / 1000)
+        self.migration = None       # The rebalance in progress, if any
+        self.last_migration = None
+        self._rebuild()
+
+    def _rebuild(self):
+        healthy = {url: {"weight": up.weight} for url, up in self.upstreams.items() if up.healthy}
+        self.ring = HashRing(healthy, hash_fn="ketama", vnodes=VNODES) if healthy else None
+
+    def node_for(self, key):
+        """Return the Upstream that owns key, or None if no node is healthy"""
+        if self.ring is None:
+            return None
+        return self.upstreams[self.ring.get_node(key)]
+
+    def add_node(self, url, weight=1):
+        """
+        Add a node, or change a node's weight, then move the keys whose owner changed
+
+        Raises:
+            MigrationInProgress: If keys from the previous change are still moving
+        """
+        if self.migration is not None:
+            raise MigrationInProgress()
+        before = dict(self.upstreams)
+        upstream = self.upstreams.get(url)
+        if upstream is None:
+            self.upstreams[url] = Upstream(url, weight)
+        else:
+            upstream.weight = weight
+        self._rebalance(before)
+
+    def remove_node(self, url):
+        """
+        Remove a node after moving its keys to the nodes that now own them
+
+        Raises:
+            MigrationInProgress: If keys from the previous change are still moving
+        """
+        if self.migration is not None:
+            raise MigrationInProgress()
+        if url not in self.upstreams:
+            return False
+        before = dict(self.upstreams)
+        self.upstreams.pop(url)
+        self._rebalance(before)
+        return True
+
+    def _rebalance(self, before):
+        # Swap in the new ring, and start moving keys if any hash ranges changed owner
+        old_ring = self.ring
+        self._rebuild()
+        if old_ring is None or self.ring is None:
+            return
+        ranges = moved_ranges(old_ring, self.ring)
+        if not ranges:
+            return
+        share = sum((end - start) % HASH_SPACE for start, end, _, _ in ranges) / HASH_SPACE
+        sources = {url: before[url] for _, _, url, _ in ranges}
+        self.migration = Migration(old_ring, sources, share)
+        self.migration.task = asyncio.create_task(self.migration.run(self))
+
+    def finish_migration(self, migration):
+        self.migration = None
+        self.last_migration = migration
+        # Removed nodes stayed open as sources until now
+        for url, source in migration.sources.items():
+            if url not in self.upstreams:
+                source.close()
+
+    def mark(self, upstream, ok):
+        """Record a health check or request outcome; the ring changes only when a node flips state"""
+        if ok:
+            upstream.failures = 0
+            if not upstream.healthy:
+                upstream.healthy = True
+                print(f"Node {upstream.url} is back, routing to it again")
+                self._rebuild()
+            return
+        upstream.failures += 1
+        if upstream.healthy and upstream.failures >= FAIL_THRESHOLD:
+            upstream.healthy = False
+            upstream.close()
+            print(f"Node {upstream.url} failed {upstream.failures} checks, no longer routing to it")
+            self._rebuild()
+
+    async def check(self, upstream):
+        try:
+            status, _, _, _ = await asyncio.wait_for(upstream.request("GET", "/_health"), HEALTH_TIMEOUT)
+            ok = status == 200
+        except (UpstreamError, asyncio.TimeoutError):
+            ok = False
+        if upstream in self._checked():
+            self.mark(upstream, ok)
+
+    def _checked(self):
+        # Every configured node and replica
+        for upstream in list(self.upstreams.values()):
+            yield upstream
+            yield from upstream.replicas
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(up) for up in list(self._checked())))
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def poll_hot_keys(self, upstream):
+        """A node's hot keys by share of its GETs; nothing if it cannot say"""
+        try:
+            status, _, body, _ = await asyncio.wait_for(
+                upstream.request("GET", f"/_hotkeys?op=get&count={HOT_COUNT}"), HEALTH_TIMEOUT)
+            if status != 200:
+                return []
+            top = json.loads(body)["ops"]["get"]["top"]
+        except (UpstreamError, asyncio.TimeoutError, ValueError, KeyError):
+            return []
+        return [{"key": hot["key"], "node": upstream.url, "requests": hot["requests"], "share": hot["share"]}
+                for hot in top if hot["share"] >= HOT_SHARE]
+
+    async def hot_loop(self):
+        while True:
+            await asyncio.sleep(HOT_INTERVAL)
+            upstreams = [up for up in self.upstreams.values() if up.healthy]
+            reports = await asyncio.gather(*(self.poll_hot_keys(up) for up in upstreams))
+            self.hot.update({hot["key"]: hot for report in reports for hot in report})
+
+    def status(self):
+        return [{"url": url, "weight": up.weight, "healthy": up.healthy, "idle_connections": len(up.idle),
+                 "replicas": [{"url": replica.url, "healthy": replica.healthy} for replica in up.replicas]}
+                for url, up in self.upstreams.items()]
+
+    def start(self):
+        self.health_task = asyncio.create_task(self.health_loop())
+        if HOT_INTERVAL > 0:
+            self.hot_task = asyncio.create_task(self.hot_loop())
+
+    def stop(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+        if self.hot_task is not None:
+            self.hot_task.cancel()
+        if self.migration is not None:
+            self.migration.task.cancel()
+        for upstream in self.upstreams.values():
+            upstream.close()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Built inside the event loop, since the upstreams' semaphores belong to it
+    app.state.router = Router(app.state.nodes, app.state.replicas)
+    app.state.router.start()
+    yield
+    app.state.router.stop()
+
+app = FastAPI(lifespan=lifespan)
+app.state.nodes = {}
+app.state.replicas = {}
+
+# Set the nodes to route to (base URL -> weight) and their replicas; called by router.py before serving
+def configure(nodes, replicas=None):
+    app.state.nodes = nodes
+    app.state.replicas = replicas or {}
+
+# Ring membership, health, and the current (or last) rebalance
+@app.get('/_nodes')
+async def list_nodes():
+    return nodes_response()
+
+def nodes_response():
+    router = app.state.router
+    migration = router.migration or router.last_migration
+    return JSONResponse({"nodes": router.status(), "migration": migration.status() if migration else None})
+
+# Add a node (or change its weight) without restarting the router or its clients; keys move in the background
+@app.post('/_nodes')
+async def add_node(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('url'), str):
+        return JSONResponse({"error": "Expected {\"url\": ..., \"weight\": ...}"}, status_code=400)
+    weight = data.get('weight', 1)
+    if not isinstance(weight, int) or weight < 1:
+        return JSONResponse({"error": "'weight' must be a positive integer"}, status_code=400)
+    try:
+        app.state.router.add_node(data['url'].rstrip('/'), weight)
+    except MigrationInProgress:
+        return JSONResponse({"error": "Keys are still moving from the last change"}, status_code=409)
+    return nodes_response()
+
+@app.delete('/_nodes')
+async def remove_node(url: str):
+    try:
+        removed = app.state.router.remove_node(url.rstrip('/'))
+    except MigrationInProgress:
+        return JSONResponse({"error": "Keys are still moving from the last change"}, status_code=409)
+    if not removed:
+        return JSONResponse({"error": f"Node '{url}' is not configured"}, status_code=404)
+    return nodes_response()
+
+# Keys the nodes report as hot, merged at the last poll
+@app.get('/_hotkeys')
+async def hot_keys():
+    return JSONResponse(app.state.router.hot.status())
+
+# Forward the single-key API to the key's node; GETs may go to one of its replicas
+@app.api_route('/{key}', methods=['GET', 'POST', 'DELETE'])
+async def forward(key: str, request: Request):
+    router = app.state.router
+    # Hot keys may be answered from the router's own short-lived copy
+    hot = router.hot
+    if hot.caching(key):
+        if request.method != 'GET':
+            hot.invalidate(key)
+            response = await route(router, key, request)
+            hot.invalidate(key)
+            return response
+        # Range and conditional GETs get answers that depend on the request, so they are not cached
+        if not any(name in request.headers for name in CONDITIONAL_HEADERS):
+            accept = request.headers.get('accept')
+            response = hot.lookup(key, accept)
+            if response is None:
+                token = hot.token(key)
+                response = await route(router, key, request)
+                hot.keep(key, accept, token, response)
+            return response
+    return await route(router, key, request)
+
+async def route(router, key, request):
+    upstream = router.node_for(key)
+    if upstream is None:
+        return JSONResponse({"error": "No healthy nodes"}, status_code=503)
+    body = await request.body()
+    # Forward the path exactly as the client encoded it
+    path = request.scope.get('raw_path', b'').decode('latin-1') or request.url.path
+    # Octet-stream sets carry their TTL options in the query string
+    if request.url.query:
+        path += "?" + request.url.query
+    content_type = request.headers.get('content-type')
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    migration = router.migration
+    if migration is not None:
+        source = migration.source_for(key, upstream)
+        if source is not None:
+            async with migration.fences[source.url].share():
+                return await forward_moving(router, key, upstream, source, request.method, path, body, content_type,
+                                            headers, request.url.query)
+    if request.method == 'GET':
+        reader = upstream.reader()
+        if reader is not upstream:
+            response = await forward_to(router, reader, 'GET', path, body, content_type, headers)
+            if response is not None:
+                return response
+            # The replica failed the read; the node itself can still answer it
+    response = await forward_to(router, upstream, request.method, path, body, content_type, headers)
+    if response is None:
+        return JSONResponse({"error": f"Node {upstream.url} is unavailable"}, status_code=502)
+    return response
+
+async def forward_moving(router, key, upstream, source, method, path, body, content_type, headers, query):
+    """Serve a key that is moving from source to upstream"""
+    if method == 'POST' and reads_current(body, content_type, query):
+        # The update must see the key's value, so the key moves now rather than when the mover gets to it
+        if not await move_key(router, key, source, upstream):
+            return JSONResponse({"error": f"Key '{key}' is moving to another node, retry"}, status_code=503,
+                                headers={"Retry-After": "1"})
+    response = await forward_to(router, upstream, method, path, body, content_type, headers)
+    if method == 'GET':
+        # Not copied yet: the old owner still has it
+        if response is not None and response.status_code == 404:
+            old = await forward_to(router, source, 'GET', path, b"", None, headers)
+            if old is not None and old.status_code == 200:
+                return old
+    elif method == 'DELETE' or (response is not None and response.status_code == 200):
+        # Drop the old copy too, so the mover cannot bring it back over this write or delete
+        old = await forward_to(router, source, 'DELETE', path, b"", None)
+        if method == 'DELETE' and old is not None and old.status_code == 200:
+            response = old
+    if response is None:
+        return JSONResponse({"error": f"Node {upstream.url} is unavailable"}, status_code=502)
+    return response
+
+def reads_current(body, content_type, query):
+    """Whether a POST /<key> reads the key's current value: an increment, an append or a conditional set"""
+    if content_type and content_type.split(';')[0].strip() == 'application/octet-stream':
+        return any(name in READS_CURRENT for name in parse_qs(query, keep_blank_values=True))
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False  # The node answers 400
+    return isinstance(data, dict) and any(name in data for name in READS_CURRENT)
+
+async def move_key(router, key, source, upstream):
+    """
+    Move one key from source to upstream ahead of the mover, keeping its TTL
+
+    Called with the source's fence held shared, so the mover is not copying
+    the key's page meanwhile. The copy is an nx set, so a write that already
+    reached upstream wins over the old copy. Returns False if a node failed.
+    """
+    quoted = quote(key, safe='')
+    # The smallest key with the key as its prefix is the key itself, if it exists
+    found = await forward_to(router, source, 'GET', f"/_scan?prefix={quoted}&count=1&expiry=1", b"", None)
+    if found is None or found.status_code != 200:
+        return False
+    items = json.loads(found.body)["items"]
+    if not items or items[0][0] != key:
+        return True  # Not on source: new, or already moved
+    _, value, deadline = items[0]
+    op = {"value": value, "nx": True}
+    if deadline is not None:
+        op["exat"] = deadline
+    copied = await forward_to(router, upstream, 'POST', f"/{quoted}", json.dumps(op).encode(), "application/json")
+    if copied is None or copied.status_code not in (200, 412):
+        return False
+    removed = await forward_to(router, source, 'DELETE', f"/{quoted}", b"", None)
+    return removed is not None and removed.status_code in (200, 404)
+
+async def forward_to(router, upstream, method, path, body, content_type, headers=None):
+    """Send one request to upstream; returns the Response, or None if upstream failed"""
+    try:
+        status, response_type, response, response_headers = await asyncio.wait_for(
+            upstream.request(method, path, body, content_type, headers), UPSTREAM_TIMEOUT)
+    except (UpstreamError, asyncio.TimeoutError):
+        # Count it like a failed health check so a dead node leaves the ring without waiting for the checker
+        router.mark(upstream, False)
+        return None
+    return Response(response, status_code=status, media_type=response_type, headers=response_headers)
@@ -0,0 +1,199 @@
+# atomic_ops.py
+# Read-modify-write operations run in one pass under the key's lock stripe: increment, conditional set and append
+import time
+from trie_kv_store import kv_store
+from lock_manager import key_locks
+from worker_pool import pool, DEFAULT_TIMEOUT
+from wal import wal
+from set_value import apply_set
+from eviction import budget
+from replication import replication, ReadOnlyReplica
+from values import pack, unpack, from_json
+from metrics import metrics
+from hot_keys import hot_keys
+
+# Samples the lock wait phase (see metrics.phase_clock)
+lock_wait_clock = metrics.phase_clock()
+# Sample accesses for hot-key tracking (see hot_keys.clock)
+set_clock = hot_keys.clock()
+update_clock = hot_keys.clock()
+
+# Stands for an absent key, and for an if_value that was not given
+MISSING = object()
+
+
+class ConditionFailed(Exception):
+    """Raised when a conditional write's condition does not hold; nothing was written"""
+
+    def __init__(self, version):
+        super().__init__(f"condition failed, key is at version {version}")
+        self.version = version  # The key's current version, 0 if it does not exist
+
+
+# TTL and condition options of an application/octet-stream set, which come in the query string;
+# shared by the wsgi and asgi apps
+def query_options(args):
+    options = {}
+    for name in ('ex', 'px', 'exat', 'pxat'):
+        if name in args:
+            try:
+                options[name] = float(args[name])
+            except ValueError:
+                raise ValueError(f"'{name}' must be a positive number")
+    if 'if_version' in args:
+        try:
+            options['if_version'] = int(args['if_version'])
+        except ValueError:
+            raise ValueError("'if_version' must be a version number")
+    if 'nx' in args:
+        options['nx'] = args['nx'] in ('1', 'true')
+    return options
+
+# Conditions of a conditional set, as keyword arguments for handle_conditional_set_thread
+def parse_conditions(data):
+    conditions = {}
+    if 'nx' in data:
+        if not isinstance(data['nx'], bool):
+            raise ValueError("'nx' must be true or false")
+        conditions['nx'] = data['nx']
+    if 'if_version' in data:
+        version = data['if_version']
+        if isinstance(version, bool) or not isinstance(version, int) or version < 0:
+            raise ValueError("'if_version' must be a version number")
+        conditions['if_version'] = version
+    if 'if_value' in data:
+        conditions['if_value'] = from_json(data['if_value'])
+    return conditions
+
+
+# Writes, so like handle_set_thread they run on the shared worker pool
+def handle_conditional_set_thread(key, value, deadline=None, if_version=None, if_value=MISSING, nx=False,
+                                  timeout=DEFAULT_TIMEOUT):
+    """
+    Returns the key's new version.
+    Raises ConditionFailed if a condition does not hold, worker_pool.DeadlineExceeded
+    if the write could not finish in time, or replication.ReadOnlyReplica on a replica.
+    """
+    return pool.run(conditional_set, key, value, deadline, if_version, if_value, nx, timeout=timeout)
+
+def handle_incr_thread(key, delta, timeout=DEFAULT_TIMEOUT):
+    """Returns (new number, new version); raises ValueError if the value is not a number"""
+    return pool.run(incr, key, delta, timeout=timeout)
+
+def handle_append_thread(key, item, timeout=DEFAULT_TIMEOUT):
+    """Returns (new length, new version); raises ValueError if item cannot be appended to the value"""
+    return pool.run(append, key, item, timeout=timeout)
+
+
+def update(key, compute):
+    """
+    Read key, compute its new value and write it without releasing the key's stripe
+
+    Args:
+        key (str): The key to update
+        compute (callable): compute(current value or MISSING, deadline or None, version)
+            returns (value to store, deadline, result); raising leaves the key untouched
+
+    Returns:
+        tuple: (result, the key's new version)
+    """
+    if replication.read_only:
+        raise ReadOnlyReplica()
+    lock = key_locks.lock_for(key)
+    started = next(lock_wait_clock)()
+    with lock:
+        if started:
+            metrics.phase_end("lock_wait", started)
+        value, deadline, version = kv_store.get_entry(key, with_version=True)
+        if value == "-1" or (deadline is not None and deadline <= time.time()):
+            # Expired keys read as absent, as in get(); the write below replaces them
+            current, deadline, version = MISSING, None, 0
+        else:
+            current = unpack(value)
+        stored, deadline, result = compute(current, deadline, version)
+        version, lsn = apply_set(key, stored, deadline)
+    if lsn is not None:
+        wal.commit(lsn)
+    if budget.enabled:
+        budget.evict()
+    return result, version
+
+def as_bytes(text):
+    # Strings from the Redis protocol may hold non-UTF-8 bytes as lone surrogates
+    return text.encode("utf-8", "surrogateescape") if isinstance(text, str) else text
+
+def conditional_set(key, value, deadline=None, if_version=None, if_value=MISSING, nx=False):
+    """
+    Set key only if every given condition holds: nx (the key does not exist),
+    if_version (its version, 0 for absent) and if_value (its current value)
+
+    Returns the key's new version.
+    """
+    if next(set_clock):
+        hot_keys.record("set", key, value)
+    # Compress before taking the stripe, as set_value does
+    stored = pack(value)
+
+    def check(current, _, version):
+        if ((nx and current is not MISSING) or (if_version is not None and if_version != version)
+                or (if_value is not MISSING and current != if_value)):
+            raise ConditionFailed(version)
+        return stored, deadline, None
+
+    return update(key, check)[1]
+
+def incr(key, delta):
+    """
+    Add delta to a number, treating an absent key as 0; the key keeps its TTL
+
+    Strings holding an integer, as written over the Redis protocol, are
+    incremented in place and stay strings.
+    """
+    if next(update_clock):
+        hot_keys.record("update", key)
+
+    def add(current, deadline, _):
+        if current is MISSING:
+            return delta, None, delta
+        number = current
+        if isinstance(current, str):
+            try:
+                number = int(current)
+            except ValueError:
+                raise ValueError("value is not an integer")
+        elif isinstance(current, bool) or not isinstance(current, (int, float)):
+            raise ValueError("value is not a number")
+        result = number + delta
+        return (str(result) if isinstance(current, str) else result), deadline, result
+
+    return update(key, add)
+
+def append(key, item, mix_bytes=False):
+    """
+    Append item to a value; the key keeps its TTL
+
+    Strings and bytes are concatenated with an item of the same type, and
+    item is added to the end of a list. An absent key starts out as a string
+    or bytes item, and as a one-item list otherwise. Returns the new length.
+    With mix_bytes, as over the Redis protocol where both are strings, a
+    string and bytes concatenate to bytes, and the length is in bytes.
+    """
+    if next(update_clock):
+        hot_keys.record("update", key, item)
+
+    def extend(current, deadline, _):
+        if current is MISSING:
+            result = item if isinstance(item, (str, bytes)) else [item]
+        elif isinstance(current, list):
+            result = current + [item]
+        elif isinstance(current, (str, bytes)) and type(item) is type(current):
+            result = current + item
+        elif mix_bytes and isinstance(current, (str, bytes)) and isinstance(item, (str, bytes)):
+            result = as_bytes(current) + as_bytes(item)
+        else:
+            raise ValueError(f"cannot append {type(item).__name__} to {type(current).__name__}")
+        length = len(as_bytes(result)) if mix_bytes and isinstance(result, str) else len(result)
+        # Compressed under the stripe, since the value only exists once the current one is read
+        return pack(result), deadline, length
+
+    return update(key, extend)
@@ -0,0 +1,139 @@
+# batch_ops.py
+# Multi-key get/set/delete, each run as one unit of work on the shared pool
+import os
+import json
+from trie_kv_store import kv_store
+from lock_manager import key_locks
+from worker_pool import pool
+from wal import wal
+from set_value import apply_set
+from delete_key import apply_delete
+from eviction import budget
+from replication import replication, ReadOnlyReplica
+from metrics import metrics
+from values import pack, unpack, from_json
+from expiry import expire_at
+from hot_keys import hot_keys
+
+# Sample the lock wait and store traversal phases (see metrics.phase_clock)
+lock_wait_clock = metrics.phase_clock()
+traversal_clock = metrics.phase_clock()
+# Sample each batch's keys for hot-key tracking (see hot_keys.clock)
+get_clock = hot_keys.clock()
+set_clock = hot_keys.clock()
+delete_clock = hot_keys.clock()
+
+# Largest number of keys accepted in one batch request
+MAX_BATCH = int(os.getenv("KV_MAX_BATCH", "1000"))
+
+# A batch does more work than a single op, so it gets a longer deadline
+BATCH_TIMEOUT = float(os.getenv("KV_BATCH_TIMEOUT", "0.2"))
+
+# Parse a batch body into [{"key": ..., "value": ..., "deadline": ...}, ...]; shared by the wsgi and asgi apps
+# Accepts a JSON array, {"keys": [...]}, {"items": {key: value}} or NDJSON lines;
+# a value of {"$base64": "..."} is stored as the bytes it decodes to
+def parse_batch(body, mimetype, require_value):
+    if mimetype == 'application/x-ndjson':
+        ops = [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+    else:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get('items'), dict):
+            ops = [{'key': key, 'value': value} for key, value in data['items'].items()]
+        elif isinstance(data, dict) and 'keys' in data:
+            ops = data['keys']
+        else:
+            ops = data
+    if not isinstance(ops, list):
+        raise ValueError("Expected an array of operations")
+    if len(ops) > MAX_BATCH:
+        raise ValueError(f"Batch exceeds {MAX_BATCH} operations")
+
+    parsed = []
+    for op in ops:
+        if not isinstance(op, dict):
+            op = {'key': op}
+        if 'key' not in op or (require_value and 'value' not in op):
+            raise ValueError(f"Malformed operation: {op}")
+        # Sets may carry the same TTL options as a single-key POST
+        deadline = expire_at(op.get('ex'), op.get('px'), op.get('exat'), op.get('pxat')) if require_value else None
+        value = from_json(op.get('value')) if require_value else None
+        parsed.append({'key': str(op['key']), 'value': value, 'deadline': deadline})
+    return parsed
+
+# Reads never block on a lock, so they take the inline fast path
+def handle_mget_thread(keys, timeout=BATCH_TIMEOUT):
+    """Returns [(key, value or None), ...] in request order"""
+    return pool.run(mget_values, keys, timeout=timeout, inline=True)
+
+def handle_mset_thread(items, timeout=BATCH_TIMEOUT):
+    """items are (key, value, deadline or None); returns [(key, new version), ...] in request order"""
+    return pool.run(mset_values, items, timeout=timeout)
+
+def handle_mdel_thread(keys, timeout=BATCH_TIMEOUT):
+    """Returns [(key, 1 if deleted else -1), ...] in request order"""
+    return pool.run(mdel_keys, keys, timeout=timeout)
+
+
+def mget_values(keys):
+    results = []
+    for key in keys:
+        started = next(traversal_clock)()
+        value = kv_store.get(key)
+        if started:
+            metrics.phase_end("traversal", started)
+        value = None if value == "-1" else unpack(value)
+        if next(get_clock):
+            hot_keys.record("get", key, value)
+        results.append((key, value))
+    return results
+
+def mset_values(items):
+    if replication.read_only:
+        raise ReadOnlyReplica()
+    if hot_keys.enabled:
+        for key, value, _ in items:
+            if next(set_clock):
+                hot_keys.record("set", key, value)
+    # Compress before taking the stripes, as set_value does
+    items = [(key, pack(value), deadline) for key, value, deadline in items]
+    # Take every stripe the batch touches once, in order; the store re-enters them per key
+    lsn = None
+    results = []
+    started = next(lock_wait_clock)()
+    with key_locks.acquire_many([key for key, _, _ in items]):
+        if started:
+            metrics.phase_end("lock_wait", started)
+        for key, value, deadline in items:
+            version, key_lsn = apply_set(key, value, deadline)
+            lsn = key_lsn or lsn
+            results.append((key, version))
+    # One commit covers the whole batch
+    if lsn is not None:
+        wal.commit(lsn)
+    if budget.enabled:
+        budget.evict()
+    return results
+
+def mdel_keys(keys):
+    if replication.read_only:
+        raise ReadOnlyReplica()
+    if hot_keys.enabled:
+        for key in keys:
+            if next(delete_clock):
+                hot_keys.record("delete", key)
+    lsn = None
+    results = []
+    started = next(lock_wait_clock)()
+    with key_locks.acquire_many(keys):
+        if started:
+            metrics.phase_end("lock_wait", started)
+        for key in keys:
+            res, key_lsn = apply_delete(key)
+            lsn = key_lsn or lsn
+            results.append((key, res))
+    if lsn is not None:
+        wal.commit(lsn)
+    return results
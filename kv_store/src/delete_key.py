@@ -1,34 +1,61 @@
 # delete_key.py
 from trie_kv_store import kv_store
-from lock_manager import kv_lock
-import threading
+from lock_manager import key_locks
+from worker_pool import pool, DEFAULT_TIMEOUT
+from wal import wal, OP_DELETE
+from snapshot import snapshots
+from replication import replication, ReadOnlyReplica
+from metrics import metrics
+from hot_keys import hot_keys
 
-# Helper function to handle retries for deleting a key
-def handle_delete_thread(key, timeout=0.01):
-    result = []
-    # Call thread, append results to result
-    thread = threading.Thread(target=lambda: result.append(delete_key(key)))
-    thread.start()
-    thread.join(timeout)
-    
-    # If timeout occurs, send another thread out
-    if thread.is_alive():
-        thread = threading.Thread(target=lambda: result.append(delete_key(key)))
-        thread.start()
-        thread.join(timeout)
-        
-    # Both threads failed - return failure
-    if thread.is_alive():
-        return "1"
-    return f"{result[0]}"
+# Sample the lock wait and store traversal phases (see metrics.phase_clock)
+lock_wait_clock = metrics.phase_clock()
+traversal_clock = metrics.phase_clock()
+# Samples accesses for hot-key tracking (see hot_keys.clock)
+hot_clock = hot_keys.clock()
+
+# Run the delete on the shared worker pool so a stuck lock cannot hold the request past its deadline
+def handle_delete_thread(key, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns 1 if the key was deleted, -1 if it did not exist.
+    Raises worker_pool.DeadlineExceeded if the delete could not finish in time,
+    or replication.ReadOnlyReplica on a replica.
+    """
+    return pool.run(delete_key, key, timeout=timeout)
 
 
 def delete_key(key):
-    # Safely delete the key from kv_store using lock
-    with kv_lock:
-        res = kv_store.delete(key)
-        print(f"delete res: {res}")
-        print(key)
-        if res is not None:
-            return res[0]  # Key successfully deleted
-        return -1  # Key not found
+    if replication.read_only:
+        raise ReadOnlyReplica()
+    if next(hot_clock):
+        hot_keys.record("delete", key)
+    # Safely delete the key from kv_store under the key's lock stripe
+    lock = key_locks.lock_for(key)
+    started = next(lock_wait_clock)()
+    with lock:
+        if started:
+            metrics.phase_end("lock_wait", started)
+        res, lsn = apply_delete(key)
+    if lsn is not None:
+        wal.commit(lsn)
+    return res  # 1 if deleted, -1 if the key was not found
+
+def apply_delete(key):
+    """
+    The delete path every delete goes through; the caller holds the key's lock stripe.
+    Returns (1 if deleted else -1, WAL LSN to commit or None).
+    """
+    if snapshots.enabled:
+        snapshots.record_write(key)
+    started = next(traversal_clock)()
+    res = kv_store.delete(key)
+    if started:
+        metrics.phase_end("traversal", started)
+    deleted = res[0] if res is not None else -1
+    # Only deletes that removed something need to be replayed
+    lsn = None
+    if wal.enabled and deleted == 1:
+        lsn = wal.append(OP_DELETE, key)
+    if replication.streaming and deleted == 1:
+        replication.feed(OP_DELETE, key)
+    return deleted, lsn
@@ -0,0 +1,208 @@
+# eviction.py
+# maxmemory-style budget for the store: per-entry memory estimates and sampled LRU/LFU/TTL eviction
+import os
+import random
+import threading
+import time
+from trie_kv_store import kv_store
+from lock_manager import key_locks
+from wal import wal
+from delete_key import apply_delete
+from metrics import metrics
+from values import value_size
+
+# Fixed cost charged per key on top of its key and value bytes: the engine's
+# nodes (see engine_benchmark.py) plus this module's bookkeeping
+ENTRY_OVERHEAD = {"trie": 480, "radix": 340}
+
+# LFU counters start here so a new key is not the first one evicted
+LFU_INIT = 5
+LFU_MAX = 255
+# Higher values make the counter grow more slowly with hits
+LFU_LOG_FACTOR = 10
+# An LFU counter loses one point per this many idle seconds
+LFU_DECAY_SECONDS = 60
+
+
+class _Entry:
+    """Bookkeeping for one key"""
+    __slots__ = ("index", "size", "atime", "counter", "deadline")
+
+    def __init__(self, index, size, atime, deadline):
+        self.index = index        # Position in MemoryBudget.keys
+        self.size = size          # Estimated bytes
+        self.atime = atime        # Last access, time.monotonic()
+        self.counter = LFU_INIT   # LFU counter as of atime
+        self.deadline = deadline  # Expiry deadline, None if the key has no TTL
+
+
+def parse_size(text):
+    """Parse a byte count such as "1073741824", "512mb" or "2gb"; 0 means unlimited"""
+    text = text.strip().lower()
+    for suffix, scale in (("kb", 1024), ("mb", 1024 ** 2), ("gb", 1024 ** 3), ("b", 1)):
+        if text.endswith(suffix):
+            return int(float(text[:-len(suffix)]) * scale)
+    return int(text)
+
+
+def lfu_count(entry, now):
+    # The stored counter, less one point per decay period the key sat idle
+    return max(0, entry.counter - int((now - entry.atime) / LFU_DECAY_SECONDS))
+
+
+# Eviction policies rank a sampled entry; the lowest rank is evicted first
+POLICIES = {
+    "lru": lambda entry, now: entry.atime,
+    "lfu": lambda entry, now: (lfu_count(entry, now), entry.atime),
+    # Keys with a TTL go first, soonest deadline first; keys without one fall back to LRU
+    "ttl": lambda entry, now: (0, entry.deadline) if entry.deadline is not None else (1, entry.atime),
+}
+
+
+class MemoryBudget:
+    def __init__(self, store, maxmemory=0, policy="lru", samples=5, entry_overhead=ENTRY_OVERHEAD["trie"]):
+        """
+        Initialize a memory budget for store
+
+        The store reports every set, delete and read (it calls on_set,
+        on_delete and on_access), so the estimate tracks every write path,
+        including replay and expiry. Keys live in a list with an index map,
+        so adding, removing and sampling a random key are all O(1). Eviction
+        samples a few keys and removes the one the policy ranks lowest,
+        which approximates true LRU/LFU the way Redis does.
+
+        Args:
+            store (KVStore): Store to bound
+            maxmemory (int): Budget in bytes; 0 disables tracking and eviction
+            policy (str): "lru", "lfu" or "ttl"
+            samples (int): Keys sampled per eviction
+            entry_overhead (int): Bytes charged per key on top of its key and value
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {tuple(POLICIES)}")
+        self.enabled = maxmemory > 0
+        self.maxmemory = maxmemory
+        self.policy = policy
+        self.rank = POLICIES[policy]
+        self.samples = samples
+        self.entry_overhead = entry_overhead
+
+        self.keys = []     # Every tracked key, in no particular order
+        self.entries = {}  # key -> _Entry
+        self.used = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        if self.enabled:
+            store.tracker = self
+
+    def on_set(self, key, value, deadline=None):
+        """Called by the store with the key's lock stripe held, after the value is stored"""
+        size = self.entry_overhead + len(key) + value_size(value)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.entries[key] = _Entry(len(self.keys), size, now, deadline)
+                self.keys.append(key)
+                self.used += size
+                return
+            self.used += size - entry.size
+            entry.size = size
+            entry.deadline = deadline
+        self._touch(entry, now)
+
+    def on_delete(self, key):
+        """Called by the store with the key's lock stripe held, after the key is removed"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            # Swap the last key into the freed slot so removal stays O(1)
+            last = self.keys.pop()
+            if last != key:
+                self.keys[entry.index] = last
+                self.entries[last].index = entry.index
+            self.used -= entry.size
+
+    def on_access(self, key):
+        """Called by the store on every successful read; lock-free, a lost update only blurs the ranking"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self._touch(entry, time.monotonic())
+
+    def _touch(self, entry, now):
+        if self.policy == "lfu":
+            # Logarithmic counter: each hit is less likely to count the higher it already is
+            count = lfu_count(entry, now)
+            if count < LFU_MAX and random.random() < 1.0 / ((max(count - LFU_INIT, 0)) * LFU_LOG_FACTOR + 1):
+                count += 1
+            entry.counter = count
+        entry.atime = now
+
+    def _pick(self):
+        # Rank a handful of random keys and return the lowest
+        now = time.monotonic()
+        keys = self.keys
+        entries = self.entries
+        rank = self.rank
+        with self.lock:
+            n = len(keys)
+            if not n:
+                return None
+            best = best_rank = None
+            for _ in range(self.samples):
+                key = keys[int(random.random() * n)]  # Much cheaper than randrange
+                key_rank = rank(entries[key], now)
+                if best is None or key_rank < best_rank:
+                    best, best_rank = key, key_rank
+            return best
+
+    def evict(self):
+        """
+        Evict keys until the store is back under budget
+
+        Called by the write handlers after they release their own stripe,
+        so taking a victim's stripe cannot deadlock against them. Each write
+        adds one entry, so on average it triggers about one eviction, and
+        each eviction costs a fixed number of samples. Victims go through
+        the normal delete path, so they are logged, snapshotted and removed
+        from the store's size.
+
+        Returns:
+            int: Number of keys evicted
+        """
+        evicted = 0
+        lsn = None
+        while self.used > self.maxmemory:
+            victim = self._pick()
+            if victim is None:
+                break
+            with key_locks.lock_for(victim):
+                res, key_lsn = apply_delete(victim)
+            if res != 1:
+                break  # Deleted concurrently, which freed the memory anyway
+            lsn = key_lsn or lsn
+            evicted += 1
+        if lsn is not None:
+            wal.commit(lsn)
+        self.evicted += evicted
+        return evicted
+
+    def collect_metrics(self):
+        """Estimated memory use and evictions, for the /metrics endpoint"""
+        return [
+            ("kv_memory_used_bytes", "gauge", "Estimated bytes used by tracked keys", [({}, self.used)]),
+            ("kv_memory_max_bytes", "gauge", "Memory budget, 0 if unlimited", [({}, self.maxmemory)]),
+            ("kv_evicted_keys_total", "counter", "Keys evicted to stay under the budget", [({}, self.evicted)]),
+        ]
+
+
+# Create shared instance used by the write handlers; KV_MAXMEMORY=0 leaves the store unbounded
+budget = MemoryBudget(
+    kv_store,
+    maxmemory=parse_size(os.getenv("KV_MAXMEMORY", "0")),
+    policy=os.getenv("KV_EVICTION_POLICY", "lru"),
+    samples=int(os.getenv("KV_EVICTION_SAMPLES", "5")),
+    entry_overhead=ENTRY_OVERHEAD.get(os.getenv("KV_ENGINE", "trie"), ENTRY_OVERHEAD["trie"]),
+)
+metrics.add_collector(budget.collect_metrics)
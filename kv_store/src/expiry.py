@@ -0,0 +1,180 @@
+# expiry.py
+# Key expiry: TTL option parsing, a hierarchical timing wheel of deadlines, and the background expirer
+import os
+import math
+import threading
+import time
+
+# Wheel resolution; keys expire at most one tick after their deadline
+EXPIRE_TICK = float(os.getenv("KV_EXPIRE_TICK_MS", "10")) / 1000
+
+
+def expire_at(ex=None, px=None, exat=None, pxat=None, now=None):
+    """
+    Turn Redis-style TTL options into an absolute deadline
+
+    Args:
+        ex (int): Expire after this many seconds
+        px (int): Expire after this many milliseconds
+        exat (float): Expire at this unix time, in seconds
+        pxat (int): Expire at this unix time, in milliseconds
+        now (float): Current unix time, defaults to time.time()
+
+    Returns:
+        float: Unix time the key expires at, or None if no option was given
+
+    Raises:
+        ValueError: If more than one option is given or the value is not a positive number
+    """
+    given = [(name, value) for name, value in (("ex", ex), ("px", px), ("exat", exat), ("pxat", pxat))
+             if value is not None]
+    if not given:
+        return None
+    if len(given) > 1:
+        raise ValueError("Only one of ex, px, exat and pxat may be given")
+    name, value = given[0]
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value <= 0:
+        raise ValueError(f"'{name}' must be a positive number")
+
+    if name in ("ex", "px"):
+        now = time.time() if now is None else now
+        return now + (value if name == "ex" else value / 1000)
+    return value if name == "exat" else value / 1000
+
+
+class TimingWheel:
+    def __init__(self, tick=EXPIRE_TICK, slots=64, levels=5, now=None):
+        """
+        Initialize a hierarchical timing wheel of (key, deadline) entries
+
+        Level 0 has one slot per tick; each level above has slots covering a
+        whole turn of the level below. When the current tick reaches a
+        higher-level slot, its entries cascade down into finer slots, so
+        adding an entry and expiring it are both O(1) regardless of how many
+        are scheduled. With the defaults the wheel spans 64^5 ticks (about
+        124 days); entries beyond that wait in the top level and are
+        re-placed each time they cascade.
+
+        Entries are never removed early: a key whose TTL is changed or
+        cleared leaves its old entry behind, and the expirer discards it when
+        it comes due and no longer matches the key's deadline.
+
+        Args:
+            tick (float): Seconds per level-0 slot
+            slots (int): Slots per level
+            levels (int): Number of levels
+            now (float): Unix time the wheel starts at, defaults to time.time()
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self.current = int((time.time() if now is None else now) / tick)  # Last tick processed
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key, deadline):
+        """Schedule key to be checked for expiry once deadline has passed"""
+        with self.lock:
+            # The current tick's slot was already drained, so the earliest slot is the next one
+            self._place((key, deadline), self.current + 1)
+            self.count += 1
+
+    def _place(self, entry, earliest):
+        # Called with self.lock held; the entry lands in the finest level whose turn reaches it
+        due_tick = max(math.ceil(entry[1] / self.tick), earliest)
+        delta = due_tick - self.current
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots or level == self.levels - 1:
+                if delta >= span * self.slots:
+                    due_tick = self.current + span * self.slots - 1  # Beyond the horizon: park it at the far edge
+                self.wheels[level][(due_tick // span) % self.slots].append(entry)
+                return
+            span *= self.slots
+
+    def advance(self, now=None):
+        """
+        Move the wheel up to now and take every entry that came due
+
+        Returns:
+            list: [(key, deadline), ...] whose deadline is at or before now
+        """
+        target = int((time.time() if now is None else now) / self.tick)
+        due = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                # Cascade coarser levels first so their entries can land in this tick's slot
+                span = self.slots ** (self.levels - 1)
+                for level in range(self.levels - 1, 0, -1):
+                    if self.current % span == 0:
+                        slot = (self.current // span) % self.slots
+                        entries, self.wheels[level][slot] = self.wheels[level][slot], []
+                        for entry in entries:
+                            self._place(entry, self.current)  # This tick's slot is drained below
+                    span //= self.slots
+
+                slot = self.current % self.slots
+                entries, self.wheels[0][slot] = self.wheels[0][slot], []
+                due.extend(entries)
+            self.count -= len(due)
+        return due
+
+
+def expire_key(store, key, deadline):
+    """
+    Delete key if it still carries deadline; it may have been rewritten since it was scheduled
+
+    Expiry is not logged or snapshotted: both record the deadline itself,
+    and replaying a key whose deadline has passed drops it.
+
+    Returns:
+        bool: True if the key was deleted
+    """
+    with store.locks.lock_for(key):
+        if store.get_entry(key)[1] != deadline:
+            return False
+        return store.delete(key)[0] == 1
+
+
+class Expirer:
+    def __init__(self, store, interval=EXPIRE_TICK):
+        """
+        Initialize the background thread that deletes keys as their deadlines pass
+
+        Each due key is deleted under its own lock stripe, one at a time, so
+        expiring many keys at once never holds more than one stripe.
+
+        Args:
+            store (KVStore): Store whose expiry wheel to drain
+            interval (float): Seconds between passes
+        """
+        self.store = store
+        self.interval = interval
+        self.expired = 0
+        self.thread = None
+
+    def run_once(self, now=None):
+        """Delete every key that came due; returns how many were deleted"""
+        deleted = 0
+        for key, deadline in self.store.expiry.advance(now):
+            if expire_key(self.store, key, deadline):
+                deleted += 1
+        self.expired += deleted
+        return deleted
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error expiring keys: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="expirer", daemon=True)
+        self.thread.start()
@@ -1,30 +1,39 @@
 # get_value.py
 # from kv_store import kv_store
 from trie_kv_store import kv_store
-import threading
+from worker_pool import pool, DEFAULT_TIMEOUT
+from metrics import metrics
+from values import unpack
+from hot_keys import hot_keys
 
-# Helper function to handle retries for getting a value
-def handle_get_thread(key, timeout=0.01):
-    result = [-1]
-    # Call thread, append results to result
-    thread = threading.Thread(target=lambda: result.append(get_value(key)))
-    thread.start()
-    thread.join(timeout)
+# Samples the store traversal phase (see metrics.phase_clock)
+traversal_clock = metrics.phase_clock()
+# Samples accesses for hot-key tracking (see hot_keys.clock)
+hot_clock = hot_keys.clock()
 
-    # If timeout occurs, send another thread out
-    if thread.is_alive():
-        thread = threading.Thread(target=lambda: result.append(get_value(key)))
-        thread.start()
-        thread.join(timeout)
-        
-    # Both threads failed - return failure
-    if thread.is_alive() or result[1] == None:
-        return "-1"
-    return result[1]
+# Lookups never block on a lock, so they take the inline fast path
+def handle_get_thread(key, with_version=False, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns the value for key, or None if it does not exist; (value, version) with with_version.
+    Raises worker_pool.DeadlineExceeded if the lookup could not finish in time.
+    """
+    return pool.run(get_value, key, with_version, timeout=timeout, inline=True)
 
 
-
-def get_value(key):
+def get_value(key, with_version=False):
     # Retrieve value from kv_store
-    x = kv_store.get(key)
-    return x
+    started = next(traversal_clock)()
+    if with_version:
+        x, version = kv_store.get(key, with_version=True)
+    else:
+        x = kv_store.get(key)
+    if started:
+        metrics.phase_end("traversal", started)
+    if x == "-1":
+        if next(hot_clock):
+            hot_keys.record("get", key)
+        return (None, 0) if with_version else None
+    x = unpack(x)
+    if next(hot_clock):
+        hot_keys.record("get", key, x)
+    return (x, version) if with_version else x
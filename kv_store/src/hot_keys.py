@@ -0,0 +1,232 @@
+# hot_keys.py
+# Hot-key detection: per-operation Count-Min sketches and Space-Saving top-k lists of sampled key accesses, in fixed memory
+import os
+import time
+import itertools
+import threading
+from values import value_size
+
+# Operations accesses are recorded under
+OPS = ("get", "set", "delete", "update")
+
+HASH_MASK = (1 << 64) - 1
+
+
+class CountMin:
+    """
+    Count-Min sketch of weights per key
+
+    Estimates never fall below a key's true weight, and with conservative
+    update rarely exceed it by more than a few parts in width of the total.
+    The depth rows of width counters are laid out in one flat list.
+    """
+    __slots__ = ("counts",)
+
+    def __init__(self, width, depth):
+        self.counts = [0] * (width * depth)
+
+    def add(self, cells, weight):
+        """Add weight at cells (from cells_for); returns the new estimate"""
+        counts = self.counts
+        estimate = min([counts[cell] for cell in cells]) + weight
+        # Conservative update: only raise the counters that fall below the new estimate
+        for cell in cells:
+            if counts[cell] < estimate:
+                counts[cell] = estimate
+        return estimate
+
+    def estimate(self, cells):
+        counts = self.counts
+        return min([counts[cell] for cell in cells])
+
+    def halve(self):
+        self.counts = [count >> 1 for count in self.counts]
+
+
+def cells_for(key, width, depth):
+    """A key's counter in each row of a flat width x depth sketch"""
+    # One hash split in two, combined per row (Kirsch-Mitzenmacher), instead of one hash per row
+    h = hash(key) & HASH_MASK
+    low, high = h & 0xFFFFFFFF, (h >> 32) | 1
+    return [row * width + (low + row * high) % width for row in range(depth)]
+
+
+class TopK:
+    """
+    Space-Saving list of the heaviest keys
+
+    Holds up to twice capacity candidates and prunes back to the heaviest
+    capacity when full, so a miss costs O(log capacity) amortized rather
+    than a scan for the lightest entry. A key joining the list starts at
+    its Count-Min estimate, so its count is never below its true weight,
+    and error bounds how far above it may be.
+    """
+    __slots__ = ("capacity", "counts")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}  # key -> [count, error]
+
+    def add(self, key, weight, sketch, cells):
+        estimate = sketch.add(cells, weight)
+        entry = self.counts.get(key)
+        if entry is not None:
+            entry[0] += weight
+            return
+        if len(self.counts) >= 2 * self.capacity:
+            self._prune()
+        self.counts[key] = [estimate, estimate - weight]
+
+    def _prune(self):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        self.counts = dict(ranked[:self.capacity])
+
+    def top(self, count):
+        """[(key, count, error), ...], heaviest first"""
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, entry[0], entry[1]) for key, entry in ranked[:count]]
+
+    def halve(self):
+        for entry in self.counts.values():
+            entry[0] >>= 1
+            entry[1] >>= 1
+
+
+class OpStats:
+    """Sketches and top-k lists of one operation, weighted by requests and by bytes"""
+    __slots__ = ("requests", "bytes", "top_requests", "top_bytes", "total_requests", "total_bytes")
+
+    def __init__(self, capacity, width, depth):
+        self.requests = CountMin(width, depth)
+        self.bytes = CountMin(width, depth)
+        self.top_requests = TopK(capacity)
+        self.top_bytes = TopK(capacity)
+        self.total_requests = 0
+        self.total_bytes = 0
+
+    def add(self, key, size, cells):
+        # Both sketches have the same shape, so the key's cells are hashed once for the two
+        self.top_requests.add(key, 1, self.requests, cells)
+        self.total_requests += 1
+        if size:
+            self.top_bytes.add(key, size, self.bytes, cells)
+            self.total_bytes += size
+
+    def halve(self):
+        for part in (self.requests, self.bytes, self.top_requests, self.top_bytes):
+            part.halve()
+        self.total_requests >>= 1
+        self.total_bytes >>= 1
+
+
+class HotKeys:
+    def __init__(self, enabled=True, sample=64, capacity=64, width=1024, depth=4, halflife=60.0):
+        """
+        Track the most accessed keys per operation, by requests and by bytes
+
+        One in sample accesses is recorded, so a request pays one iterator
+        step unless it is sampled. Memory is fixed: per operation, two
+        width x depth Count-Min sketches and two top-k lists of at most
+        2 x capacity keys. Every halflife seconds all counts are halved,
+        so the lists follow the keys that are hot now rather than since
+        startup. Reported counts are scaled back up by sample.
+
+        Args:
+            enabled (bool): When False, clock() never samples and nothing is recorded
+            sample (int): Record one in this many accesses at each call site; 0 disables tracking
+            capacity (int): Keys reported per operation and ranking
+            width (int): Counters per Count-Min row
+            depth (int): Count-Min rows
+            halflife (float): Seconds between halvings of every count
+        """
+        self.enabled = enabled and sample > 0
+        self.sample = sample
+        self.capacity = capacity
+        self.width = width
+        self.depth = depth
+        self.halflife = halflife
+        self.ops = {op: OpStats(capacity, width, depth) for op in OPS}
+        self.next_decay = time.monotonic() + halflife
+        self.lock = threading.Lock()
+
+    def clock(self):
+        """
+        A sampling clock for one call site: yields True once every sample calls
+
+        `if next(clock): hot_keys.record(...)` costs one iterator step when
+        the access is not sampled. As with metrics.phase_clock, each site
+        gets its own clock so sites called in a fixed pattern cannot alias.
+        """
+        if not self.enabled:
+            return itertools.repeat(False)
+        return itertools.cycle([True] + [False] * (self.sample - 1))
+
+    def record(self, op, key, value=None):
+        """Record one sampled access to key; value, if any, is what was read or written"""
+        size = value_size(value) if value is not None else 0
+        cells = cells_for(key, self.width, self.depth)
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.next_decay:
+                for stats in self.ops.values():
+                    stats.halve()
+                self.next_decay = now + self.halflife
+            self.ops[op].add(key, size, cells)
+
+    def report(self, ops=OPS, count=None, by="requests", keys=()):
+        """
+        The hottest keys of each operation, and estimates for the given keys
+
+        Args:
+            ops (iterable): Operations to report
+            count (int): Keys per operation, at most capacity
+            by (str): Rank by "requests" or "bytes"
+            keys (iterable): Keys to estimate with the sketches, hot or not
+
+        Returns:
+            dict: {"sample", "halflife", "by", "ops": {op: {"requests", "bytes", "top": [...]}}, "keys": {...}}
+
+        Raises:
+            ValueError: If an operation or the ranking is unknown
+        """
+        unknown = [op for op in ops if op not in self.ops]
+        if unknown:
+            raise ValueError(f"unknown operation {unknown[0]!r}, expected one of {', '.join(OPS)}")
+        if by not in ("requests", "bytes"):
+            raise ValueError("'by' must be 'requests' or 'bytes'")
+        count = min(count or self.capacity, self.capacity)
+        scale = self.sample
+        result = {}
+        estimates = {}
+        with self.lock:
+            for op in ops:
+                stats = self.ops[op]
+                ranking, total = ((stats.top_bytes, stats.total_bytes) if by == "bytes"
+                                  else (stats.top_requests, stats.total_requests))
+                top = []
+                for key, weight, error in ranking.top(count):
+                    cells = cells_for(key, self.width, self.depth)
+                    requests = (weight if by == "requests" else stats.requests.estimate(cells)) * scale
+                    size = (weight if by == "bytes" else stats.bytes.estimate(cells)) * scale
+                    top.append({"key": key, "requests": requests, "bytes": size, "error": error * scale,
+                                "share": round(weight / total, 4) if total else 0.0})
+                result[op] = {"requests": stats.total_requests * scale, "bytes": stats.total_bytes * scale, "top": top}
+                for key in keys:
+                    cells = cells_for(key, self.width, self.depth)
+                    estimates.setdefault(key, {})[op] = {"requests": stats.requests.estimate(cells) * scale,
+                                                         "bytes": stats.bytes.estimate(cells) * scale}
+        report = {"sample": self.sample, "halflife": self.halflife, "by": by, "ops": result}
+        if estimates:
+            report["keys"] = estimates
+        return report
+
+
+# Create shared instance used by the read and write paths and the admin endpoint
+hot_keys = HotKeys(
+    enabled=os.getenv("KV_HOTKEYS", "on") != "off",
+    sample=int(os.getenv("KV_HOTKEYS_SAMPLE", "64")),
+    capacity=int(os.getenv("KV_HOTKEYS_CAPACITY", "64")),
+    width=int(os.getenv("KV_HOTKEYS_WIDTH", "1024")),
+    depth=int(os.getenv("KV_HOTKEYS_DEPTH", "4")),
+    halflife=float(os.getenv("KV_HOTKEYS_HALFLIFE", "60")),
+)
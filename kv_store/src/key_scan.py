@@ -0,0 +1,52 @@
+# key_scan.py
+# Shared glob and cursor-pagination helpers used by both store engines
+from fnmatch import fnmatchcase
+
+GLOB_CHARS = "*?["
+
+# Upper bound on keys examined per page, as a multiple of the page size
+VISIT_FACTOR = 10
+
+
+def glob_prefix(pattern):
+    """Return the literal prefix of a glob pattern, i.e. everything before the first wildcard"""
+    for i, char in enumerate(pattern):
+        if char in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+def matches(key, pattern):
+    return pattern is None or pattern == "*" or fnmatchcase(key, pattern)
+
+
+def scan_page(items, count=10, pattern=None):
+    """
+    Take one page of matching items from a sorted (key, value, ...) iterator
+
+    A page stops after count matches or after VISIT_FACTOR * count keys were
+    examined, so a selective pattern cannot turn one request into a full scan.
+    Like Redis SCAN, a page may therefore hold fewer than count items even
+    though the scan is not finished.
+
+    Args:
+        items (iterator): (key, value) pairs, or longer tuples, in ascending key order
+        count (int): Maximum number of items to return
+        pattern (str): Optional glob the keys must match
+
+    Returns:
+        tuple: (next_cursor, [item, ...]); next_cursor is "" once the scan is complete
+    """
+    page = []
+    visited = 0
+    last_key = None
+    for item in items:
+        key = last_key = item[0]
+        visited += 1
+        if matches(key, pattern):
+            page.append(item)
+            if len(page) >= count:
+                return last_key, page
+        if visited >= count * VISIT_FACTOR:
+            return last_key, page
+    return "", page
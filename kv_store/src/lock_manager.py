@@ -1,6 +1,61 @@
+import os
 import threading
+from contextlib import contextmanager
 
-kv_lock = threading.Lock()
+
+class StripedLockManager:
+    def __init__(self, num_stripes=64):
+        """
+        Initialize a fixed set of lock stripes shared by all keys
+
+        Args:
+            num_stripes (int): Number of stripes; keys hash onto one of them
+        """
+        # Re-entrant so a handler can hold a key's stripe around the store call that takes it again
+        self.stripes = [threading.RLock() for _ in range(num_stripes)]
+
+    def stripe_index(self, key):
+        return hash(key) % len(self.stripes)
+
+    def lock_for(self, key):
+        """Return the lock guarding key"""
+        return self.stripes[self.stripe_index(key)]
+
+    def locks_for(self, keys):
+        """Return the distinct locks guarding keys, in the global acquisition order"""
+        return [self.stripes[i] for i in sorted({self.stripe_index(key) for key in keys})]
+
+    @contextmanager
+    def acquire_many(self, keys):
+        """
+        Hold the locks for every key at once
+
+        Stripes are always taken in index order so two multi-key
+        operations can never deadlock against each other.
+        """
+        locks = self.locks_for(keys)
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def acquire_all(self):
+        """Hold every stripe, fencing out all writers (used for brief store-wide barriers)"""
+        for lock in self.stripes:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.stripes):
+                lock.release()
+
+
+# Create shared instance used by the store and the request handlers
+key_locks = StripedLockManager(int(os.getenv("KV_LOCK_STRIPES", "64")))
 
 
 '''
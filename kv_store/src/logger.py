@@ -1,44 +1,164 @@
-import logging
-import threading
+# logger.py
+# Access log: sampled records go into a bounded buffer on the request path and are written as JSON lines in batches by a background thread
+import os
 import time
-from queue import Queue
-from trie_kv_store import kv_store
+import atexit
+import itertools
+import threading
+from collections import deque
+from json.encoder import encode_basestring
+from metrics import metrics
+
+# Results that mark a failed request; they are sampled at their own rate, so failures can be kept in full
+ERROR_RESULTS = frozenset({"timeout", "overloaded", "read-only", "wrong type", "condition failed"})
+
+
+def format_record(record):
+    """One JSON line for a (time, operation, key, result) record"""
+    timestamp, operation, key, result = record
+    # Operations and results are fixed strings from the handlers; only the key needs escaping
+    key = "null" if key is None else encode_basestring(str(key))
+    return f'{{"ts":{timestamp:.6f},"op":"{operation}","key":{key},"result":"{result}"}}\n'
+
+
+class AccessLog:
+    def __init__(self, path, enabled=True, sample=1, error_sample=1, capacity=65536, batch=4096, flush_interval=0.2):
+        """
+        Sampled, batched access log
+
+        A request pays an iterator step to decide whether it is sampled and,
+        if so, a time.time() call and an append of a tuple to a bounded
+        deque. Formatting and I/O happen on a writer thread, which drains the
+        buffer once batch records are waiting or every flush_interval
+        seconds, and writes everything drained with one write(). When the
+        buffer is full, records are counted as dropped instead of queueing
+        without bound, so a slow disk never holds up or grows the server.
+
+        Args:
+            path (str): File the JSON lines are appended to; its directory is created if needed
+            enabled (bool): When False, nothing is recorded and no file is opened
+            sample (int): Log one in this many successful requests; 0 logs none of them
+            error_sample (int): Log one in this many failed requests (see ERROR_RESULTS); 0 logs none
+            capacity (int): Records the buffer holds before new ones are dropped
+            batch (int): Buffered records that wake the writer before flush_interval is up
+            flush_interval (float): Longest time in seconds a record waits in the buffer
+        """
+        self.path = path
+        self.enabled = enabled and (sample > 0 or error_sample > 0)
+        self.sample = sample
+        self.error_sample = error_sample
+        self.clock = self._clock(sample)
+        self.error_clock = self._clock(error_sample)
+        self.capacity = capacity
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.buffer = deque()
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.file = None
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.thread = None
 
-# Set up a logging queue
-log_queue = Queue()
+    @staticmethod
+    def _clock(sample):
+        # As in metrics.phase_clock: next() on a cycle is atomic under the GIL and runs no Python code
+        if sample <= 0:
+            return itertools.repeat(False)
+        return itertools.cycle([True] + [False] * (sample - 1))
 
-# Configure logger to use the queue handler
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("kv_store_operations")
+    def start(self):
+        """Open the log file and start the writer thread; with no usable file, logging is turned off"""
+        if not self.enabled:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(self.path, "a", buffering=1 << 20)
+        except OSError as e:
+            print(f"Access log disabled: cannot open {self.path}: {e}")
+            self.enabled = False
+            return
+        self.thread = threading.Thread(target=self._run, name="access-log", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
 
-# Log worker continuously writes from queue to logfile
-def log_worker():
-    with open("../logs/kv_store_operations.log", "a") as logfile:
+    def record(self, operation, key, result):
+        """Buffer one request, if it is sampled and there is room"""
+        if not self.enabled or not next(self.error_clock if result in ERROR_RESULTS else self.clock):
+            return
+        buffer = self.buffer
+        if len(buffer) >= self.capacity:
+            # Unlocked, like the metrics counters; a rare lost increment is accepted
+            self.dropped += 1
+            return
+        buffer.append((time.time(), operation, key, result))
+        if len(buffer) == self.batch:
+            self.wake.set()
+
+    def _run(self):
         while True:
-            log_entry = log_queue.get()
-            if log_entry is None:
-                break  # Exit signal received
-            logfile.write(log_entry + "\n")
-            logfile.flush()  # Ensure log is written to file immediately
-    print("Log worker exiting")
-
-# Start the log worker thread
-log_thread = threading.Thread(target=log_worker, daemon=True)
-log_thread.start()
-
-# Get time & format log operation
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every buffered record with a single write() and flush"""
+        with self.flush_lock:
+            buffer = self.buffer
+            pop = buffer.popleft
+            # Only what is buffered now; records appended meanwhile wait for the next flush
+            records = [pop() for _ in range(len(buffer))]
+            if not records or self.file is None:
+                return
+            try:
+                self.file.write("".join([format_record(record) for record in records]))
+                self.file.flush()
+            except (OSError, ValueError):
+                # Keep serving; the lost batch shows up as dropped records
+                self.write_errors += 1
+                self.dropped += len(records)
+                return
+            self.written += len(records)
+            self.batches += 1
+
+    def close(self):
+        """Write out what is still buffered and close the file"""
+        self.flush()
+        with self.flush_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def collect_metrics(self):
+        """Access log counters, for the /metrics endpoint"""
+        return [
+            ("kv_access_log_records_total", "counter", "Access log records written or dropped",
+             [({"outcome": "written"}, self.written), ({"outcome": "dropped"}, self.dropped)]),
+            ("kv_access_log_batches_total", "counter", "Batched writes to the access log", [({}, self.batches)]),
+            ("kv_access_log_write_errors_total", "counter", "Access log batches lost to write errors",
+             [({}, self.write_errors)]),
+            ("kv_access_log_buffered", "gauge", "Records waiting to be written", [({}, len(self.buffer))]),
+        ]
+
+
+# Create shared instance used by the request handlers
+access_log = AccessLog(
+    os.getenv("KV_ACCESS_LOG_PATH", "./logs/kv_store_operations.log"),
+    enabled=os.getenv("KV_ACCESS_LOG", "on") != "off",
+    sample=int(os.getenv("KV_ACCESS_LOG_SAMPLE", "1")),
+    error_sample=int(os.getenv("KV_ACCESS_LOG_ERROR_SAMPLE", "1")),
+    capacity=int(os.getenv("KV_ACCESS_LOG_BUFFER", "65536")),
+    batch=int(os.getenv("KV_ACCESS_LOG_BATCH", "4096")),
+    flush_interval=int(os.getenv("KV_ACCESS_LOG_FLUSH_MS", "200")) / 1000,
+)
+access_log.start()
+metrics.add_collector(access_log.collect_metrics)
+
+
 def log_operation(operation_type, key, result):
-    timestamp = time.ctime()
-    log_entry = f"{timestamp} - {operation_type.upper()} - key: {key}, result: {result}"
-    log_queue.put(log_entry)
-
-
-# Periodic logging of entire kv_store
-def log_entire_store():
-    threading.Timer(10.0, log_entire_store).start()
-    print("Logging store...")
-    try:
-        with open("./logs/kv_store_contents.log", "w") as logfile:
-            logfile.write(f"{time.ctime()}: {kv_store.keys()}\n")
-    except Exception as e:
-        print(f"Error writing to log file: {e}")
+    """Record one request in the access log; see AccessLog.record"""
+    access_log.record(operation_type, key, result)
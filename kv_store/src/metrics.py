@@ -0,0 +1,255 @@
+# metrics.py
+# Request and phase latency histograms plus server counters, rendered in the Prometheus text format
+import os
+import functools
+import inspect
+import itertools
+from time import perf_counter_ns
+
+# Each power of two is split into 2^SUB_BITS linear buckets, so a recorded
+# latency is off by at most 1/8 (12.5%) of its value, as in HdrHistogram
+SUB_BITS = 3
+SUB_COUNT = 1 << SUB_BITS
+SUB_MASK = SUB_COUNT - 1
+# Enough buckets for any 64-bit nanosecond count
+BUCKETS = (64 - SUB_BITS + 1) << SUB_BITS
+
+# Prometheus buckets are exported one per power of two from ~1us to ~69s;
+# the fine buckets only feed the quantile gauges
+EXPORT_BOUNDS = [1 << e for e in range(10, 37)]
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def bucket_index(ns):
+    """Bucket holding a duration of ns nanoseconds"""
+    if ns < 2 * SUB_COUNT:
+        return ns
+    shift = ns.bit_length() - SUB_BITS - 1
+    return ((shift + 1) << SUB_BITS) | ((ns >> shift) & SUB_MASK)
+
+
+def bucket_bounds(index):
+    """(lowest, highest + 1) nanoseconds counted in bucket index"""
+    if index < 2 * SUB_COUNT:
+        return index, index + 1
+    shift = (index >> SUB_BITS) - 1
+    low = (SUB_COUNT | (index & SUB_MASK)) << shift
+    return low, low + (1 << shift)
+
+
+class Histogram:
+    """Log-linear histogram of durations in nanoseconds"""
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0  # Sum of every recorded duration
+
+    def record(self, ns):
+        # Not locked: two threads bumping the same bucket at once can lose one
+        # count, which blurs the distribution but never corrupts it
+        self.counts[bucket_index(ns)] += 1
+        self.total += ns
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q, counts=None):
+        """
+        Duration at quantile q, in nanoseconds
+
+        Reports the top of the bucket the quantile falls in, so it is never
+        below the true value and at most 12.5% above it.
+        """
+        counts = self.counts if counts is None else counts
+        rank = q * sum(counts)
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if n and seen >= rank:
+                return bucket_bounds(index)[1] - 1
+        return 0
+
+    def cumulative(self, bounds, counts=None):
+        """Number of durations below each bound, for Prometheus' le buckets"""
+        counts = self.counts if counts is None else counts
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            # Every bound is a power of two, so it always starts a bucket
+            end = bucket_index(bound)
+            seen += sum(counts[index:end])
+            index = end
+            result.append(seen)
+        return result
+
+
+class Metrics:
+    def __init__(self, enabled=True, phase_sample=16):
+        """
+        Initialize the registry the handlers record into
+
+        Request latency is recorded for every request, per operation and
+        response status. Phases inside a request (queue wait, lock wait,
+        store traversal, response serialization) are each timed for one in
+        phase_sample calls; the other calls cost one iterator step instead
+        of two clock reads and a histogram update.
+
+        Args:
+            enabled (bool): When False, timed() leaves views unwrapped and no phase is sampled
+            phase_sample (int): Time one in this many phase calls; 0 disables phase timing
+        """
+        self.enabled = enabled
+        self.requests = {}  # (op, status) -> Histogram
+        self.phases = {}    # phase -> Histogram
+        self.collectors = []
+        self.phase_sample = phase_sample if enabled else 0
+
+    def request_histogram(self, op, status):
+        histogram = self.requests.get((op, status))
+        if histogram is None:
+            histogram = self.requests.setdefault((op, status), Histogram())
+        return histogram
+
+    def timed(self, op):
+        """
+        Decorate a view to record its latency under op and the status it returned
+
+        Works on Flask views returning (response, status) and on async views
+        returning a response object.
+        """
+        def decorate(view):
+            if not self.enabled:
+                return view
+            # Per-view cache, so the common case is one dict lookup by status
+            by_status = {}
+            clock = perf_counter_ns
+
+            def histogram_for(status):
+                histogram = by_status[status] = self.request_histogram(op, status)
+                return histogram
+
+            # bucket_index and Histogram.record are inlined below: a Python call
+            # costs more than the rest of the bookkeeping put together
+            if inspect.iscoroutinefunction(view):
+                @functools.wraps(view)
+                async def timed_view(**kwargs):
+                    start = clock()
+                    rv = await view(**kwargs)
+                    ns = clock() - start
+                    status = rv.status_code
+                    histogram = by_status.get(status) or histogram_for(status)
+                    shift = ns.bit_length() - SUB_BITS - 1
+                    histogram.counts[((shift + 1) << SUB_BITS) | ((ns >> shift) & SUB_MASK) if shift > 0 else ns] += 1
+                    histogram.total += ns
+                    return rv
+            else:
+                @functools.wraps(view)
+                def timed_view(**kwargs):
+                    start = clock()
+                    rv = view(**kwargs)
+                    ns = clock() - start
+                    status = rv[1] if type(rv) is tuple else rv.status_code
+                    histogram = by_status.get(status) or histogram_for(status)
+                    shift = ns.bit_length() - SUB_BITS - 1
+                    histogram.counts[((shift + 1) << SUB_BITS) | ((ns >> shift) & SUB_MASK) if shift > 0 else ns] += 1
+                    histogram.total += ns
+                    return rv
+            return timed_view
+        return decorate
+
+    def phase_clock(self):
+        """
+        A sampling clock for one call site that times a phase
+
+        It yields perf_counter_ns once every phase_sample calls and int, which
+        returns 0, the rest of the time, so `started = next(clock)()` starts a
+        sampled timing without running any Python code. next() on a cycle is
+        atomic under the GIL. Each site gets its own clock so that sites
+        called in a fixed pattern cannot alias against one shared counter.
+        """
+        if not self.phase_sample:
+            return itertools.cycle([int])
+        return itertools.cycle([perf_counter_ns] + [int] * (self.phase_sample - 1))
+
+    def phase_end(self, phase, started):
+        """
+        Record a phase begun at started, taken from a phase_clock
+
+        Callers skip this when started is 0, i.e. the call was not sampled.
+        """
+        ns = perf_counter_ns() - started
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases.setdefault(phase, Histogram())
+        histogram.record(ns)
+
+    def add_collector(self, collect):
+        """
+        Register a callable rendered with every scrape
+
+        collect() returns [(name, type, help, [(labels dict, value), ...]), ...],
+        read from counters its owner already keeps, so nothing is added to the
+        request path.
+        """
+        self.collectors.append(collect)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        self._render_histograms(lines, "kv_request_duration_seconds",
+                                "Request latency by operation and HTTP status",
+                                [({"op": op, "status": str(status)}, histogram)
+                                 for (op, status), histogram in sorted(self.requests.items())])
+        self._render_histograms(lines, "kv_phase_duration_seconds",
+                                "Sampled latency of request phases: queue, lock_wait, traversal, serialize",
+                                [({"phase": phase}, histogram) for phase, histogram in sorted(self.phases.items())])
+        for collect in self.collectors:
+            for name, kind, help_text, samples in collect():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, lines, name, help_text, series):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        quantiles = []
+        for labels, histogram in series:
+            # Copy once so buckets, count and quantiles agree even while requests keep recording
+            counts = list(histogram.counts)
+            total = sum(counts)
+            for bound, seen in zip(EXPORT_BOUNDS, histogram.cumulative(EXPORT_BOUNDS, counts)):
+                lines.append(f"{name}_bucket{format_labels(labels, le=seconds(bound))} {seen}")
+            lines.append(f"{name}_bucket{format_labels(labels, le='+Inf')} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {seconds(histogram.total)}")
+            lines.append(f"{name}_count{format_labels(labels)} {total}")
+            quantiles.extend((labels, q, histogram.quantile(q, counts)) for q in QUANTILES)
+
+        # Quantiles from the fine buckets, sharper than histogram_quantile over the exported ones
+        lines.append(f"# HELP {name}_quantile {help_text}, at quantiles since startup")
+        lines.append(f"# TYPE {name}_quantile gauge")
+        for labels, q, ns in quantiles:
+            lines.append(f"{name}_quantile{format_labels(labels, quantile=str(q))} {seconds(ns)}")
+
+
+def seconds(ns):
+    return repr(ns / 1e9)
+
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+# Create shared instance used by the apps, the worker pool and the write paths
+metrics = Metrics(
+    enabled=os.getenv("KV_METRICS", "on") != "off",
+    phase_sample=int(os.getenv("KV_METRICS_PHASE_SAMPLE", "16")),
+)
@@ -0,0 +1,427 @@
+# radix_kv_store.py
+# A compressed (radix / Patricia) tree for kv storage, drop-in for trie_kv_store.KVStore
+import threading
+import time
+from lock_manager import key_locks
+from key_scan import glob_prefix, matches, scan_page
+from expiry import TimingWheel, expire_at, expire_key
+from versions import Versions
+
+# Marks a node that does not hold a key; lets readers check presence with a single attribute load
+_EMPTY = object()
+
+
+class _Expiring:
+    """Stored in place of the value of a key with a TTL, so only those keys pay for the deadline"""
+    __slots__ = ("value", "deadline")
+
+    def __init__(self, value, deadline):
+        self.value = value
+        self.deadline = deadline
+
+# Guards lazy allocation of per-node locks
+_lock_alloc = threading.Lock()
+
+
+class RadixNode:
+    __slots__ = ("edges", "value", "lock", "dead", "version")
+
+    def __init__(self, value=_EMPTY, edges=None, version=0):
+        """Initialize a node in the radix tree"""
+        self.edges = edges  # Maps first char of an edge label to (label, child), None for leaves
+        self.value = value  # Stored value, or _EMPTY if no key ends here
+        self.lock = None    # Allocated the first time a writer modifies this node
+        self.dead = False   # Set once the node has been pruned or merged away
+        # Version stamp of the last write. Writers store it after the value and readers load it
+        # before, so a lock-free reader may pair a new value with the old version, never the reverse
+        self.version = version
+
+
+def _lock_of(node):
+    lock = node.lock
+    if lock is None:
+        with _lock_alloc:
+            if node.lock is None:
+                node.lock = threading.Lock()
+            lock = node.lock
+    return lock
+
+
+def _common_prefix_len(label, key, start):
+    limit = min(len(label), len(key) - start)
+    i = 0
+    while i < limit and label[i] == key[start + i]:
+        i += 1
+    return i
+
+
+class RadixKVStore:
+    def __init__(self, locks=key_locks):
+        """
+        Initialize an empty radix-tree-based key-value store
+
+        Edge labels live in the parent's edge map, so every structural change
+        (adding a leaf, splitting or merging an edge) is a single slot
+        assignment in one node. Readers never lock: they see either the old or
+        the new edge, and both describe the same keys.
+
+        Args:
+            locks (StripedLockManager): Per-key lock stripes serializing writers of the same key
+        """
+        self.root = RadixNode(edges={})
+        self.size = 0
+        self.size_lock = threading.Lock()
+        self.locks = locks
+        self.expiry = TimingWheel()  # Deadlines of keys set with a TTL, drained by expiry.Expirer
+        self.tracker = None          # Optional eviction.MemoryBudget told about every set, delete and read
+        self.versions = Versions()
+
+    def set(self, key, value, ex=None, px=None, exat=None, pxat=None, version=None, **kwargs):
+        """
+        Set a value in the tree; a set without a TTL option clears any previous TTL
+
+        Args:
+            key (str): The key to store
+            value (any): The value to store
+            ex (int): Expire after this many seconds
+            px (int): Expire after this many milliseconds
+            exat (float): Expire at this unix time, in seconds
+            pxat (int): Expire at this unix time, in milliseconds
+            version (int): Version to store, as stamped by apply_set or adopted from a record;
+                None stamps a new one
+            **kwargs: Additional arguments (maintained for compatibility)
+
+        Returns:
+            int: The key's new version, or 0 if the deadline had already passed and the key was deleted
+
+        Raises:
+            ValueError: If the TTL options are invalid
+        """
+        if not isinstance(key, str):
+            key = str(key)
+        deadline = expire_at(ex, px, exat, pxat)
+        if deadline is not None:
+            if deadline <= time.time():
+                # Already expired, e.g. a record replayed long after it was written
+                self.delete(key)
+                return 0
+            # Value and deadline are swapped in with one store, so lock-free readers see both or neither
+            stored = _Expiring(value, deadline)
+        else:
+            stored = value
+
+        with self.locks.lock_for(key):
+            if version is None:
+                version = self.versions.stamp()
+            was_new_key = None
+            while was_new_key is None:  # None means a concurrent writer changed the path, retry
+                was_new_key = self._insert(key, stored, version)
+            if self.tracker is not None:
+                self.tracker.on_set(key, value, deadline)
+        if deadline is not None:
+            self.expiry.add(key, deadline)
+
+        # Update size if this was a new key
+        if was_new_key:
+            with self.size_lock:
+                self.size += 1
+
+        return version
+
+    def _insert(self, key, value, version):
+        node = self.root
+        i = 0
+        n = len(key)
+        while True:
+            if i == n:
+                with _lock_of(node):
+                    if node.dead:
+                        return None
+                    was_new_key = node.value is _EMPTY
+                    node.value = value
+                    node.version = version
+                return was_new_key
+
+            char = key[i]
+            edges = node.edges
+            edge = edges.get(char) if edges else None
+            if edge is not None and key.startswith(edge[0], i):
+                i += len(edge[0])
+                node = edge[1]
+                continue
+
+            with _lock_of(node):
+                edges = node.edges
+                if node.dead or (edges.get(char) if edges else None) is not edge:
+                    return None
+
+                if edge is None:
+                    # No edge starts with this char: hang the rest of the key off a new leaf
+                    leaf = RadixNode(value, version=version)
+                    if edges is None:
+                        node.edges = {char: (key[i:], leaf)}
+                    else:
+                        edges[char] = (key[i:], leaf)
+                    return True
+
+                # Key diverges inside the edge: split it at the common prefix
+                label, child = edge
+                common = _common_prefix_len(label, key, i)
+                mid = RadixNode(edges={label[common]: (label[common:], child)})
+                if i + common == n:
+                    mid.value = value
+                    mid.version = version
+                else:
+                    mid.edges[key[i + common]] = (key[i + common:], RadixNode(value, version=version))
+                edges[char] = (label[:common], mid)
+                return True
+
+    def get(self, key, with_version=False):
+        """
+        Get a value from the tree
+
+        Args:
+            key (str): The key to retrieve
+            with_version (bool): Also return the key's version
+
+        Returns:
+            any: The stored value or "-1" if key doesn't exist; (value, version) with
+                with_version, version 0 if the key doesn't exist
+        """
+        if with_version:
+            return self._get_versioned(key)
+        if not isinstance(key, str):
+            key = str(key)
+
+        # Same walk as _find, inlined since this is the hot path
+        node = self.root
+        i = 0
+        n = len(key)
+        while i < n:
+            edges = node.edges
+            edge = edges.get(key[i]) if edges else None
+            if edge is None:
+                return "-1"
+            label = edge[0]
+            if not key.startswith(label, i):
+                return "-1"
+            i += len(label)
+            node = edge[1]
+        value = node.value
+        if value is _EMPTY:
+            return "-1"
+        if type(value) is _Expiring:
+            if value.deadline <= time.time():
+                # Lazy expiry: the key is gone as soon as its deadline passes, whether or not the expirer got to it
+                expire_key(self, key, value.deadline)
+                return "-1"
+            value = value.value
+        if self.tracker is not None:
+            self.tracker.on_access(key)
+        return value
+
+    def _get_versioned(self, key):
+        value, deadline, version = self.get_entry(key, with_version=True)
+        if deadline is not None and deadline <= time.time():
+            expire_key(self, key, deadline)
+            return "-1", 0
+        if self.tracker is not None and value != "-1":
+            self.tracker.on_access(key)
+        return value, version
+
+    def get_entry(self, key, with_version=False):
+        """
+        Get a value and its expiry deadline, without checking whether the deadline has passed
+
+        Returns:
+            tuple: (value or "-1" if the key doesn't exist, deadline or None), plus the
+                key's version (0 if it doesn't exist) with with_version
+        """
+        if not isinstance(key, str):
+            key = str(key)
+        node = self._find(key)
+        version = 0
+        value = _EMPTY
+        if node is not None:
+            version = node.version
+            value = node.value
+        deadline = None
+        if value is _EMPTY:
+            value, version = "-1", 0
+        elif type(value) is _Expiring:
+            value, deadline = value.value, value.deadline
+        return (value, deadline, version) if with_version else (value, deadline)
+
+    def _find(self, key, path=None):
+        node = self.root
+        i = 0
+        n = len(key)
+        while i < n:
+            edges = node.edges
+            edge = edges.get(key[i]) if edges else None
+            if edge is None or not key.startswith(edge[0], i):
+                return None
+            if path is not None:
+                path.append((node, key[i], edge))
+            i += len(edge[0])
+            node = edge[1]
+        return node
+
+    def delete(self, key):
+        """
+        Delete a key from the tree
+
+        Args:
+            key (str): The key to delete
+
+        Returns:
+            list: List containing 1 if key was deleted, -1 if key didn't exist
+        """
+        if not isinstance(key, str):
+            key = str(key)
+
+        with self.locks.lock_for(key):
+            was_deleted = None
+            while was_deleted is None:
+                was_deleted = self._remove(key)
+            if was_deleted and self.tracker is not None:
+                self.tracker.on_delete(key)
+
+        if was_deleted:
+            with self.size_lock:
+                self.size -= 1
+            return [1]
+        return [-1]
+
+    def _remove(self, key):
+        path = []
+        node = self._find(key, path)
+        if node is None:
+            return False
+
+        with _lock_of(node):
+            if node.dead:
+                return None
+            if node.value is _EMPTY:
+                return False
+            node.value = _EMPTY
+            node.version = 0
+
+        # Restore the compressed shape; a failed check just leaves a valid, less compact tree
+        while path:
+            parent, char, edge = path.pop()
+            if not self._compact(parent, char, edge, node):
+                break
+            node = parent
+        return True
+
+    def _compact(self, parent, char, edge, node):
+        """Prune an empty leaf or merge a pass-through node into its parent's edge"""
+        with _lock_of(parent), _lock_of(node):
+            if parent.dead or node.dead or parent.edges.get(char) is not edge:
+                return False
+            if node.value is not _EMPTY:
+                return False
+
+            if not node.edges:
+                # Empty leaf: remove it, then check whether the parent became pass-through
+                node.dead = True
+                del parent.edges[char]
+                if not parent.edges and parent is not self.root:
+                    parent.edges = None
+                return True
+
+            if len(node.edges) == 1:
+                # Single child and no value: fold its edge into ours
+                (child_label, child), = node.edges.values()
+                parent.edges[char] = (edge[0] + child_label, child)
+                node.dead = True
+            return False
+
+    def iter_items(self, prefix="", start_after=None, with_expiry=False, with_version=False):
+        """
+        Lazily yield key-value pairs in ascending key order, skipping expired keys
+
+        Args:
+            prefix (str): Only yield keys starting with this prefix
+            start_after (str): Only yield keys sorting after this key
+            with_expiry (bool): Also yield each key's deadline
+            with_version (bool): Also yield each key's deadline and version
+
+        Yields:
+            tuple: (key, value), (key, value, deadline or None) with with_expiry,
+                or (key, value, deadline or None, version) with with_version
+        """
+        now = time.time()
+        # Descend to the prefix's subtree; the prefix may end partway along an edge
+        node = self.root
+        path = ""
+        i = 0
+        while i < len(prefix):
+            edges = node.edges
+            edge = edges.get(prefix[i]) if edges else None
+            if edge is None:
+                return
+            label, child = edge
+            if not (prefix.startswith(label, i) or label.startswith(prefix[i:])):
+                return
+            i += len(label)
+            path += label
+            node = child
+
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            value = node.value
+            if value is not _EMPTY and (start_after is None or path > start_after):
+                deadline = None
+                if type(value) is _Expiring:
+                    value, deadline = value.value, value.deadline
+                if deadline is None or deadline > now:
+                    if with_version:
+                        yield path, value, deadline, node.version
+                    else:
+                        yield (path, value, deadline) if with_expiry else (path, value)
+
+            edges = node.edges
+            if edges:
+                # Pushed in reverse so the smallest child is visited next
+                for char in sorted(edges, reverse=True):
+                    edge = edges.get(char)
+                    if edge is None:
+                        continue
+                    child_path = path + edge[0]
+                    if start_after is not None and child_path < start_after[:len(child_path)]:
+                        continue  # Whole subtree sorts before the cursor
+                    stack.append((edge[1], child_path))
+
+    def scan(self, prefix="", cursor="", count=10, pattern=None, with_expiry=False):
+        """
+        Return one page of a resumable prefix/glob scan
+
+        Args:
+            prefix (str): Only return keys starting with this prefix
+            cursor (str): Cursor returned by the previous page, "" to start
+            count (int): Maximum number of items per page
+            pattern (str): Optional glob the keys must match
+            with_expiry (bool): Also return each key's deadline
+
+        Returns:
+            tuple: (next_cursor, [(key, value), ...]), or (key, value, deadline or None) items
+                with with_expiry; next_cursor is "" once the scan is complete
+        """
+        if pattern is not None:
+            literal = glob_prefix(pattern)
+            if not (literal.startswith(prefix) or prefix.startswith(literal)):
+                return "", []
+            prefix = max(prefix, literal, key=len)
+        return scan_page(self.iter_items(prefix, cursor or None, with_expiry), count, pattern)
+
+    def keys(self, pattern="*"):
+        """
+        Get all key-value pairs from the store, optionally filtered by a glob pattern
+
+        Returns:
+            dict: Dictionary containing all matching key-value pairs in the store
+        """
+        return {key: value for key, value in self.iter_items(glob_prefix(pattern)) if matches(key, pattern)}
@@ -0,0 +1,317 @@
+# replication.py
+# Primary-replica replication: the primary streams its set/delete log to replicas, which apply it and serve reads
+import os
+import socket
+import threading
+import time
+import zlib
+from trie_kv_store import kv_store
+from lock_manager import key_locks
+from wal import wal, encode_record, decode_payload, HEADER, OP_SET, OP_DELETE
+from metrics import metrics
+
+# Stream-only records, never written to the WAL
+OP_PING = 16       # Keeps an idle link alive
+OP_SYNC_DONE = 17  # Ends a full sync's dump
+
+# Most records sent to a replica in one write
+MAX_SEND_RECORDS = 1024
+
+# Replica reconnect backoff, in seconds
+RECONNECT_MIN = 0.1
+RECONNECT_MAX = 2.0
+
+
+class ReadOnlyReplica(Exception):
+    """Raised by the write handlers on a replica, which only takes writes from its primary"""
+
+
+def read_records(reader):
+    """
+    Decode records from a replication link as they arrive
+
+    Yields:
+        tuple: (op, offset, key, value, deadline or None, version or None)
+
+    Raises:
+        ConnectionError: If the link closes mid-stream
+        ValueError: If a record fails its crc32 check
+    """
+    while True:
+        header = reader.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ConnectionError("link closed")
+        length, crc = HEADER.unpack(header)
+        payload = reader.read(length)
+        if len(payload) < length:
+            raise ConnectionError("link closed")
+        if zlib.crc32(payload) != crc:
+            raise ValueError("corrupt replication record")
+        yield decode_payload(payload)
+
+
+class Replication:
+    def __init__(self, store, backlog_bytes=16 * 1024 * 1024, timeout=10.0, ping_interval=1.0):
+        """
+        Initialize replication for store, as a primary until replicate_from is called
+
+        Every set and delete gets the next replication offset and is encoded
+        like a WAL record into an in-memory backlog. Each connected replica
+        has a sender thread that streams the backlog from the replica's
+        offset. A replica that reconnects with the same replication id and
+        an offset still in the backlog resumes where it stopped. Any other
+        replica gets a full sync first: a dump of the store followed by the
+        backlog from the offset the dump starts at.
+
+        Args:
+            store (KVStore): Store to replicate
+            backlog_bytes (int): Size of the record backlog kept for resuming replicas
+            timeout (float): Seconds a link may stall before it is dropped
+            ping_interval (float): Seconds between pings on an idle link
+        """
+        self.store = store
+        self.backlog_bytes = backlog_bytes
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+
+        # Primary side
+        self.role = "primary"
+        self.read_only = False
+        self.streaming = False    # True once serving replicas; the write paths only feed the backlog then
+        self.replid = os.urandom(20).hex()  # Changes on restart, since the backlog does not survive one
+        self.offset = 0           # Offset of the newest record
+        self.records = []         # Encoded records first_offset .. offset
+        self.first_offset = 1
+        self.backlog_size = 0
+        self.cond = threading.Condition()
+        self.replicas = {}        # "host:port" -> offset sent
+
+        # Replica side
+        self.primary = None       # (host, port)
+        self.primary_replid = None
+        self.primary_offset = 0   # Offset of the last record applied
+        self.link_up = False
+        self.full_syncs = 0
+
+    def feed(self, op, key, value=None, deadline=None, version=None):
+        """
+        Add one operation to the backlog and wake the senders
+
+        Called by the write paths with the key's lock stripe held, so each
+        key's records are in the order they were applied.
+        """
+        with self.cond:
+            self.offset += 1
+            record = encode_record(op, self.offset, key, value, deadline, version)
+            self.records.append(record)
+            self.backlog_size += len(record)
+            if self.backlog_size > self.backlog_bytes:
+                self._trim()
+            self.cond.notify_all()
+
+    def _trim(self):
+        # Called with self.cond held; drops a quarter of the backlog at once so trimming stays amortized O(1)
+        target = self.backlog_bytes * 3 // 4
+        drop = 0
+        while self.backlog_size > target and drop < len(self.records):
+            self.backlog_size -= len(self.records[drop])
+            drop += 1
+        del self.records[:drop]
+        self.first_offset += drop
+
+    def _records_after(self, position):
+        # Called with self.cond held; None if the records after position were already trimmed
+        if position + 1 < self.first_offset:
+            return None
+        start = position + 1 - self.first_offset
+        return self.records[start:start + MAX_SEND_RECORDS]
+
+    def serve(self, host='0.0.0.0', port=7380):
+        """Accept replicas on a background thread"""
+        listener = socket.create_server((host, port))
+        self.streaming = True
+        thread = threading.Thread(target=self._accept_loop, args=(listener,), name="repl-listener", daemon=True)
+        thread.start()
+        return thread
+
+    def _accept_loop(self, listener):
+        while True:
+            sock, (host, port) = listener.accept()
+            threading.Thread(target=self._serve_replica, args=(sock, f"{host}:{port}"),
+                             name="repl-sender", daemon=True).start()
+
+    def _serve_replica(self, sock, address):
+        try:
+            sock.settimeout(self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            request = sock.makefile("rb").readline(1024).decode().split()
+            if len(request) != 3 or request[0] != "PSYNC":
+                sock.sendall(b"-ERR expected PSYNC <replid> <offset>\r\n")
+                return
+            replid, position = request[1], int(request[2])
+            with self.cond:
+                resumable = replid == self.replid and self.first_offset - 1 <= position <= self.offset
+            if resumable:
+                sock.sendall(f"+CONTINUE {self.replid}\r\n".encode())
+                print(f"Replica {address} resumed at offset {position}")
+            else:
+                position = self._full_sync(sock)
+                print(f"Replica {address} fully synced at offset {position}")
+            self.replicas[address] = position
+            self._stream(sock, address, position)
+        except (OSError, ValueError) as e:
+            print(f"Replica {address} disconnected: {e}")
+        finally:
+            self.replicas.pop(address, None)
+            sock.close()
+
+    def _full_sync(self, sock):
+        # Fence writers for an instant: every record up to start is applied to the store, none after it
+        with key_locks.acquire_all():
+            start = self.offset
+        sock.sendall(f"+FULLRESYNC {self.replid} {start}\r\n".encode())
+
+        # The dump runs concurrently with writes; whatever it misses or captures early
+        # comes after start in the backlog and is replayed on top, as in wal.compact
+        chunk = []
+        size = 0
+        for key, value, deadline, version in self.store.iter_items(with_version=True):
+            record = encode_record(OP_SET, start, key, value, deadline, version)
+            chunk.append(record)
+            size += len(record)
+            if size >= 65536:
+                sock.sendall(b"".join(chunk))
+                chunk = []
+                size = 0
+        chunk.append(encode_record(OP_SYNC_DONE, start, ""))
+        sock.sendall(b"".join(chunk))
+        return start
+
+    def _stream(self, sock, address, position):
+        while True:
+            with self.cond:
+                if position == self.offset:
+                    self.cond.wait(self.ping_interval)
+                records = self._records_after(position)
+            if records is None:
+                # The replica reconnects and gets a full sync
+                raise ValueError(f"fell more than the backlog behind at offset {position}")
+            if records:
+                sock.sendall(b"".join(records))
+                position += len(records)
+                self.replicas[address] = position
+            else:
+                sock.sendall(encode_record(OP_PING, position, ""))
+
+    def replicate_from(self, host, port):
+        """Become a read-only replica of the primary at host:port, syncing on a background thread"""
+        self.role = "replica"
+        self.read_only = True
+        self.primary = (host, port)
+        thread = threading.Thread(target=self._replica_loop, name="repl-replica", daemon=True)
+        thread.start()
+        return thread
+
+    def _replica_loop(self):
+        host, port = self.primary
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                self._sync_once()
+            except (OSError, ValueError) as e:
+                if self.link_up:
+                    delay = RECONNECT_MIN
+                print(f"Replication link to {host}:{port} lost: {e}")
+            self.link_up = False
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def _sync_once(self):
+        sock = socket.create_connection(self.primary, timeout=self.timeout)
+        try:
+            reader = sock.makefile("rb")
+            sock.sendall(f"PSYNC {self.primary_replid or '?'} {self.primary_offset}\r\n".encode())
+            reply = reader.readline(1024).decode().split()
+            records = read_records(reader)
+            if reply[:1] == ["+FULLRESYNC"] and len(reply) == 3:
+                # Forget the old position first, so a sync that breaks off is retried in full
+                self.primary_replid = None
+                self._load(records)
+                self.primary_replid, self.primary_offset = reply[1], int(reply[2])
+                self.full_syncs += 1
+            elif reply[:1] != ["+CONTINUE"]:
+                raise ValueError(f"unexpected reply from primary: {' '.join(reply)}")
+            self.link_up = True
+
+            for op, offset, key, value, deadline, version in records:
+                if op == OP_PING:
+                    continue
+                if offset != self.primary_offset + 1:
+                    raise ValueError(f"expected offset {self.primary_offset + 1}, got {offset}")
+                self._apply(op, key, value, deadline, version)
+                self.primary_offset = offset
+        finally:
+            sock.close()
+
+    def _load(self, records):
+        # Apply the dump over the current contents so reads keep being served, then drop keys the primary lacks
+        received = set()
+        for op, _, key, value, deadline, version in records:
+            if op == OP_SYNC_DONE:
+                break
+            received.add(key)
+            self._apply(op, key, value, deadline, version)
+        stale = [key for key, _ in self.store.iter_items() if key not in received]
+        for key in stale:
+            self._apply(OP_DELETE, key)
+
+    def _apply(self, op, key, value=None, deadline=None, version=None):
+        # Through the normal write paths, so the replica logs and snapshots what it applies,
+        # keeping the primary's version so CAS works against versions read from either
+        from set_value import apply_set
+        from delete_key import apply_delete
+        with key_locks.lock_for(key):
+            if op == OP_SET:
+                _, lsn = apply_set(key, value, deadline, version)
+            else:
+                _, lsn = apply_delete(key)
+        if lsn is not None:
+            wal.commit(lsn)
+
+    def status(self):
+        if self.role == "replica":
+            host, port = self.primary
+            return {"role": "replica", "primary": f"{host}:{port}", "link": "up" if self.link_up else "down",
+                    "replid": self.primary_replid, "offset": self.primary_offset, "full_syncs": self.full_syncs}
+        with self.cond:
+            offset = self.offset
+            first_offset = self.first_offset
+        return {"role": "primary", "replid": self.replid, "offset": offset,
+                "backlog": {"first_offset": first_offset, "bytes": self.backlog_size},
+                "replicas": [{"address": address, "offset": sent, "lag": offset - sent}
+                             for address, sent in list(self.replicas.items())]}
+
+    def collect_metrics(self):
+        """Replication offset and links, for the /metrics endpoint"""
+        if self.role == "replica":
+            return [
+                ("kv_replication_offset", "gauge", "Offset of the last record applied from the primary",
+                 [({"role": "replica"}, self.primary_offset)]),
+                ("kv_replication_link_up", "gauge", "1 while the link to the primary is up",
+                 [({}, int(self.link_up))]),
+            ]
+        return [
+            ("kv_replication_offset", "gauge", "Offset of the newest record", [({"role": "primary"}, self.offset)]),
+            ("kv_replication_replica_lag", "gauge", "Records not yet sent to each replica",
+             [({"replica": address}, self.offset - sent) for address, sent in list(self.replicas.items())]),
+        ]
+
+
+# Create shared instance used by the write handlers and main.py
+replication = Replication(
+    kv_store,
+    backlog_bytes=int(os.getenv("KV_REPL_BACKLOG_BYTES", str(16 * 1024 * 1024))),
+    timeout=float(os.getenv("KV_REPL_TIMEOUT", "10")),
+    ping_interval=float(os.getenv("KV_REPL_PING_INTERVAL", "1")),
+)
+metrics.add_collector(replication.collect_metrics)
@@ -0,0 +1,22 @@
+# scan_keys.py
+from trie_kv_store import kv_store
+from worker_pool import pool, DEFAULT_TIMEOUT
+from values import unpack
+
+# Largest page a single scan request may ask for
+MAX_SCAN_COUNT = 1000
+
+# Scans are bounded per page and never block on a lock, so they take the inline fast path
+def handle_scan_thread(prefix="", cursor="", count=10, pattern=None, with_expiry=False, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns (next_cursor, [(key, value), ...]); next_cursor is "" once the scan is complete.
+    With with_expiry the items are (key, value, deadline or None).
+    """
+    count = max(1, min(count, MAX_SCAN_COUNT))
+    return pool.run(scan_keys, prefix, cursor, count, pattern, with_expiry, timeout=timeout, inline=True)
+
+
+def scan_keys(prefix, cursor, count, pattern, with_expiry=False):
+    # Walk one page of the prefix's subtree
+    next_cursor, items = kv_store.scan(prefix, cursor, count, pattern, with_expiry)
+    return next_cursor, [(key, unpack(value), *rest) for key, value, *rest in items]
@@ -1,27 +1,69 @@
 from trie_kv_store import kv_store
-from lock_manager import kv_lock
-import threading
+from lock_manager import key_locks
+from worker_pool import pool, DEFAULT_TIMEOUT
+from wal import wal, OP_SET
+from snapshot import snapshots
+from eviction import budget
+from replication import replication, ReadOnlyReplica
+from metrics import metrics
+from values import pack
+from hot_keys import hot_keys
 
-# Helper function to handle retries for setting a key-value pair
-def handle_set_thread(key, value, timeout=0.01):
-    result = [None]
-    # Call thread, append results to result
-    thread = threading.Thread(target=lambda: result.append(set_value(key, value)))
-    thread.start()
-    thread.join(timeout)
+# Sample the lock wait and store traversal phases (see metrics.phase_clock)
+lock_wait_clock = metrics.phase_clock()
+traversal_clock = metrics.phase_clock()
+# Samples accesses for hot-key tracking (see hot_keys.clock)
+hot_clock = hot_keys.clock()
 
-    # If timeout occurs, send another thread out
-    if thread.is_alive():
-        thread = threading.Thread(target=lambda: result.append(set_value(key, value)))
-        thread.start()
-        thread.join(timeout)
-    # Both threads failed - return failure
-    if thread.is_alive():
-        return "-1"
-    return f"{result[1]}"
+# Run the write on the shared worker pool so a stuck lock cannot hold the request past its deadline
+def handle_set_thread(key, value, deadline=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns the key's new version once the value is stored; deadline is the unix time it expires at, None to keep it.
+    Raises worker_pool.DeadlineExceeded if the write could not finish in time,
+    or replication.ReadOnlyReplica on a replica.
+    """
+    return pool.run(set_value, key, value, deadline, timeout=timeout)
 
-def set_value(key, value):
-    # Safely set key-value pair using lock
-    with kv_lock:
-        kv_store.set(key, value)
-        return 0
+def set_value(key, value, deadline=None):
+    if replication.read_only:
+        raise ReadOnlyReplica()
+    if next(hot_clock):
+        hot_keys.record("set", key, value)
+    # Compress before taking the stripe, so other writers never wait on it
+    value = pack(value)
+    # Safely set key-value pair under the key's lock stripe
+    lock = key_locks.lock_for(key)
+    started = next(lock_wait_clock)()
+    with lock:
+        if started:
+            metrics.phase_end("lock_wait", started)
+        version, lsn = apply_set(key, value, deadline)
+    # Wait for durability outside the stripe so other writers can join the same fsync
+    if lsn is not None:
+        wal.commit(lsn)
+    # Evict outside the stripe too, since victims are locked one by one
+    if budget.enabled:
+        budget.evict()
+    return version
+
+def apply_set(key, value, deadline=None, version=None):
+    """
+    The write path every set goes through; the caller holds the key's lock stripe.
+    deadline is the absolute unix time the key expires at, so the log replays the same expiry.
+    The version is stamped here, or adopted from the primary on a replica, and logged and
+    replicated with the value, so the key has the same version everywhere and after a restart.
+    Returns (the key's new version, WAL LSN to commit or None if the WAL is off).
+    """
+    version = kv_store.versions.stamp() if version is None else kv_store.versions.adopt(version)
+    lsn = None
+    if snapshots.enabled:
+        snapshots.record_write(key)
+    if wal.enabled:
+        lsn = wal.append(OP_SET, key, value, deadline, version)
+    if replication.streaming:
+        replication.feed(OP_SET, key, value, deadline, version)
+    started = next(traversal_clock)()
+    version = kv_store.set(key, value, exat=deadline, version=version)
+    if started:
+        metrics.phase_end("traversal", started)
+    return version, lsn
@@ -0,0 +1,333 @@
+# snapshot.py
+# Point-in-time binary snapshots of the store, full and incremental, loaded via mmap
+import os
+import mmap
+import struct
+import threading
+import zlib
+from trie_kv_store import kv_store
+from lock_manager import key_locks
+from wal import wal
+from values import encode as encode_value, decode as decode_value, KIND_JSON
+
+MAGIC = b"OTKVSNP1"
+KIND_FULL = 0
+KIND_INCREMENTAL = 1
+SUFFIXES = {KIND_FULL: ".full", KIND_INCREMENTAL: ".incr"}
+
+# File header: magic, snapshot kind, WAL LSN the snapshot is consistent with
+FILE_HEADER = struct.Struct("<8sBQ")
+# Entry header: flags, key length, value length; followed by the key and value bytes
+ENTRY = struct.Struct("<BII")
+# Follows the entry header when FLAG_EXPIRES is set: unix time the key expires at
+DEADLINE = struct.Struct("<d")
+# Follows the deadline, if any, when FLAG_TYPED is set: the value's kind (see values.encode)
+KIND = struct.Struct("<B")
+# Follows the kind, if any, when FLAG_VERSIONED is set: the key's version
+VERSION = struct.Struct("<Q")
+# File footer: entry count and crc32 of every entry
+FOOTER = struct.Struct("<QI")
+
+FLAG_TOMBSTONE = 1
+FLAG_EXPIRES = 2
+FLAG_TYPED = 4
+FLAG_VERSIONED = 8
+
+# Marks a key that did not exist when the snapshot started
+_ABSENT = object()
+
+
+def encode_entry(key, value, deadline=None, version=None):
+    # Keys from the Redis protocol may hold non-UTF-8 bytes as lone surrogates
+    key_bytes = key.encode("utf-8", "surrogateescape")
+    if value is _ABSENT:
+        return ENTRY.pack(FLAG_TOMBSTONE, len(key_bytes), 0) + key_bytes
+    kind, value_bytes = encode_value(value)
+    flags = 0
+    prefix = b""
+    if deadline is not None:
+        flags |= FLAG_EXPIRES
+        prefix = DEADLINE.pack(deadline)
+    if kind != KIND_JSON:
+        flags |= FLAG_TYPED
+        prefix += KIND.pack(kind)
+    if version is not None:
+        flags |= FLAG_VERSIONED
+        prefix += VERSION.pack(version)
+    return ENTRY.pack(flags, len(key_bytes), len(value_bytes)) + prefix + key_bytes + value_bytes
+
+
+def read_header(path):
+    """
+    Returns:
+        tuple: (kind, lsn) from a snapshot file's header
+
+    Raises:
+        ValueError: If the file is not a snapshot
+    """
+    with open(path, "rb") as f:
+        header = f.read(FILE_HEADER.size)
+    if len(header) < FILE_HEADER.size:
+        raise ValueError(f"{path} is truncated")
+    magic, kind, lsn = FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a snapshot")
+    return kind, lsn
+
+
+def read_snapshot(path):
+    """
+    Decode a snapshot file's entries one at a time through a read-only memory map
+
+    The checksum runs over the map before the first entry is yielded, so a
+    damaged file yields nothing. Entries are then decoded as they are
+    consumed, so a caller that applies each one as it arrives holds a single
+    decoded entry beyond the store, however large the file.
+
+    Yields:
+        tuple: (key, value or _ABSENT, deadline or None, version or None)
+
+    Raises:
+        ValueError: If the file is truncated or fails its checksum
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, _, _ = FILE_HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        body_end = len(data) - FOOTER.size
+        count, crc = FOOTER.unpack_from(data, body_end)
+        view = memoryview(data)
+        try:
+            if zlib.crc32(view[FILE_HEADER.size:body_end]) != crc:
+                raise ValueError(f"{path} failed its checksum")
+
+            offset = FILE_HEADER.size
+            for _ in range(count):
+                flags, key_len, value_len = ENTRY.unpack_from(view, offset)
+                offset += ENTRY.size
+                deadline = None
+                if flags & FLAG_EXPIRES:
+                    deadline, = DEADLINE.unpack_from(view, offset)
+                    offset += DEADLINE.size
+                kind = KIND_JSON
+                if flags & FLAG_TYPED:
+                    kind, = KIND.unpack_from(view, offset)
+                    offset += KIND.size
+                version = None
+                if flags & FLAG_VERSIONED:
+                    version, = VERSION.unpack_from(view, offset)
+                    offset += VERSION.size
+                key = str(view[offset:offset + key_len], "utf-8", "surrogateescape")
+                offset += key_len
+                if flags & FLAG_TOMBSTONE:
+                    yield key, _ABSENT, None, None
+                else:
+                    # decode() copies out of the map, so nothing yielded keeps it open
+                    value = decode_value(kind, view[offset:offset + value_len])
+                    offset += value_len
+                    yield key, value, deadline, version
+        finally:
+            view.release()
+
+
+class SnapshotManager:
+    def __init__(self, store, directory, interval=10.0, full_every=6, enabled=True):
+        """
+        Initialize periodic snapshots of store
+
+        A snapshot is consistent with one WAL LSN: writers are fenced only
+        while the snapshot starts, and afterwards the first write to each key
+        records the key's pre-image (copy-on-write), which the snapshot uses
+        in place of whatever the live store holds by the time it gets there.
+
+        Args:
+            store (KVStore): Store to snapshot
+            directory (str): Where snapshot files live
+            interval (float): Seconds between snapshots
+            full_every (int): Write a full snapshot after this many incrementals
+            enabled (bool): When False no snapshots are taken or loaded
+        """
+        self.enabled = enabled
+        self.store = store
+        self.directory = directory
+        self.interval = interval
+        self.full_every = full_every
+
+        self.dirty = set()          # Keys written since the last snapshot started
+        self.capturing = False      # True while a snapshot is being written
+        self.preimages = {}         # key -> (value, deadline, version) when the running snapshot started
+        self.snapshot_lock = threading.Lock()  # One snapshot at a time
+        self.seq = 0
+        self.incrementals = 0
+        self.timer = None
+
+    def _path(self, seq, kind):
+        return os.path.join(self.directory, f"{seq:012d}{SUFFIXES[kind]}")
+
+    def _list(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            for kind, suffix in SUFFIXES.items():
+                if name.endswith(suffix):
+                    entries.append((int(name[:-len(suffix)]), kind, name))
+        return sorted(entries)
+
+    def record_write(self, key):
+        """
+        Note that key is about to change
+
+        Called with the key's lock stripe held, before the store is modified.
+        """
+        self.dirty.add(key)
+        if self.capturing and key not in self.preimages:
+            value, deadline, version = self.store.get_entry(key, with_version=True)
+            self.preimages[key] = (_ABSENT, None, None) if value == "-1" else (value, deadline, version)
+
+    def snapshot(self, full=False):
+        """
+        Write one snapshot; incremental snapshots only contain keys written since the previous one
+
+        Returns:
+            str: Path of the snapshot file, or None if there was nothing to write
+        """
+        with self.snapshot_lock:
+            os.makedirs(self.directory, exist_ok=True)
+            full = full or self.seq == 0 or self.incrementals >= self.full_every
+
+            # Fence writers for an instant: every record up to lsn is applied, none after it
+            with key_locks.acquire_all():
+                dirty, self.dirty = self.dirty, set()
+                if not full and not dirty:
+                    return None
+                lsn = wal.last_lsn
+                preimages = self.preimages = {}
+                self.capturing = True
+
+            kind = KIND_FULL if full else KIND_INCREMENTAL
+            self.seq += 1
+            path = self._path(self.seq, kind)
+            try:
+                if full:
+                    entries = self._full_entries(preimages)
+                else:
+                    entries = self._dirty_entries(dirty, preimages)
+                self._write(path, kind, lsn, entries)
+            except Exception:
+                # Keep the keys dirty so the next snapshot still covers them
+                self.dirty |= dirty
+                self.seq -= 1
+                raise
+            finally:
+                self.capturing = False
+
+            if full:
+                self.incrementals = 0
+                self._remove_before(self.seq)
+                if wal.enabled:
+                    wal.truncate_through(lsn)
+            else:
+                self.incrementals += 1
+            return path
+
+    def _full_entries(self, preimages):
+        seen = set()  # Only keys that have pre-images, so this stays small
+        for key, value, deadline, version in self.store.iter_items(with_version=True):
+            if key in preimages:
+                seen.add(key)
+                value, deadline, version = preimages[key]
+            if value is not _ABSENT:
+                yield key, value, deadline, version
+        # Keys deleted after the snapshot started were skipped by the walk
+        for key, (value, deadline, version) in list(preimages.items()):
+            if key not in seen and value is not _ABSENT:
+                yield key, value, deadline, version
+
+    def _dirty_entries(self, dirty, preimages):
+        for key in dirty:
+            value, deadline, version = self.store.get_entry(key, with_version=True)
+            # Checked after the lookup: a writer records the pre-image before changing the key
+            if key in preimages:
+                value, deadline, version = preimages[key]
+            elif value == "-1":
+                value = _ABSENT
+            yield key, value, deadline, version
+
+    def _write(self, path, kind, lsn, entries):
+        tmp_path = path + ".tmp"
+        crc = 0
+        count = 0
+        with open(tmp_path, "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, kind, lsn))
+            for key, value, deadline, version in entries:
+                entry = encode_entry(key, value, deadline, version)
+                crc = zlib.crc32(entry, crc)
+                f.write(entry)
+                count += 1
+            f.write(FOOTER.pack(count, crc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove_before(self, seq):
+        for file_seq, _, name in self._list():
+            if file_seq < seq:
+                os.remove(os.path.join(self.directory, name))
+
+    def load(self):
+        """
+        Rebuild the store from the newest full snapshot and the incrementals after it
+
+        Returns:
+            int: The WAL LSN the loaded state is consistent with (0 if there were no snapshots)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        files = self._list()
+        fulls = [i for i, (_, kind, _) in enumerate(files) if kind == KIND_FULL]
+        if not fulls:
+            return 0
+
+        lsn = 0
+        for seq, kind, name in files[fulls[-1]:]:
+            path = os.path.join(self.directory, name)
+            try:
+                _, lsn_in_file = read_header(path)
+                # Applied as they are decoded, so a multi-GB snapshot is never held in memory twice
+                for key, value, deadline, version in read_snapshot(path):
+                    if value is _ABSENT:
+                        self.store.delete(key)
+                    else:
+                        # Keys whose deadline passed while the server was down are dropped
+                        self.store.set(key, value, exat=deadline, version=self.store.versions.adopt(version))
+            except (ValueError, struct.error) as e:
+                # A damaged incremental ends the chain; the WAL replays the rest. The checksum
+                # is verified before the file's first entry is applied
+                print(f"Stopping snapshot load: {e}")
+                break
+            lsn = lsn_in_file
+            self.seq = seq
+        # Keys replayed from the WAL after this point are not tracked as dirty, so start over with a full snapshot
+        self.incrementals = self.full_every
+        return lsn
+
+    def start(self):
+        """Take snapshots every interval seconds on a background timer"""
+        self.timer = threading.Timer(self.interval, self._tick)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _tick(self):
+        try:
+            self.snapshot()
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+        self.start()
+
+
+# Create shared instance used by the write handlers and main.py
+snapshots = SnapshotManager(
+    kv_store,
+    directory=os.getenv("KV_SNAPSHOT_DIR", "./data/snapshots"),
+    interval=float(os.getenv("KV_SNAPSHOT_INTERVAL", "10")),
+    full_every=int(os.getenv("KV_SNAPSHOT_FULL_EVERY", "6")),
+    enabled=os.getenv("KV_SNAPSHOTS", "on") != "off",
+)
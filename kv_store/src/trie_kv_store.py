@@ -1,6 +1,13 @@
 # trie_kv_store.py
 # A basic tree structure for kv storage
+import os
 import threading
+import time
+from lock_manager import key_locks
+from key_scan import glob_prefix, matches, scan_page
+from expiry import TimingWheel, expire_at, expire_key
+from versions import Versions
+from metrics import metrics
 
 class TrieNode:
     def __init__(self):
@@ -9,60 +16,121 @@ class TrieNode:
         self.value = None   # Stores value if this node represents end of a key
         self.is_end = False # Indicates if this node represents end of a key
         self.lock = threading.Lock()  # For thread-safe operations
+        self.dead = False   # Set once the node has been pruned from the trie
+        self.expires = None # Unix time the key expires at, None if it never does
+        self.version = 0    # Version stamp of the last write, 0 while no key ends here
 
 class KVStore:
-    def __init__(self):
-        """Initialize an empty trie-based key-value store"""
+    def __init__(self, locks=key_locks):
+        """
+        Initialize an empty trie-based key-value store
+
+        Args:
+            locks (StripedLockManager): Per-key lock stripes serializing writers of the same key
+        """
         self.root = TrieNode()
         self.size = 0
         self.size_lock = threading.Lock()
+        self.locks = locks
+        self.expiry = TimingWheel()  # Deadlines of keys set with a TTL, drained by expiry.Expirer
+        self.tracker = None          # Optional eviction.MemoryBudget told about every set, delete and read
+        self.versions = Versions()
 
-    def set(self, key, value, **kwargs):
+    def set(self, key, value, ex=None, px=None, exat=None, pxat=None, version=None, **kwargs):
         """
-        Set a value in the trie
+        Set a value in the trie; a set without a TTL option clears any previous TTL
         
         Args:
             key (str): The key to store
             value (any): The value to store
+            ex (int): Expire after this many seconds
+            px (int): Expire after this many milliseconds
+            exat (float): Expire at this unix time, in seconds
+            pxat (int): Expire at this unix time, in milliseconds
+            version (int): Version to store, as stamped by apply_set or adopted from a record;
+                None stamps a new one
             **kwargs: Additional arguments (maintained for compatibility)
             
         Returns:
-            int: 0 on success
+            int: The key's new version, or 0 if the deadline had already passed and the key was deleted
+
+        Raises:
+            ValueError: If the TTL options are invalid
         """
         if not isinstance(key, str):
             key = str(key)
+        deadline = expire_at(ex, px, exat, pxat)
+        if deadline is not None and deadline <= time.time():
+            # Already expired, e.g. a record replayed long after it was written
+            self.delete(key)
+            return 0
             
-        current = self.root
-        
-        # Traverse/build the trie path for this key
-        for char in key:
-            with current.lock:
-                if char not in current.children:
-                    current.children[char] = TrieNode()
-                current = current.children[char]
-        
-        # Set the value at the final node
-        with current.lock:
-            was_new_key = not current.is_end
-            current.value = value
-            current.is_end = True
-            
+        with self.locks.lock_for(key):
+            if version is None:
+                version = self.versions.stamp()
+            while True:
+                current = self.root
+
+                # Traverse/build the trie path for this key
+                for char in key:
+                    with current.lock:
+                        if current.dead:
+                            break  # A concurrent delete pruned this path, start over
+                        if char not in current.children:
+                            current.children[char] = TrieNode()
+                        child = current.children[char]
+                    current = child
+                else:
+                    # Set the value at the final node
+                    with current.lock:
+                        if current.dead:
+                            continue
+                        was_new_key = not current.is_end
+                        current.value = value
+                        current.is_end = True
+                        current.expires = deadline
+                        current.version = version
+                    break
+            if self.tracker is not None:
+                self.tracker.on_set(key, value, deadline)
+        if deadline is not None:
+            self.expiry.add(key, deadline)
+
         # Update size if this was a new key
         if was_new_key:
             with self.size_lock:
                 self.size += 1
                 
-        return 0
+        return version
 
-    def get(self, key):
+    def get(self, key, with_version=False):
         """
         Get a value from the trie
         
         Args:
             key (str): The key to retrieve
+            with_version (bool): Also return the key's version
             
         Returns:
-            any: The stored value or None if key doesn't exist
+            any: The stored value or "-1" if key doesn't exist; (value, version) with
+                with_version, version 0 if the key doesn't exist
+        """
+        value, deadline, version = self.get_entry(key, with_version=True)
+        if deadline is not None and deadline <= time.time():
+            # Lazy expiry: the key is gone as soon as its deadline passes, whether or not the expirer got to it
+            expire_key(self, key, deadline)
+            value, version = "-1", 0
+        elif self.tracker is not None and value != "-1":
+            self.tracker.on_access(key)
+        return (value, version) if with_version else value
+
+    def get_entry(self, key, with_version=False):
+        """
+        Get a value and its expiry deadline, without checking whether the deadline has passed
+
+        Returns:
+            tuple: (value or "-1" if the key doesn't exist, deadline or None), plus the
+                key's version (0 if it doesn't exist) with with_version
         """
         if not isinstance(key, str):
             key = str(key)
@@ -71,11 +139,17 @@ class KVStore:
         
         # Traverse the trie to find the key
         for char in key:
-            if char not in current.children:
-                return "-1"
-            current = current.children[char]
-            
-        return current.value if current.is_end else "-1"
+            current = current.children.get(char)
+            if current is None:
+                return ("-1", None, 0) if with_version else ("-1", None)
+
+        # Read value, is_end, expires and version together so a concurrent write is never seen half-applied
+        with current.lock:
+            if not current.is_end:
+                return ("-1", None, 0) if with_version else ("-1", None)
+            if with_version:
+                return current.value, current.expires, current.version
+            return current.value, current.expires
 
     def delete(self, key):
         """
@@ -93,61 +167,130 @@ class KVStore:
         def _delete_helper(node, key, depth):
             # Base case - reached end of key
             if depth == len(key):
-                if not node.is_end:
-                    return False
                 with node.lock:
+                    if not node.is_end:
+                        return False
                     node.is_end = False
                     node.value = None
+                    node.expires = None
+                    node.version = 0
                 return True
             
             char = key[depth]
-            if char not in node.children:
+            child = node.children.get(char)
+            if child is None:
                 return False
             
-            was_deleted = _delete_helper(node.children[char], key, depth + 1)
+            was_deleted = _delete_helper(child, key, depth + 1)
             
-            # Clean up empty nodes
+            # Clean up empty nodes; parent is locked before child, matching traversal order
             if was_deleted:
-                child = node.children[char]
-                if not child.children and not child.is_end:
-                    with node.lock:
+                with node.lock, child.lock:
+                    if not child.children and not child.is_end and node.children.get(char) is child:
+                        child.dead = True
                         del node.children[char]
             
             return was_deleted
 
-        was_deleted = _delete_helper(self.root, key, 0)
+        with self.locks.lock_for(key):
+            was_deleted = _delete_helper(self.root, key, 0)
+            if was_deleted and self.tracker is not None:
+                self.tracker.on_delete(key)
         if was_deleted:
             with self.size_lock:
                 self.size -= 1
             return [1]
         return [-1]
 
+    def iter_items(self, prefix="", start_after=None, with_expiry=False, with_version=False):
+        """
+        Lazily yield key-value pairs in ascending key order, skipping expired keys
+
+        Only the prefix's subtree is walked, and subtrees sorting entirely
+        before start_after are skipped, so resuming a scan does not re-walk
+        the keys already returned.
+
+        Args:
+            prefix (str): Only yield keys starting with this prefix
+            start_after (str): Only yield keys sorting after this key
+            with_expiry (bool): Also yield each key's deadline
+            with_version (bool): Also yield each key's deadline and version
+
+        Yields:
+            tuple: (key, value), (key, value, deadline or None) with with_expiry,
+                or (key, value, deadline or None, version) with with_version
+        """
+        now = time.time()
+        width = 4 if with_version else 3 if with_expiry else 2
+        # Descend to the prefix's subtree
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return
+
+        stack = [(node, prefix)]
+        while stack:
+            node, path = stack.pop()
+            with node.lock:
+                entry = (path, node.value, node.expires, node.version) if node.is_end else None
+                children = sorted(node.children.items(), reverse=True)
+
+            if entry is not None and (start_after is None or path > start_after):
+                if entry[2] is None or entry[2] > now:
+                    yield entry[:width]
+
+            # Pushed in reverse so the smallest child is visited next
+            for char, child in children:
+                child_path = path + char
+                if start_after is not None and child_path < start_after[:len(child_path)]:
+                    continue  # Whole subtree sorts before the cursor
+                stack.append((child, child_path))
+
+    def scan(self, prefix="", cursor="", count=10, pattern=None, with_expiry=False):
+        """
+        Return one page of a resumable prefix/glob scan
+
+        Args:
+            prefix (str): Only return keys starting with this prefix
+            cursor (str): Cursor returned by the previous page, "" to start
+            count (int): Maximum number of items per page
+            pattern (str): Optional glob the keys must match
+            with_expiry (bool): Also return each key's deadline
+
+        Returns:
+            tuple: (next_cursor, [(key, value), ...]), or (key, value, deadline or None) items
+                with with_expiry; next_cursor is "" once the scan is complete
+        """
+        if pattern is not None:
+            literal = glob_prefix(pattern)
+            if not (literal.startswith(prefix) or prefix.startswith(literal)):
+                return "", []
+            prefix = max(prefix, literal, key=len)
+        return scan_page(self.iter_items(prefix, cursor or None, with_expiry), count, pattern)
+
     def keys(self, pattern="*"):
         """
-        Get all key-value pairs from the store
+        Get all key-value pairs from the store, optionally filtered by a glob pattern
         
         Returns:
-            dict: Dictionary containing all key-value pairs in the store
+            dict: Dictionary containing all matching key-value pairs in the store
         """
-        def _collect_pairs(node, prefix, store_dict):
-            # If this node represents a key's end, add it to our dictionary
-            if node.is_end:
-                store_dict[prefix] = node.value
-                
-            # Recursively traverse all children
-            for char, child in node.children.items():
-                _collect_pairs(child, prefix + char, store_dict)
+        return {key: value for key, value in self.iter_items(glob_prefix(pattern)) if matches(key, pattern)}
 
-        if pattern == "*":  # Get entire contents of store
-            # Dictionary to store all key-value pairs
-            store_contents = {}
-            
-            # Start collection from root with empty prefix
-            _collect_pairs(self.root, "", store_contents)
-            
-            return store_contents
-        else:
-            raise NotImplemented
+# Create singleton instance; KV_ENGINE=radix swaps in the compressed tree
+if os.getenv("KV_ENGINE", "trie") == "radix":
+    from radix_kv_store import RadixKVStore
+    kv_store = RadixKVStore()
+else:
+    kv_store = KVStore()
+
+
+def collect_store_metrics():
+    """The store's key count and pending expiries, for the /metrics endpoint"""
+    return [
+        ("kv_keys", "gauge", "Keys in the store", [({}, kv_store.size)]),
+        ("kv_expiry_scheduled", "gauge", "Deadlines waiting in the expiry wheel", [({}, len(kv_store.expiry))]),
+    ]
 
-# Create singleton instance
-kv_store = KVStore()
+metrics.add_collector(collect_store_metrics)
@@ -0,0 +1,157 @@
+# values.py
+# Stored value forms: JSON values, raw bytes kept as sent, and either one compressed past a size threshold
+import os
+import bz2
+import json
+import lzma
+import zlib
+import base64
+
+# Values whose encoding reaches this many bytes are stored compressed; 0 turns compression off
+COMPRESS_MIN_BYTES = int(os.getenv("KV_COMPRESS_MIN_BYTES", "0"))
+COMPRESS_CODEC = os.getenv("KV_COMPRESS_CODEC", "zlib")
+# 1 is the fastest level of every codec; higher levels trade write CPU for memory
+COMPRESS_LEVEL = int(os.getenv("KV_COMPRESS_LEVEL", "1"))
+
+# Codec name -> (id kept on disk, compress(data, level), decompress(data))
+CODECS = {
+    "zlib": (1, zlib.compress, zlib.decompress),
+    "bz2": (2, bz2.compress, bz2.decompress),
+    "lzma": (3, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+DECOMPRESS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+# On-disk kind byte: the low bit marks raw bytes (else JSON text), the high nibble the codec id
+KIND_JSON = 0
+KIND_RAW = 1
+
+# How raw bytes appear wherever values travel as JSON: mget and scan results, JSON bodies
+BASE64_TAG = "$base64"
+
+
+class Compressed:
+    """A value held compressed; raw tells whether data decompresses to the bytes themselves or to JSON text"""
+    __slots__ = ("codec", "data", "raw")
+
+    def __init__(self, codec, data, raw):
+        self.codec = codec  # Codec id, as in CODECS
+        self.data = data
+        self.raw = raw
+
+
+def pack(value, min_bytes=COMPRESS_MIN_BYTES, codec=COMPRESS_CODEC, level=COMPRESS_LEVEL):
+    """
+    The form value is stored in: compressed if its encoding reaches min_bytes and shrinks, else value itself
+
+    Runs on the write path before any lock is taken, so the CPU spent
+    compressing never holds up other writers.
+    """
+    if not min_bytes:
+        return value
+    if isinstance(value, bytes):
+        data, raw = value, True
+    elif isinstance(value, (list, dict)) or (isinstance(value, str) and len(value) >= min_bytes - 2):
+        data, raw = json.dumps(value).encode(), False
+    else:
+        # Numbers, booleans, null and short strings never reach any sensible threshold
+        return value
+    if len(data) < min_bytes:
+        return value
+    codec_id, compress, _ = CODECS[codec]
+    compressed = compress(data, level)
+    if len(compressed) >= len(data):
+        return value
+    return Compressed(codec_id, compressed, raw)
+
+
+def unpack(value):
+    """The value a client sees, decompressing a Compressed one"""
+    if type(value) is not Compressed:
+        return value
+    data = DECOMPRESS[value.codec](value.data)
+    return data if value.raw else json.loads(data)
+
+
+def value_size(value):
+    """Cheap estimate of a value's in-memory size"""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if type(value) is Compressed:
+        return len(value.data)
+    if value is None or isinstance(value, (bool, int, float)):
+        return 8
+    return len(json.dumps(value))
+
+
+def encode(value):
+    """
+    Encode a stored value for the WAL, snapshots and replication
+
+    Compressed values are written as they are held, so nothing is
+    recompressed on the way to disk or decompressed on the way back.
+
+    Returns:
+        tuple: (kind byte, encoded bytes)
+    """
+    if type(value) is Compressed:
+        return value.codec << 4 | (KIND_RAW if value.raw else KIND_JSON), value.data
+    if isinstance(value, bytes):
+        return KIND_RAW, value
+    return KIND_JSON, json.dumps(value).encode()
+
+
+def decode(kind, data):
+    """The stored value encode() produced (kind, data) from; data may be a memoryview"""
+    codec_id = kind >> 4
+    raw = bool(kind & KIND_RAW)
+    if codec_id:
+        return Compressed(codec_id, bytes(data), raw)
+    if raw:
+        return bytes(data)
+    return json.loads(bytes(data))
+
+
+def byte_range(header, length):
+    """
+    The (start, stop) slice of a length-byte value a Range header asks for
+
+    Only a single "bytes=" range is honoured; anything else is ignored, as
+    HTTP allows, and the whole value is served.
+
+    Returns:
+        tuple: (start, stop), or None to serve the whole value
+
+    Raises:
+        ValueError: If the range starts past the end of the value (a 416)
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            # "bytes=-N": the last N bytes
+            suffix = int(last)
+            return (max(0, length - suffix), length) if suffix > 0 else None
+        start = int(first)
+        stop = min(int(last) + 1, length) if last else length
+    except ValueError:
+        return None
+    if start < 0 or stop <= start and start < length:
+        return None
+    if start >= length:
+        raise ValueError("range not satisfiable")
+    return start, stop
+
+
+def to_json(value):
+    """value as it goes into a JSON response: raw bytes become {"$base64": "..."}"""
+    if isinstance(value, bytes):
+        return {BASE64_TAG: base64.b64encode(value).decode()}
+    return value
+
+
+def from_json(value):
+    """Inverse of to_json, for values arriving in JSON bodies"""
+    if type(value) is dict and len(value) == 1 and BASE64_TAG in value:
+        return base64.b64decode(value[BASE64_TAG], validate=True)
+    return value
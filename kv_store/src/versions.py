@@ -0,0 +1,49 @@
+# versions.py
+# Per-key version stamps shared by both store engines, for compare-and-set
+import itertools
+import threading
+import time
+
+
+class Versions:
+    def __init__(self):
+        """
+        Version stamps for a store: unique across its keys and increasing with every write
+
+        The count starts at the current time in microseconds, so a store
+        that starts empty, or replays records that carry no version, stamps
+        above any version a client saw before it, unless the last run
+        averaged over a million writes a second. A stale version then fails
+        its compare-and-set instead of matching a recreated key.
+
+        Versions stamped elsewhere, by the primary or before a restart, come
+        back through adopt(), so a key keeps the version clients saw for it
+        on the primary, on its replicas and after a restart or failover.
+        """
+        start = time.time_ns() // 1000
+        self.counter = itertools.count(start)
+        self.floor = start  # The counter never hands out less than this
+        self.lock = threading.Lock()
+
+    def stamp(self):
+        """A fresh version; next() on a count is atomic under the GIL"""
+        return next(self.counter)
+
+    def adopt(self, version):
+        """
+        Keep a version read from a log, a snapshot or the primary, and stamp above it from now on
+
+        Called by replay and by a replica's apply path, which do not race
+        with local stamps: replay runs before serving, and replicas are read-only.
+
+        Returns:
+            int: version, or None if it is None (a record written without one), so the store stamps the key
+        """
+        if version is not None and version >= self.floor:
+            with self.lock:
+                if version >= self.floor:
+                    # Drawing from the old counter skips a stamp but never goes back below one handed out
+                    start = max(version + 1, next(self.counter))
+                    self.counter = itertools.count(start)
+                    self.floor = start
+        return version
@@ -0,0 +1,389 @@
+# wal.py
+# Binary write-ahead log for the set/delete paths, with group commit, rotation and replay
+import os
+import struct
+import threading
+import time
+import zlib
+from lock_manager import key_locks
+from worker_pool import pool
+from values import encode as encode_value, decode as decode_value, KIND_JSON
+
+OP_SET = 1
+OP_DELETE = 2
+# On disk only: a set carrying an expiry deadline, decoded back to OP_SET
+OP_SET_EXPIRING = 3
+# On disk only: sets of raw bytes or compressed values, whose value bytes follow a kind byte (see values.encode)
+OP_SET_TYPED = 4
+OP_SET_TYPED_EXPIRING = 5
+# On disk only: set on a set op when the key's version follows the key (see versions.Versions)
+OP_VERSIONED = 0x40
+
+# Record framing: payload length and crc32 of the payload, then the payload itself
+HEADER = struct.Struct("<II")
+# Payload prefix: op, log sequence number, key length; followed by the key and value bytes
+PAYLOAD = struct.Struct("<BQI")
+# Precedes the value bytes of OP_SET_EXPIRING records: unix time the key expires at
+DEADLINE = struct.Struct("<d")
+# Follows the deadline, if any, of OP_SET_TYPED records
+KIND = struct.Struct("<B")
+# Follows the key of OP_VERSIONED records: the key's version
+VERSION = struct.Struct("<Q")
+
+SEGMENT_SUFFIX = ".log"
+BASE_SUFFIX = ".base"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def encode_record(op, lsn, key, value=None, deadline=None, version=None):
+    # Keys from the Redis protocol may hold non-UTF-8 bytes as lone surrogates
+    key_bytes = key.encode("utf-8", "surrogateescape")
+    value_bytes = b""
+    if op == OP_SET:
+        kind, value_bytes = encode_value(value)
+        # Plain JSON values keep the original record layout
+        if kind != KIND_JSON:
+            op = OP_SET_TYPED
+            value_bytes = KIND.pack(kind) + value_bytes
+        if deadline is not None:
+            op = OP_SET_TYPED_EXPIRING if op == OP_SET_TYPED else OP_SET_EXPIRING
+            value_bytes = DEADLINE.pack(deadline) + value_bytes
+        if version is not None:
+            op |= OP_VERSIONED
+            value_bytes = VERSION.pack(version) + value_bytes
+    payload = PAYLOAD.pack(op, lsn, len(key_bytes)) + key_bytes + value_bytes
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def iter_records(data):
+    """
+    Decode records from a segment's bytes
+
+    Stops at the first torn or corrupt record, which can only be the tail
+    left by a crash mid-write.
+
+    Yields:
+        tuple: (op, lsn, key, value, deadline or None, version or None)
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(data)
+    while offset + HEADER.size <= end:
+        length, crc = HEADER.unpack_from(view, offset)
+        start = offset + HEADER.size
+        if start + length > end or length < PAYLOAD.size:
+            return
+        payload = view[start:start + length]
+        if zlib.crc32(payload) != crc:
+            return
+        yield decode_payload(payload)
+        offset = start + length
+
+
+def decode_payload(payload):
+    """
+    Decode one record's payload, already checked against its crc32
+
+    Returns:
+        tuple: (op, lsn, key, value, deadline or None, version or None)
+    """
+    op, lsn, key_len = PAYLOAD.unpack_from(payload)
+    key_end = PAYLOAD.size + key_len
+    key = bytes(payload[PAYLOAD.size:key_end]).decode("utf-8", "surrogateescape")
+    value = deadline = version = None
+    kind = KIND_JSON
+    if op & OP_VERSIONED:
+        op &= ~OP_VERSIONED
+        version, = VERSION.unpack_from(payload, key_end)
+        key_end += VERSION.size
+    if op in (OP_SET_EXPIRING, OP_SET_TYPED_EXPIRING):
+        deadline, = DEADLINE.unpack_from(payload, key_end)
+        key_end += DEADLINE.size
+    if op in (OP_SET_TYPED, OP_SET_TYPED_EXPIRING):
+        kind, = KIND.unpack_from(payload, key_end)
+        key_end += KIND.size
+    if op in (OP_SET, OP_SET_EXPIRING, OP_SET_TYPED, OP_SET_TYPED_EXPIRING):
+        op = OP_SET
+        value = decode_value(kind, payload[key_end:])
+    return op, lsn, key, value, deadline, version
+
+
+class WriteAheadLog:
+    def __init__(self, directory, fsync_policy="interval", fsync_interval_ms=10,
+                 segment_bytes=64 * 1024 * 1024, max_segments=8, enabled=True):
+        """
+        Initialize a write-ahead log stored as numbered segment files in directory
+
+        Args:
+            directory (str): Where segment and base files live
+            fsync_policy (str): "always" waits for fsync before acknowledging a write
+                (concurrent writers share one fsync), "interval" fsyncs every
+                fsync_interval_ms in the background, "never" leaves it to the OS
+            fsync_interval_ms (int): Background flush period
+            segment_bytes (int): Segment size at which the log rotates
+            max_segments (int): Segment count at which the log is compacted
+            enabled (bool): When False the handlers skip the log entirely
+        """
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES}")
+        self.enabled = enabled
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval_ms / 1000
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+
+        self.lock = threading.Lock()       # Orders appends and owns the active segment
+        self.sync_lock = threading.Lock()  # One fsync at a time; later waiters piggyback on it
+        self.file = None
+        self.retired = []                  # Rotated segments not yet fsynced and closed
+        self.segment_size = 0
+        self.segment_count = 0
+        self.last_lsn = 0
+        self.synced_lsn = 0
+        self.store = None
+        self.compact_requested = False
+        self.flusher = None
+        self.closed = False
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _list(self, suffix):
+        # File names are zero-padded LSNs, so name order is LSN order
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(suffix))
+        return [(int(name[:-len(suffix)]), name) for name in names]
+
+    def replay(self, store, after_lsn=0):
+        """
+        Rebuild store from the newest base file plus every segment after it
+
+        Args:
+            store (KVStore): Store to apply the records to
+            after_lsn (int): Skip records at or below this LSN (already loaded from a snapshot)
+
+        Returns:
+            int: Number of records applied
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        applied = 0
+        base_lsn = after_lsn
+        bases = self._list(BASE_SUFFIX)
+        if bases and bases[-1][0] > after_lsn:
+            base_lsn, name = bases[-1]
+            with open(self._path(name), "rb") as f:
+                for _, _, key, value, deadline, version in iter_records(f.read()):
+                    store.set(key, value, exat=deadline, version=store.versions.adopt(version))
+                    applied += 1
+        self.last_lsn = base_lsn
+
+        for _, name in self._list(SEGMENT_SUFFIX):
+            with open(self._path(name), "rb") as f:
+                for op, lsn, key, value, deadline, version in iter_records(f.read()):
+                    if lsn <= base_lsn:
+                        continue  # Already captured by the base
+                    if op == OP_SET:
+                        # Keys whose deadline passed while the server was down are dropped
+                        store.set(key, value, exat=deadline, version=store.versions.adopt(version))
+                    else:
+                        store.delete(key)
+                    self.last_lsn = lsn
+                    applied += 1
+        return applied
+
+    def recover(self, store, after_lsn=0, compact=True):
+        """
+        Replay the log into store, then open it for appends
+
+        Args:
+            store (KVStore): Store to rebuild
+            after_lsn (int): LSN already covered by a loaded snapshot
+            compact (bool): Compact into base files; off when snapshots truncate the log instead
+        """
+        applied = self.replay(store, after_lsn)
+        if compact:
+            self.store = store
+        self.open(scan=False)
+        return applied
+
+    def open(self, scan=True):
+        """Start a fresh segment after the last logged LSN and start the background flusher"""
+        with self.lock:
+            if self.file is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            if scan:
+                self.last_lsn = self._scan_last_lsn()
+            self.synced_lsn = self.last_lsn
+            self.segment_count = len(self._list(SEGMENT_SUFFIX))
+            self._start_segment()
+        self.flusher = threading.Thread(target=self._flush_worker, name="wal-flusher", daemon=True)
+        self.flusher.start()
+
+    def _scan_last_lsn(self):
+        for first_lsn, name in reversed(self._list(SEGMENT_SUFFIX)):
+            with open(self._path(name), "rb") as f:
+                last = None
+                for _, lsn, _, _, _, _ in iter_records(f.read()):
+                    last = lsn
+            if last is not None:
+                return last
+        bases = self._list(BASE_SUFFIX)
+        return bases[-1][0] if bases else 0
+
+    def _start_segment(self):
+        # Called with self.lock held; a segment is named after the first LSN it will hold.
+        # A leftover file with this name holds no valid records, so it is safe to truncate
+        name = f"{self.last_lsn + 1:020d}{SEGMENT_SUFFIX}"
+        self.file = open(self._path(name), "wb")
+        self.segment_size = 0
+        self.segment_count += 1
+
+    def _rotate(self):
+        # Called with self.lock held; the old file is fsynced and closed by the next sync
+        self.file.flush()
+        self.retired.append(self.file)
+        self._start_segment()
+        if self.store is not None and self.segment_count > self.max_segments:
+            self.compact_requested = True
+
+    def append(self, op, key, value=None, deadline=None, version=None):
+        """
+        Append one operation to the log
+
+        Callers hold the key's lock stripe across append and the store update,
+        so log order matches apply order for every key. A set's expiry is
+        logged as an absolute deadline, so replay expires it on time.
+
+        Returns:
+            int: The record's log sequence number
+        """
+        if self.file is None:
+            self.open()
+        with self.lock:
+            self.last_lsn += 1
+            record_lsn = self.last_lsn
+            record = encode_record(op, record_lsn, key, value, deadline, version)
+            self.file.write(record)
+            self.segment_size += len(record)
+            if self.segment_size >= self.segment_bytes:
+                self._rotate()
+        return record_lsn
+
+    def commit(self, lsn):
+        """Block until lsn is durable if the policy requires it"""
+        if self.fsync_policy == "always":
+            # The write is applied and logged, so a slow fsync must not turn it into a timeout
+            pool.mark_applied()
+            self.sync(lsn)
+
+    def sync(self, lsn=None, fsync=True):
+        """
+        Flush buffered records to the OS and fsync them
+
+        With group commit, a writer whose record was covered by another
+        writer's fsync returns immediately.
+        """
+        with self.sync_lock:
+            if lsn is not None and self.synced_lsn >= lsn:
+                return
+            with self.lock:
+                if self.file is None:
+                    return
+                self.file.flush()
+                target = self.last_lsn
+                retired, self.retired = self.retired, []
+                fd = self.file.fileno()
+            # fsync outside self.lock so appends continue while the disk works
+            for f in retired:
+                if fsync:
+                    os.fsync(f.fileno())
+                f.close()
+            if fsync:
+                os.fsync(fd)
+            self.synced_lsn = target
+
+    def _flush_worker(self):
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            try:
+                if self.fsync_policy == "interval":
+                    self.sync()
+                elif self.fsync_policy == "never":
+                    self.sync(fsync=False)
+                if self.compact_requested:
+                    self.compact()
+            except Exception as e:
+                print(f"Error flushing write-ahead log: {e}")
+
+    def compact(self):
+        """
+        Replace every existing segment with a single base file holding the live keys
+
+        All writers are fenced for the instant the log rotates, so every
+        record up to the new base LSN is already applied to the store. The
+        dump itself runs concurrently with writes; anything it misses or
+        captures early is logged after the base LSN and replayed on top.
+        """
+        store = self.store
+        if store is None:
+            return
+        with key_locks.acquire_all():
+            with self.lock:
+                self._rotate()
+                base_lsn = self.last_lsn
+                self.compact_requested = False
+                self.segment_count = 1
+
+        tmp_path = self._path(f"{base_lsn:020d}{BASE_SUFFIX}.tmp")
+        with open(tmp_path, "wb") as f:
+            for key, value, deadline, version in store.iter_items(with_version=True):
+                f.write(encode_record(OP_SET, base_lsn, key, value, deadline, version))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path(f"{base_lsn:020d}{BASE_SUFFIX}"))
+        self.sync(fsync=self.fsync_policy != "never")
+
+        # The new base supersedes every older base and segment
+        for lsn, name in self._list(BASE_SUFFIX):
+            if lsn < base_lsn:
+                os.remove(self._path(name))
+        for first_lsn, name in self._list(SEGMENT_SUFFIX):
+            if first_lsn <= base_lsn:
+                os.remove(self._path(name))
+
+    def truncate_through(self, lsn):
+        """Remove base files and segments whose records are all at or below lsn"""
+        with self.lock:
+            active = self.file.name if self.file is not None else None
+        segments = self._list(SEGMENT_SUFFIX)
+        removable = [name for (_, name), (next_first, _) in zip(segments, segments[1:]) if next_first <= lsn + 1]
+        removable += [name for base_lsn, name in self._list(BASE_SUFFIX) if base_lsn <= lsn]
+        for name in removable:
+            if self._path(name) == active:
+                continue
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+        self.segment_count = len(self._list(SEGMENT_SUFFIX))
+
+    def close(self):
+        """Flush and fsync everything, then stop the background flusher"""
+        self.closed = True
+        self.sync(fsync=self.fsync_policy != "never")
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Create shared instance used by the set/delete handlers
+wal = WriteAheadLog(
+    directory=os.getenv("KV_WAL_DIR", "./data/wal"),
+    fsync_policy=os.getenv("KV_WAL_FSYNC", "interval"),
+    fsync_interval_ms=int(os.getenv("KV_WAL_FSYNC_MS", "10")),
+    segment_bytes=int(os.getenv("KV_WAL_SEGMENT_BYTES", str(64 * 1024 * 1024))),
+    max_segments=int(os.getenv("KV_WAL_MAX_SEGMENTS", "8")),
+    enabled=os.getenv("KV_WAL", "on") != "off",
+)
@@ -0,0 +1,205 @@
+# worker_pool.py
+# A shared, bounded pool of worker threads with per-request deadlines
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from metrics import metrics
+
+# Default deadline for an operation (the old handlers waited 2 x 10ms)
+DEFAULT_TIMEOUT = float(os.getenv("KV_OP_TIMEOUT", "0.02"))
+
+# Samples how long tasks wait in the queue (see metrics.phase_clock)
+queue_clock = metrics.phase_clock()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an operation did not finish before its deadline"""
+
+
+class PoolSaturated(Exception):
+    """Raised when the pool's queue is full and a task cannot be accepted"""
+
+
+class WorkerPool:
+    def __init__(self, num_workers=8, max_queue=1024, name="kv-worker"):
+        """
+        Initialize a fixed set of long-lived worker threads
+
+        Args:
+            num_workers (int): Number of worker threads to start
+            max_queue (int): Maximum number of tasks waiting for a worker
+            name (str): Prefix used when naming the worker threads
+        """
+        self.tasks = queue.Queue(maxsize=max_queue)
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "submitted": 0,
+            "inline": 0,
+            "completed": 0,
+            "failed": 0,
+            "timed_out": 0,    # Caller stopped waiting before the task finished
+            "cancelled": 0,    # Task was dropped before it ever started
+            "abandoned": 0,    # Task finished after its caller had given up
+            "late_commit": 0,  # Write applied before the deadline, durable after it; its caller waited
+            "rejected": 0,     # Queue was full
+        }
+        self.current = threading.local()  # (future, deadline) of the task each worker is running
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _count(self, stat, n=1):
+        with self.stats_lock:
+            self.stats[stat] += n
+
+    def _worker(self):
+        # Worker continuously pulls tasks until it receives the exit signal
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, deadline, queued, fn, args = task
+            if queued:
+                metrics.phase_end("queue", queued)
+
+            # Skip work whose caller has already given up or whose deadline passed
+            if not future.set_running_or_notify_cancel():
+                self._count("cancelled")
+                continue
+            if deadline is not None and time.monotonic() > deadline:
+                future.set_exception(DeadlineExceeded())
+                self._count("cancelled")
+                continue
+
+            self.current.task = (future, deadline)
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+                self._count("failed")
+            else:
+                future.set_result(result)
+                self._count("completed")
+            finally:
+                self.current.task = None
+
+            if deadline is not None and time.monotonic() > deadline and not self.was_applied(future):
+                self._count("abandoned")
+
+    def mark_applied(self):
+        """
+        Note that the running task's write is in the store and the log, so only its commit remains
+
+        Called by wal.commit before it waits on fsync. If this happens before
+        the deadline, a caller whose deadline then runs out keeps waiting
+        instead of answering 504: the write has happened, and a timeout would
+        make clients retry it. A no-op outside a pool task.
+        """
+        task = getattr(self.current, "task", None)
+        if task is not None:
+            future, deadline = task
+            if deadline is None or time.monotonic() <= deadline:
+                future.applied = True
+
+    @staticmethod
+    def was_applied(future):
+        """Whether the task behind future called mark_applied before its deadline"""
+        return getattr(future, "applied", False)
+
+    def submit(self, fn, *args, timeout=None):
+        """
+        Queue fn(*args) for a worker thread
+
+        Args:
+            fn (callable): The operation to run
+            *args: Arguments passed to fn
+            timeout (float): Seconds from now after which the task is dropped
+
+        Returns:
+            Future: Resolves to the return value of fn
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        future = Future()
+        # Sampled enqueue time, so the worker can record how long the task waited
+        queued = next(queue_clock)()
+        try:
+            self.tasks.put_nowait((future, deadline, queued, fn, args))
+        except queue.Full:
+            self._count("rejected")
+            raise PoolSaturated()
+        self._count("submitted")
+        return future
+
+    def run(self, fn, *args, timeout=DEFAULT_TIMEOUT, inline=False):
+        """
+        Run fn(*args) and wait for its result until the deadline
+
+        Args:
+            fn (callable): The operation to run
+            *args: Arguments passed to fn
+            timeout (float): Seconds to wait before giving up on the result
+            inline (bool): Run on the calling thread instead of a worker (fast path)
+
+        Returns:
+            any: The return value of fn
+
+        Raises:
+            DeadlineExceeded: If the result was not ready before the deadline,
+                unless the write was applied by then and only its commit was outstanding (see mark_applied)
+            PoolSaturated: If the queue was full
+        """
+        if inline:
+            self._count("inline")
+            return fn(*args)
+
+        future = self.submit(fn, *args, timeout=timeout)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            if self.was_applied(future):
+                # Only the commit ran past the deadline; the deadline bounds getting the write applied
+                self._count("late_commit")
+                return future.result()
+            # Cancel if still queued, otherwise the worker will count it abandoned
+            future.cancel()
+            self._count("timed_out")
+            raise DeadlineExceeded()
+
+    def snapshot_stats(self):
+        """Return a copy of the pool's counters along with the current queue depth"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["queued"] = self.tasks.qsize()
+        stats["workers"] = len(self.workers)
+        return stats
+
+    def collect_metrics(self):
+        """The pool's counters and queue depth, for the /metrics endpoint"""
+        stats = self.snapshot_stats()
+        queued = stats.pop("queued")
+        workers = stats.pop("workers")
+        return [
+            ("kv_pool_tasks_total", "counter", "Worker pool tasks by outcome",
+             [({"outcome": outcome}, count) for outcome, count in stats.items()]),
+            ("kv_pool_queue_depth", "gauge", "Tasks waiting for a worker", [({}, queued)]),
+            ("kv_pool_workers", "gauge", "Worker threads", [({}, workers)]),
+        ]
+
+    def shutdown(self):
+        """Signal every worker to exit once the queued work is drained"""
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+# Create shared instance used by every request handler
+pool = WorkerPool(
+    num_workers=int(os.getenv("KV_WORKERS", "8")),
+    max_queue=int(os.getenv("KV_WORKER_QUEUE", "1024")),
+)
+metrics.add_collector(pool.collect_metrics)
@@ -0,0 +1,104 @@
+import sys
+import threading
+import time
+import random
+import argparse
+sys.path.append("./kv_store/src")
+from trie_kv_store import KVStore
+from radix_kv_store import RadixKVStore
+
+ENGINES = {"trie": KVStore, "radix": RadixKVStore}
+
+# Configure the stress run
+WRITER_COUNTS = [1, 2, 4, 8]
+NUM_READERS = 4
+KEYS_PER_WRITER = 50
+DURATION = 2.0
+
+def writer_keys(writer_id):
+    # Each writer's keys extend the previous writer's ("k1", "k1x", "k1xx", ...) so pruning races with inserts
+    return [f"k{i}" + "x" * writer_id for i in range(KEYS_PER_WRITER)]
+
+def writer(store, writer_id, stop, final_state, op_counts):
+    # Each key is owned by exactly one writer, so its final state is known
+    rng = random.Random(writer_id)
+    keys = writer_keys(writer_id)
+    ops = 0
+    seq = 0
+    while not stop.is_set():
+        key = rng.choice(keys)
+        if rng.random() < 0.6:
+            seq += 1
+            value = {"key": key, "seq": seq}
+            store.set(key, value)
+            final_state[key] = value
+        else:
+            store.delete(key)
+            final_state[key] = None
+        ops += 1
+    op_counts[writer_id] = ops
+
+def reader(store, keys, stop, violations, op_counts, reader_id):
+    rng = random.Random(1000 + reader_id)
+    ops = 0
+    while not stop.is_set():
+        key = rng.choice(keys)
+        value = store.get(key)
+        # A read sees either nothing or a complete value written for this exact key
+        if value != "-1" and (not isinstance(value, dict) or value.get("key") != key):
+            violations.append((key, value))
+        ops += 1
+    op_counts[reader_id] = ops
+
+def run(engine, num_writers):
+    store = ENGINES[engine]()
+    stop = threading.Event()
+    final_state = {}
+    violations = []
+    writer_ops = {}
+    reader_ops = {}
+    all_keys = [key for w in range(num_writers) for key in writer_keys(w)]
+
+    threads = [threading.Thread(target=writer, args=(store, w, stop, final_state, writer_ops))
+               for w in range(num_writers)]
+    threads += [threading.Thread(target=reader, args=(store, all_keys, stop, violations, reader_ops, r))
+                for r in range(NUM_READERS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # Every key must hold exactly what its writer last did: no lost or resurrected writes
+    for key, expected in final_state.items():
+        value = store.get(key)
+        if (expected is None and value != "-1") or (expected is not None and value != expected):
+            violations.append((key, value))
+    live = sum(1 for value in final_state.values() if value is not None)
+    if store.size != live or len(store.keys()) != live:
+        violations.append(("size", store.size, live))
+
+    write_throughput = sum(writer_ops.values()) / DURATION
+    read_throughput = sum(reader_ops.values()) / DURATION
+    print(f"{num_writers} writers: {write_throughput:.0f} writes/sec, "
+          f"{read_throughput:.0f} reads/sec, {len(violations)} violations")
+    return violations
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Stress concurrent reads and writes against a store engine')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='trie', help='Store engine to stress (default: trie)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    failed = False
+    for num_writers in WRITER_COUNTS:
+        violations = run(args.engine, num_writers)
+        if violations:
+            failed = True
+            print(f"First violations: {violations[:5]}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
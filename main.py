@@ -1,25 +1,92 @@
 import threading
 import argparse
+import atexit
 import sys
-import fastwsgi
 import uvicorn
+from werkzeug.serving import make_server, WSGIRequestHandler
 sys.path.append("./kv_store")
-from logger import log_entire_store
+sys.path.append("./kv_store/src")
 from app import app
+from asgi_app import app as asgi_app, use_redis_backend
+from resp_server import start_resp_server
+from trie_kv_store import kv_store
+from wal import wal
+from snapshot import snapshots
+from expiry import Expirer
+from eviction import budget
+from replication import replication
+
+class KeepAliveHandler(WSGIRequestHandler):
+    # HTTP/1.1 so clients such as benchmark.py's requests.Session reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        # Requests go to the access log; a line per request on stderr would cost more than serving it
+        pass
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Start KV Store server')
     parser.add_argument('--nodes', type=int, default=3, help='Number of Redis nodes to create (default: 3)')
     parser.add_argument('--base-port', type=int, default=6379, help='Base port number for Redis nodes (default: 6379)')
     parser.add_argument('--port', type=int, default=8080, help='Port to run the FastAPI application (default: 8080)')
+    parser.add_argument('--mode', choices=['wsgi', 'asgi'], default='wsgi', help='Serve the Flask app from a threaded WSGI server or the async app with uvicorn (default: wsgi)')
+    parser.add_argument('--resp-port', type=int, default=7379, help='Port for the Redis-protocol front end, 0 to disable (default: 7379)')
+    parser.add_argument('--repl-port', type=int, default=0, help='Port replicas connect to for the replication stream, 0 to disable (default: 0)')
+    parser.add_argument('--replica-of', metavar='HOST:PORT', help="Run as a read-only replica of the primary's replication port")
+    parser.add_argument('--backend', choices=['trie', 'redis'], default='trie', help='Store behind the asgi app (default: trie)')
     return parser.parse_args()
 
+def run_wsgi(port):
+    # A thread per connection, blocked in socket calls that release the GIL, so the RESP server,
+    # the WAL flusher, the expirer, snapshots and replication keep running while clients hold
+    # keep-alive connections open
+    server = make_server('0.0.0.0', port, app, threaded=True, request_handler=KeepAliveHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 if __name__ == '__main__':
     args = parse_args()
 
-    # Start background thread for logging the entire store
-    pulse_thread = threading.Thread(target=log_entire_store, daemon=True)
-    pulse_thread.start()
+    # Rebuild the store from the latest snapshots, then the write-ahead log records after them
+    snapshot_lsn = 0
+    if snapshots.enabled:
+        snapshot_lsn = snapshots.load()
+        print(f"Loaded {kv_store.size} keys from snapshots (LSN {snapshot_lsn})")
+    if wal.enabled:
+        replayed = wal.recover(kv_store, after_lsn=snapshot_lsn, compact=not snapshots.enabled)
+        print(f"Replayed {replayed} write-ahead log records")
+        atexit.register(wal.close)
+
+    # The budget may have shrunk since the data was written
+    if budget.enabled:
+        print(f"Evicted {budget.evict()} keys to fit KV_MAXMEMORY")
+
+    # Delete keys in the background as their TTLs run out
+    Expirer(kv_store).start()
+
+    # Start periodic snapshots of the store
+    if snapshots.enabled:
+        snapshots.start()
+
+    # Follow a primary as a read-only replica, and/or stream this node's writes to replicas
+    if args.replica_of:
+        host, _, port = args.replica_of.rpartition(':')
+        replication.replicate_from(host or '127.0.0.1', int(port))
+    if args.repl_port:
+        replication.serve(port=args.repl_port)
+
+    # Serve the Redis protocol alongside the HTTP API
+    if args.resp_port:
+        start_resp_server(port=args.resp_port)
 
-    fastwsgi.run(wsgi_app=app, host='0.0.0.0', port=args.port)
+    if args.mode == 'asgi':
+        if args.backend == 'redis':
+            use_redis_backend(args.nodes, args.base_port)
+        uvicorn.run(asgi_app, host='0.0.0.0', port=args.port, log_level='warning')
+    else:
+        run_wsgi(args.port)
 
@@ -0,0 +1,52 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import redis
+from benchmark_modes import wait_for_port
+
+# Configure the comparison
+PIPELINE_SIZES = [1, 10, 100]
+NUM_OPS = 20000
+PORT = 7390
+
+def run(client, pipeline_size, num_ops):
+    """Alternate SET and GET over num_ops operations, pipeline_size commands per round trip"""
+    start_time = time.perf_counter()
+    for i in range(0, num_ops, pipeline_size):
+        pipe = client.pipeline(transaction=False)
+        for j in range(i, min(i + pipeline_size, num_ops)):
+            key = f"key_{j % 1000}"
+            if j % 2:
+                pipe.get(key)
+            else:
+                pipe.set(key, f"value_{j}")
+        pipe.execute()
+    return num_ops / (time.perf_counter() - start_time)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the RESP front end at increasing pipeline depths')
+    parser.add_argument('--pipeline', type=int, nargs='+', default=PIPELINE_SIZES, help='Commands per round trip')
+    parser.add_argument('--ops', type=int, default=NUM_OPS, help='Operations per run')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    # Durability is off so the numbers reflect protocol and round-trip cost only
+    env = dict(os.environ, KV_WAL='off', KV_SNAPSHOTS='off')
+    server = subprocess.Popen([sys.executable, 'main.py', '--port', str(PORT + 1), '--resp-port', str(PORT)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(PORT):
+            print("RESP server did not start")
+            return
+        client = redis.Redis(port=PORT)
+        for size in args.pipeline:
+            print(f"pipeline {size}: {run(client, size, args.ops):.2f} ops/sec")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
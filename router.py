@@ -0,0 +1,36 @@
+import argparse
+import sys
+import uvicorn
+sys.path.append("./kv_store")
+from router_app import app, configure
+
+# Nodes routed to when none are given, matching benchmark.py
+DEFAULT_NODES = ['http://127.0.0.1:8080', 'http://127.0.0.1:8081', 'http://127.0.0.1:8082']
+
+def parse_node(text):
+    """Parse URL or URL=weight"""
+    url, _, weight = text.partition('=')
+    try:
+        weight = int(weight) if weight else 1
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid weight in '{text}'")
+    if weight < 1:
+        raise argparse.ArgumentTypeError(f"weight must be positive in '{text}'")
+    return url.rstrip('/'), weight
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Route the key-value API to nodes on a consistent-hash ring')
+    parser.add_argument('--port', type=int, default=8000, help='Port to serve the router on (default: 8000)')
+    parser.add_argument('--node', type=parse_node, action='append', dest='nodes',
+                        help='Node base URL, optionally with a ring weight as URL=weight; repeat per node (default: ports 8080-8082)')
+    parser.add_argument('--replica', nargs=2, metavar=('NODE_URL', 'REPLICA_URL'), action='append', default=[],
+                        help="Send some of a node's GETs to one of its read-only replicas; repeat per replica")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    replicas = {}
+    for node, replica in args.replica:
+        replicas.setdefault(node.rstrip('/'), []).append(replica.rstrip('/'))
+    configure(dict(args.nodes or [(url, 1) for url in DEFAULT_NODES]), replicas)
+    uvicorn.run(app, host='0.0.0.0', port=args.port, log_level='warning')
@@ -0,0 +1,496 @@
+import asyncio
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from urllib.parse import urlsplit, quote
+from uhashring import HashRing
+from benchmark_modes import http_request, wait_for_port, start_server
+
+# Core YCSB workloads plus a write-heavy mix: (operation proportions, key distribution)
+WORKLOADS = {
+    'a': ({'read': 0.5, 'update': 0.5}, 'zipfian'),             # Update heavy
+    'b': ({'read': 0.95, 'update': 0.05}, 'zipfian'),           # Read mostly
+    'c': ({'read': 1.0}, 'zipfian'),                            # Read only
+    'd': ({'read': 0.95, 'insert': 0.05}, 'latest'),            # Read latest
+    'e': ({'scan': 0.95, 'insert': 0.05}, 'zipfian'),           # Short ranges
+    'f': ({'read': 0.5, 'rmw': 0.5}, 'zipfian'),                # Read-modify-write
+    'w': ({'read': 0.1, 'update': 0.6, 'insert': 0.2, 'delete': 0.1}, 'zipfian'),  # Write heavy
+}
+OPERATIONS = ('read', 'update', 'insert', 'scan', 'rmw', 'delete')
+
+# Configure the defaults
+RECORD_COUNT = 10000
+DURATION = 10.0
+CONNECTIONS = 16
+VALUE_SIZE = 100
+MAX_SCAN = 100
+LOAD_BATCH = 500
+BASE_PORT = 8280
+ZIPFIAN_CONSTANT = 0.99
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'p999': 0.999}
+
+
+class ZipfianGenerator:
+    """Zipfian ranks in [0, items), rank 0 the most popular, as in YCSB (Gray et al., SIGMOD '94)"""
+
+    def __init__(self, items, theta=ZIPFIAN_CONSTANT):
+        self.items = items
+        self.theta = theta
+        self.alpha = 1.0 / (1.0 - theta)
+        self.zetan = sum(1.0 / (i + 1) ** theta for i in range(items))
+        zeta2 = 1.0 + 0.5 ** theta
+        self.eta = (1 - (2.0 / items) ** (1 - theta)) / (1 - zeta2 / self.zetan)
+        self.half_pow_theta = 0.5 ** theta
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < 1.0 + self.half_pow_theta:
+            return 1
+        return min(int(self.items * (self.eta * u - self.eta + 1) ** self.alpha), self.items - 1)
+
+
+def fnv1a64(n):
+    """FNV-1a of an integer's 8 bytes, used to scatter zipfian ranks over the key space"""
+    h = 0xcbf29ce484222325
+    for _ in range(8):
+        h ^= n & 0xff
+        h = (h * 0x100000001b3) & 0xffffffffffffffff
+        n >>= 8
+    return h
+
+
+class KeyChooser:
+    def __init__(self, distribution, records, rng):
+        """
+        Pick existing records by index
+
+        Args:
+            distribution (str): "uniform"; "zipfian", whose popular ranks are
+                hashed over the key space so hot keys land on every node, as
+                in YCSB's scrambled zipfian; or "latest", zipfian over how
+                recently a record was inserted
+            records (int): Records loaded before the run
+            rng (random.Random): Source of randomness
+        """
+        self.distribution = distribution
+        self.rng = rng
+        self.inserted = records  # Records 0 .. inserted - 1 exist
+        self.zipfian = ZipfianGenerator(records) if distribution != 'uniform' else None
+
+    def next_insert(self):
+        index = self.inserted
+        self.inserted += 1
+        return index
+
+    def next(self):
+        if self.distribution == 'uniform':
+            return int(self.rng.random() * self.inserted)
+        rank = self.zipfian.next(self.rng)
+        if self.distribution == 'latest':
+            return max(self.inserted - 1 - rank, 0)
+        return fnv1a64(rank) % self.inserted
+
+
+class ValueSizes:
+    def __init__(self, distribution, max_size, min_size, rng):
+        """
+        Pick value sizes in bytes
+
+        Args:
+            distribution (str): "constant" (always max_size), "uniform" over
+                [min_size, max_size], or "zipfian" over the same range with
+                small values the most common
+            max_size (int): Largest value
+            min_size (int): Smallest value for the non-constant distributions
+            rng (random.Random): Source of randomness
+        """
+        self.distribution = distribution
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.rng = rng
+        self.zipfian = ZipfianGenerator(max_size - self.min_size + 1) if distribution == 'zipfian' else None
+        # Values are random slices of one random string, so building them costs no more than a slice
+        self.pool = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(max_size * 2))
+
+    def next_value(self):
+        if self.distribution == 'constant':
+            size = self.max_size
+        elif self.distribution == 'uniform':
+            size = self.rng.randint(self.min_size, self.max_size)
+        else:
+            size = self.min_size + self.zipfian.next(self.rng)
+        start = int(self.rng.random() * self.max_size)
+        return self.pool[start:start + size]
+
+
+def record_key(index):
+    # Zero-padded so key order matches insert order, which scans rely on
+    return f"user{index:010d}"
+
+
+class Cluster:
+    def __init__(self, urls, connections):
+        """
+        Keep-alive connections to every node, routed with the same ketama ring as benchmark.py
+
+        Args:
+            urls (list): Node base URLs
+            connections (int): Connections opened to each node
+        """
+        self.urls = urls
+        self.ring = HashRing(urls, hash_fn='ketama')
+        self.connections = connections
+        self.pools = {}
+
+    async def open(self):
+        for url in self.urls:
+            parts = urlsplit(url)
+            pool = asyncio.Queue()
+            for _ in range(self.connections):
+                pool.put_nowait(await asyncio.open_connection(parts.hostname, parts.port or 80))
+            self.pools[url] = pool
+
+    async def close(self):
+        for pool in self.pools.values():
+            while not pool.empty():
+                connection = pool.get_nowait()
+                if connection is not None:
+                    connection[1].close()
+
+    def node_for(self, key):
+        return self.ring.get_node(key)
+
+    async def request(self, node, method, path, body=None):
+        """Send one request on a free connection to node; returns (status, seconds spent waiting for the connection)"""
+        pool = self.pools[node]
+        waited_from = time.perf_counter()
+        connection = await pool.get()
+        waited = time.perf_counter() - waited_from
+        try:
+            if connection is None:
+                parts = urlsplit(node)
+                connection = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            status = await http_request(*connection, method, path, body)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            # The connection is unusable after a failed exchange; its slot reconnects on next use
+            if connection is not None:
+                connection[1].close()
+            pool.put_nowait(None)
+            return None, waited
+        pool.put_nowait(connection)
+        return status, waited
+
+
+async def load(cluster, records, values):
+    """Insert records 0 .. records - 1, in /_mset batches per node; falls back to single POSTs"""
+    by_node = {}
+    for index in range(records):
+        key = record_key(index)
+        by_node.setdefault(cluster.node_for(key), []).append({'key': key, 'value': values.next_value()})
+
+    async def load_node(node, items):
+        for i in range(0, len(items), LOAD_BATCH):
+            batch = items[i:i + LOAD_BATCH]
+            status, _ = await cluster.request(node, 'POST', '/_mset', batch)
+            if status == 200:
+                continue
+            # Nodes without the batch endpoints (the asgi app) take one key per request
+            await asyncio.gather(*(cluster.request(node, 'POST', f"/{item['key']}", {'value': item['value']})
+                                   for item in batch))
+
+    await asyncio.gather(*(load_node(node, items) for node, items in by_node.items()))
+
+
+class Workload:
+    def __init__(self, mix, keys, values, max_scan, rng):
+        self.operations = [op for op in OPERATIONS if mix.get(op)]
+        total = sum(mix[op] for op in self.operations)
+        self.cumulative = []
+        running = 0.0
+        for op in self.operations:
+            running += mix[op] / total
+            self.cumulative.append(running)
+        self.keys = keys
+        self.values = values
+        self.max_scan = max_scan
+        self.rng = rng
+
+    def next_op(self):
+        u = self.rng.random()
+        for op, bound in zip(self.operations, self.cumulative):
+            if u < bound:
+                return op
+        return self.operations[-1]
+
+    def plan(self):
+        """
+        Draw the next operation up front, so choosing keys and values is not timed
+
+        Returns:
+            tuple: (op, key, value or scan length)
+        """
+        op = self.next_op()
+        if op == 'insert':
+            return op, record_key(self.keys.next_insert()), self.values.next_value()
+        key = record_key(self.keys.next())
+        if op in ('update', 'rmw'):
+            return op, key, self.values.next_value()
+        if op == 'scan':
+            return op, key, self.rng.randint(1, self.max_scan)
+        return op, key, None
+
+
+async def execute(cluster, op, key, arg):
+    """Run one planned operation; returns (node, final status, seconds spent waiting for connections)"""
+    node = cluster.node_for(key)
+    if op == 'read':
+        status, waited = await cluster.request(node, 'GET', f"/{key}")
+    elif op in ('update', 'insert'):
+        status, waited = await cluster.request(node, 'POST', f"/{key}", {'value': arg})
+    elif op == 'delete':
+        status, waited = await cluster.request(node, 'DELETE', f"/{key}")
+    elif op == 'scan':
+        # Keys are hash-partitioned, so a range scan reads the owning node's keys after the start key
+        status, waited = await cluster.request(node, 'GET', f"/_scan?cursor={quote(key)}&count={arg}")
+    else:
+        status, waited = await cluster.request(node, 'GET', f"/{key}")
+        if status == 200:
+            status, waited_update = await cluster.request(node, 'POST', f"/{key}", {'value': arg})
+            waited += waited_update
+    return node, status, waited
+
+
+class Recorder:
+    def __init__(self, start):
+        self.start = start
+        self.samples = []  # (op, node, status, corrected, service, completed_at)
+
+    def add(self, op, node, status, intended, sent, completed):
+        # Corrected latency runs from when the op was due, so stalls count against every op
+        # that should have been sent during them (coordinated-omission correction)
+        self.samples.append((op, node, status, completed - intended, completed - sent, completed - self.start))
+
+
+async def run_open_loop(cluster, workload, rate, duration, arrivals, rng):
+    """
+    Send operations on a fixed schedule of rate ops/sec, whether or not earlier ones have finished
+
+    An operation that cannot get a connection waits for one. Its corrected
+    latency still starts at its scheduled time, so a slow server raises the
+    latency of everything queued behind it, as a real client population would see.
+    """
+    start = time.perf_counter()
+    recorder = Recorder(start)
+    tasks = []
+    late = 0
+
+    async def one(op, key, arg, intended):
+        sent = time.perf_counter()
+        node, status, waited = await execute(cluster, op, key, arg)
+        recorder.add(op, node, status, intended, sent + waited, time.perf_counter())
+
+    intended = start
+    end = start + duration
+    while True:
+        intended += rng.expovariate(rate) if arrivals == 'poisson' else 1.0 / rate
+        if intended >= end:
+            break
+        delay = intended - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -0.001:
+            late += 1
+        op, key, arg = workload.plan()
+        tasks.append(asyncio.ensure_future(one(op, key, arg, intended)))
+    await asyncio.gather(*tasks)
+    return recorder, time.perf_counter() - start, late
+
+
+async def run_closed_loop(cluster, workload, workers, duration):
+    """Each worker sends its next operation as soon as the previous one returns"""
+    start = time.perf_counter()
+    recorder = Recorder(start)
+    end = start + duration
+
+    async def worker():
+        while time.perf_counter() < end:
+            op, key, arg = workload.plan()
+            sent = time.perf_counter()
+            node, status, waited = await execute(cluster, op, key, arg)
+            now = time.perf_counter()
+            recorder.add(op, node, status, sent, sent + waited, now)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return recorder, time.perf_counter() - start, 0
+
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    n = len(latencies)
+    result = {name: latencies[min(int(math.ceil(q * n)) - 1, n - 1)] for name, q in PERCENTILES.items()}
+    result['max'] = latencies[-1]
+    result['mean'] = sum(latencies) / n
+    return result
+
+
+def summarize(recorder, elapsed, late, nodes):
+    samples = recorder.samples
+    errors = sum(1 for _, _, status, _, _, _ in samples if status is None or status >= 500)
+    not_found = sum(1 for _, _, status, _, _, _ in samples if status == 404)
+    per_op = {}
+    for op in OPERATIONS:
+        op_samples = [s for s in samples if s[0] == op]
+        if op_samples:
+            per_op[op] = {
+                'ops': len(op_samples),
+                'corrected': percentiles([s[3] for s in op_samples]),
+                'service': percentiles([s[4] for s in op_samples]),
+            }
+
+    # Completions per second of the run
+    windows = [[] for _ in range(int(math.ceil(elapsed)))]
+    for s in samples:
+        windows[min(int(s[5]), len(windows) - 1)].append(s)
+    timeline = [{
+        'second': second,
+        'ops': len(window),
+        'errors': sum(1 for s in window if s[2] is None or s[2] >= 500),
+        'p99': percentiles([s[3] for s in window])['p99'] if window else None,
+    } for second, window in enumerate(windows)]
+
+    counts = {node: 0 for node in nodes}
+    for s in samples:
+        counts[s[1]] += 1
+    mean = len(samples) / len(nodes) if nodes else 0
+    return {
+        'ops': len(samples),
+        'elapsed': elapsed,
+        'throughput': len(samples) / elapsed if elapsed else 0.0,
+        'errors': errors,
+        'error_rate': errors / len(samples) if samples else 0.0,
+        'not_found': not_found,
+        'late_dispatches': late,
+        'latency': {
+            'corrected': percentiles([s[3] for s in samples]),
+            'service': percentiles([s[4] for s in samples]),
+        },
+        'per_op': per_op,
+        'timeline': timeline,
+        'nodes': {node: {'ops': count, 'share': count / len(samples) if samples else 0.0}
+                  for node, count in counts.items()},
+        # Busiest node's load relative to an even split; 1.0 is perfectly balanced
+        'skew': max(counts.values()) / mean if mean else 0.0,
+    }
+
+
+async def run_workload(args, name, urls):
+    mix, distribution = WORKLOADS[name]
+    if args.mix:
+        mix = {op: float(weight) for op, _, weight in (part.partition('=') for part in args.mix.split(','))}
+    distribution = args.distribution or distribution
+    rng = random.Random(args.seed)
+
+    cluster = Cluster(urls, args.connections)
+    await cluster.open()
+    try:
+        values = ValueSizes(args.value_dist, args.value_size, args.min_value_size, rng)
+        if args.records:
+            await load(cluster, args.records, values)
+        workload = Workload(mix, KeyChooser(distribution, max(args.records, 1), rng), values, args.max_scan, rng)
+        if args.rate:
+            recorder, elapsed, late = await run_open_loop(cluster, workload, args.rate, args.duration, args.arrivals, rng)
+        else:
+            recorder, elapsed, late = await run_closed_loop(cluster, workload, args.connections * len(urls), args.duration)
+    finally:
+        await cluster.close()
+
+    return {
+        'workload': name,
+        'config': {
+            'mix': mix, 'distribution': distribution, 'records': args.records, 'duration': args.duration,
+            'target_rate': args.rate or None, 'arrivals': args.arrivals if args.rate else 'closed-loop',
+            'connections_per_node': args.connections, 'value_size': args.value_size,
+            'value_dist': args.value_dist, 'max_scan': args.max_scan, 'nodes': urls,
+        },
+        'results': summarize(recorder, elapsed, late, urls),
+    }
+
+
+def print_summary(report):
+    results = report['results']
+    latency = results['latency']['corrected']
+    print(f"workload {report['workload']}: {results['throughput']:.2f} ops/sec, "
+          f"error rate {results['error_rate'] * 100:.4f}%, skew {results['skew']:.2f}", file=sys.stderr)
+    if latency:
+        print(f"  p50 {latency['p50'] * 1000:.2f} ms, p99 {latency['p99'] * 1000:.2f} ms, "
+              f"p999 {latency['p999'] * 1000:.2f} ms", file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YCSB-style workloads against one or more nodes, reported as JSON')
+    parser.add_argument('--workload', nargs='+', choices=sorted(WORKLOADS), default=['a'], help='Workloads to run in turn (default: a)')
+    parser.add_argument('--mix', help='Override the operation mix, e.g. read=0.9,scan=0.1 (operations: ' + ', '.join(OPERATIONS) + ')')
+    parser.add_argument('--distribution', choices=['uniform', 'zipfian', 'latest'], help="Override the workload's key distribution")
+    parser.add_argument('--records', type=int, default=RECORD_COUNT, help='Records loaded before each run, 0 to skip loading')
+    parser.add_argument('--duration', type=float, default=DURATION, help='Seconds per run')
+    parser.add_argument('--rate', type=float, default=0, help='Target ops/sec for open-loop load; 0 runs closed-loop')
+    parser.add_argument('--arrivals', choices=['uniform', 'poisson'], default='uniform', help='Open-loop arrival spacing')
+    parser.add_argument('--connections', type=int, default=CONNECTIONS, help='Keep-alive connections per node (closed-loop: one worker each)')
+    parser.add_argument('--value-size', type=int, default=VALUE_SIZE, help='Largest value in bytes')
+    parser.add_argument('--min-value-size', type=int, default=1, help='Smallest value for uniform and zipfian sizes')
+    parser.add_argument('--value-dist', choices=['constant', 'uniform', 'zipfian'], default='constant', help='Value size distribution')
+    parser.add_argument('--max-scan', type=int, default=MAX_SCAN, help='Longest scan; lengths are uniform from 1')
+    parser.add_argument('--node', action='append', help='Node base URL, repeatable (default: http://127.0.0.1:8080)')
+    parser.add_argument('--start', type=int, default=0, help='Start this many local nodes instead of using --node')
+    parser.add_argument('--mode', choices=['wsgi', 'asgi'], default='wsgi', help='Server mode for --start')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+    if args.mix:
+        unknown = {part.partition('=')[0] for part in args.mix.split(',')} - set(OPERATIONS)
+        if unknown:
+            parser.error(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    servers = []
+    if args.start:
+        urls = [f"http://127.0.0.1:{BASE_PORT + i}" for i in range(args.start)]
+        servers = [start_server(args.mode, BASE_PORT + i, ['--resp-port', '0']) for i in range(args.start)]
+    else:
+        urls = args.node or ['http://127.0.0.1:8080']
+
+    try:
+        for url in urls[:len(servers)]:
+            if not wait_for_port(urlsplit(url).port):
+                print(f"{url} did not start")
+                return
+        reports = []
+        for name in args.workload:
+            report = asyncio.run(run_workload(args, name, urls))
+            print_summary(report)
+            reports.append(report)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(reports, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()